@@ -0,0 +1,274 @@
+import sys
+import timeit
+from memoryfs_client import *
+
+## Microbenchmarks for the client and server building blocks
+## Usage: python memoryfs_bench.py [xor] [protocol] [rebuild] [checksum] [range] [file]
+
+# Block sizes benchmarked, from the default 128 Bytes up to 64 KiB
+BENCH_BLOCK_SIZES = [128, 512, 1024, 4096, 16384, 65536]
+
+
+## Runs function repeatedly and returns the average time per call in microseconds
+
+def TimeCall(function, size):
+    # keep the total number of bytes processed roughly constant across block sizes
+    number = max(10, (4 * 1024 * 1024) // size)
+    return timeit.timeit(function, number=number) / number * 1e6
+
+
+## The original byte-at-a-time XOR, kept as a baseline
+
+def LoopXor(b1, b2):
+    result = bytearray()
+    for i in range(0, len(b1)):
+        result.append(b1[i] ^ b2[i])
+    return result
+
+
+## XOR engine: two-block xor, in-place accumulate, and reconstruction of a block from 4 peers
+
+def BenchXor():
+    print('xor engine (' + ('numpy' if numpy is not None else 'pure python') + '), microseconds per call')
+    print('%8s %12s %12s %12s %16s' % ('size', 'loop', 'xor_blocks', 'xor_into', 'xor_many(4 blk)'))
+    for size in BENCH_BLOCK_SIZES:
+        b1 = bytearray(range(256)) * (size // 256) or bytearray(range(size))
+        b2 = bytes(reversed(b1))
+        accumulator = bytearray(size)
+        peers = [b1, b2, b1, b2]
+        print('%8d %12.2f %12.2f %12.2f %16.2f' % (
+            size,
+            TimeCall(lambda: LoopXor(b1, b2), size * 64),
+            TimeCall(lambda: xor_blocks(b1, b2), size),
+            TimeCall(lambda: xor_into(accumulator, b2), size),
+            TimeCall(lambda: xor_many(peers, size), size)))
+
+
+## Block protocols: operations per second of Get and Put round trips, and of pipelined Gets, against a
+## server running in this process (so client and server share one core)
+
+def BenchProtocol():
+    import memoryfs_server
+    import memoryfs_protocol
+
+    blocks = memoryfs_server.DiskBlocks(memoryfs_server.MemoryBlockStore(1024, BLOCK_SIZE))
+    xmlrpc_server = memoryfs_server.ThreadedXMLRPCServer(('localhost', 0), requestHandler=memoryfs_server.RequestHandler,
+                                                         allow_none=True, logRequests=False)
+    xmlrpc_server.register_instance(blocks)
+    binary_server = memoryfs_server.BlockProtocolServer(('localhost', 0), blocks)
+    for server in (xmlrpc_server, binary_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    clients = {
+        'xmlrpc': xmlrpc.client.ServerProxy('http://localhost:' + str(xmlrpc_server.server_address[1]),
+                                            use_builtin_types=True),
+        'binary': memoryfs_protocol.BlockClient('localhost', binary_server.server_address[1]),
+    }
+    block = bytes(BLOCK_SIZE)
+    number = 2000
+
+    print('block protocols, ' + str(BLOCK_SIZE) + ' Byte blocks, operations per second')
+    print('%8s %12s %12s %16s' % ('protocol', 'Get', 'Put', 'pipelined Get'))
+    for name, client in clients.items():
+        get = number / timeit.timeit(lambda: client.Get(7), number=number)
+        put = number / timeit.timeit(lambda: client.Put(7, block), number=number)
+        pipelined = '-'
+        if name == 'binary':
+            request = [memoryfs_protocol.BLOCK_NUMBER.pack(7)]
+            start = time.perf_counter()
+            futures = [client.Submit(memoryfs_protocol.OP_GET, request, bytearray) for i in range(0, number)]
+            for future in futures:
+                future.result()
+            pipelined = '%.0f' % (number / (time.perf_counter() - start))
+        print('%8s %12.0f %12.0f %16s' % (name, get, put, pipelined))
+
+    for server in (xmlrpc_server, binary_server):
+        server.shutdown()
+
+
+## Starts an XML-RPC block server over blocks in this process; returns the server and its URL
+
+def StartServer(blocks):
+    import memoryfs_server
+
+    server = memoryfs_server.ThreadedXMLRPCServer(('localhost', 0), requestHandler=memoryfs_server.RequestHandler,
+                                                  allow_none=True, logRequests=False)
+    server.register_instance(blocks)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://localhost:' + str(server.server_address[1])
+
+
+## Original rebuild, kept as a baseline: one Get per peer and one Put per block
+
+def BlockAtATimeRebuild(RawBlocks, server, num_blocks):
+    for physical_block_number in range(0, num_blocks):
+        peers = [RawBlocks.Get_RPC(peer, physical_block_number) for peer in range(len(RawBlocks.servers)) if peer != server]
+        RawBlocks.Put_RPC(server, physical_block_number, xor_many(peers, BLOCK_SIZE))
+
+
+## Server rebuild: blocks per second rebuilt onto a blank replacement of one of 4 servers, block at a time and
+## in batches of growing size (servers in this process, so clients and servers share one core)
+
+def BenchRebuild():
+    import memoryfs_server
+    import memoryfs_rebuild
+
+    num_servers = 4
+    num_blocks = 2048
+    failed = 1
+    servers = []
+    urls = []
+    for i in range(0, num_servers):
+        server, url = StartServer(memoryfs_server.DiskBlocks(memoryfs_server.MemoryBlockStore(num_blocks, BLOCK_SIZE)))
+        servers.append(server)
+        urls.append(url)
+    RawBlocks = DiskBlocks(urls, parallel=True, heartbeat_interval=0)
+    data = bytes(range(256)) * (BLOCK_SIZE // 256) or bytes(range(BLOCK_SIZE))
+    RawBlocks.WriteBlocks([(block_number, data) for block_number in range(0, num_blocks * (num_servers - 1))])
+
+    print('server rebuild, ' + str(num_servers) + ' servers of ' + str(num_blocks) + ' ' + str(BLOCK_SIZE)
+          + ' Byte blocks, blocks per second')
+    print('%16s %12s %10s' % ('method', 'blocks/s', 'MB/s'))
+    methods = [('block at a time', None)] + [('batch ' + str(size), size) for size in (16, 64, 256, 1024)]
+    for name, batch_size in methods:
+        # a blank replacement of the failed server
+        replacement, url = StartServer(memoryfs_server.DiskBlocks(
+            memoryfs_server.MemoryBlockStore(num_blocks, BLOCK_SIZE), rebuilding=True))
+        urls[failed] = url
+        RawBlocks = DiskBlocks(urls, parallel=True, heartbeat_interval=0)
+        start = time.perf_counter()
+        if batch_size is None:
+            BlockAtATimeRebuild(RawBlocks, failed, num_blocks)
+        else:
+            memoryfs_rebuild.Rebuild(RawBlocks, failed, batch_size).Run()
+        elapsed = time.perf_counter() - start
+        print('%16s %12.0f %10.2f' % (name, num_blocks / elapsed, num_blocks * BLOCK_SIZE / elapsed / 1e6))
+        replacement.shutdown()
+
+    for server in servers:
+        server.shutdown()
+
+
+## Checksums: digest time per block of every available algorithm, and server Get/Put operations per second
+## with each algorithm and verify policy (calls to the server's DiskBlocks, without RPC)
+
+def BenchChecksum():
+    import memoryfs_server
+
+    algorithms = list(memoryfs_server.CHECKSUM_ALGORITHMS)
+    print('block checksums, microseconds per block')
+    print('%8s' % 'size' + ''.join('%10s' % algorithm for algorithm in algorithms))
+    for size in BENCH_BLOCK_SIZES:
+        block = bytes(range(256)) * (size // 256) or bytes(range(size))
+        print('%8d' % size + ''.join('%10.2f' % TimeCall(lambda: memoryfs_server.CHECKSUM_ALGORITHMS[algorithm][1](block),
+                                                          size) for algorithm in algorithms))
+
+    number = 20000
+    block = bytes(range(256)) * (BLOCK_SIZE // 256) or bytes(range(BLOCK_SIZE))
+    print('server Get/Put, ' + str(BLOCK_SIZE) + ' Byte blocks, operations per second')
+    print('%10s %10s %12s %12s' % ('checksum', 'verify', 'Get', 'Put'))
+    for algorithm in algorithms:
+        for verify in memoryfs_server.VERIFY_POLICIES:
+            blocks = memoryfs_server.DiskBlocks(memoryfs_server.MemoryBlockStore(1024, BLOCK_SIZE, algorithm),
+                                                verify=verify)
+            put = number / timeit.timeit(lambda: blocks.Put(7, block), number=number)
+            get = number / timeit.timeit(lambda: blocks.Get(7), number=number)
+            print('%10s %10s %12.0f %12.0f' % (algorithm, verify, get, put))
+
+
+## Ranged writes: updates per second of 16 Bytes of a block (an inode, a directory entry), written as a whole
+## block by Put (read old data, write data, XOR the delta into parity) or as a range by PutRange, over 4 servers
+
+def BenchRange():
+    import memoryfs_client
+    import memoryfs_server
+
+    number = 500
+    print('16 Byte updates of a block, updates per second')
+    print('%8s %12s %12s' % ('size', 'Put', 'PutRange'))
+    for size in (128, 1024, 4096, 16384):
+        memoryfs_client.SetGeometry(TOTAL_NUM_BLOCKS, size, MAX_NUM_INODES, INODE_SIZE)
+        servers = [StartServer(memoryfs_server.DiskBlocks(memoryfs_server.MemoryBlockStore(256, size)))
+                   for i in range(0, 4)]
+        RawBlocks = DiskBlocks([url for server, url in servers], parallel=True, heartbeat_interval=0)
+        update = bytes(range(16))
+
+        def PutBlock():
+            block_data = RawBlocks.Get(7)
+            block_data[32:48] = update
+            RawBlocks.Put(7, block_data)
+
+        put = number / timeit.timeit(PutBlock, number=number)
+        put_range = number / timeit.timeit(lambda: RawBlocks.PutRange(7, 32, update), number=number)
+        print('%8d %12.0f %12.0f' % (size, put, put_range))
+        for server, url in servers:
+            server.shutdown()
+    memoryfs_client.SetGeometry(TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE)
+
+
+## Open files: MB/s of appending a file 100 Bytes at a time and of reading it back a stripe at a time,
+## with one-shot FileName.Write/Read calls and through a FileHandle (write buffer, read ahead), over 4 servers
+
+def BenchFile():
+    import memoryfs_client
+    import memoryfs_server
+
+    num_servers = 4
+    memoryfs_client.SetGeometry(4096, BLOCK_SIZE, 64, 32)
+    servers = [StartServer(memoryfs_server.DiskBlocks(memoryfs_server.MemoryBlockStore(2048, BLOCK_SIZE)))
+               for i in range(0, num_servers)]
+    RawBlocks = DiskBlocks([url for server, url in servers], parallel=True, heartbeat_interval=0)
+    RawBlocks.InitializeBlocks(True, b'\x12\x34\x56\x78')
+    FileObject = FileName(RawBlocks)
+    FileObject.InitRootInode()
+
+    size = 64 * 1024
+    chunk = bytes(range(100))
+    stripe_size = (num_servers - 1) * BLOCK_SIZE
+
+    def OneShotWrite(file_inode_number):
+        for offset in range(0, size, len(chunk)):
+            FileObject.Write(file_inode_number, offset, chunk)
+
+    def HandleWrite(file_inode_number):
+        with FileObject.Open(file_inode_number, 'r+') as file:
+            for offset in range(0, size, len(chunk)):
+                file.write(chunk)
+
+    def OneShotRead(file_inode_number):
+        for offset in range(0, size, stripe_size):
+            FileObject.Read(file_inode_number, offset, stripe_size)
+
+    def HandleRead(file_inode_number):
+        with FileObject.Open(file_inode_number) as file:
+            chunk = file.read(stripe_size)
+            while chunk and chunk != -1:
+                chunk = file.read(stripe_size)
+
+    print('file of ' + str(size) + ' Bytes, ' + str(BLOCK_SIZE) + ' Byte blocks, ' + str(num_servers)
+          + ' servers, MB/s')
+    print('%10s %12s %12s' % ('method', 'write', 'read'))
+    for name, write, read in (('one-shot', OneShotWrite, OneShotRead), ('handle', HandleWrite, HandleRead)):
+        file_inode_number = FileObject.Create(0, name, INODE_TYPE_FILE)
+        write_time = timeit.timeit(lambda: write(file_inode_number), number=1)
+        read_time = timeit.timeit(lambda: read(file_inode_number), number=1)
+        print('%10s %12.3f %12.3f' % (name, size / write_time / 1e6, size / read_time / 1e6))
+
+    for server, url in servers:
+        server.shutdown()
+    memoryfs_client.SetGeometry(TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE)
+
+
+BENCHMARKS = {
+    'xor': BenchXor,
+    'protocol': BenchProtocol,
+    'rebuild': BenchRebuild,
+    'checksum': BenchChecksum,
+    'range': BenchRange,
+    'file': BenchFile,
+}
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        BENCHMARKS[name]()
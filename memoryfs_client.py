@@ -1,12 +1,25 @@
 import xmlrpc.client
 import base64
+import uuid
+import zlib
 import threading
+import concurrent.futures
+import collections
 import time
 import pickle, logging
+from memoryfs_protocol import BlockClient, ServerPool, HealthMonitor, TimeoutTransport, ServerUnavailable
+
+# NumPy is optional: it speeds up XOR of large blocks, the pure Python path is used when it is missing
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 ##### File system constants
 
 # Core parameters
+# These are the defaults used to format a new file system; the geometry of a mounted file system is read
+# from its superblock, and SetGeometry() recomputes every derived parameter below
 # Total number of blocks in raw storage
 TOTAL_NUM_BLOCKS = 256
 # Block size (in Bytes)
@@ -29,15 +42,19 @@ INODES_PER_BLOCK = BLOCK_SIZE // INODE_SIZE
 FREEBITMAP_BLOCK_OFFSET = 2
 
 # Number of blocks needed for free bitmap
-# For simplicity, we assume each entry in the bitmap is a Byte in length
-# This allows us to avoid bit-wise operations
-FREEBITMAP_NUM_BLOCKS = TOTAL_NUM_BLOCKS // BLOCK_SIZE
+# Each entry in the bitmap is one bit: block b is bit (b % 8) of byte b // 8, counting from the start of the bitmap
+FREEBITMAP_BITS_PER_BLOCK = BLOCK_SIZE * 8
+FREEBITMAP_NUM_BLOCKS = -(-TOTAL_NUM_BLOCKS // FREEBITMAP_BITS_PER_BLOCK)
+
+# Bitmap of used inodes follows the free bitmap, one bit per inode, same bit order
+INODEBITMAP_BLOCK_OFFSET = FREEBITMAP_BLOCK_OFFSET + FREEBITMAP_NUM_BLOCKS
+INODEBITMAP_NUM_BLOCKS = -(-MAX_NUM_INODES // FREEBITMAP_BITS_PER_BLOCK)
 
-# inode table starts at offset 2 + FREEBITMAP_NUM_BLOCKS
-INODE_BLOCK_OFFSET = 2 + FREEBITMAP_NUM_BLOCKS
+# inode table starts after the inode bitmap
+INODE_BLOCK_OFFSET = INODEBITMAP_BLOCK_OFFSET + INODEBITMAP_NUM_BLOCKS
 
 # inode table size
-INODE_NUM_BLOCKS = (MAX_NUM_INODES * INODE_SIZE) // BLOCK_SIZE
+INODE_NUM_BLOCKS = -(-(MAX_NUM_INODES * INODE_SIZE) // BLOCK_SIZE)
 
 # maximum number of blocks indexed by inode
 # This implementation hardcodes:
@@ -48,9 +65,22 @@ INODE_NUM_BLOCKS = (MAX_NUM_INODES * INODE_SIZE) // BLOCK_SIZE
 # In total, 4+2+2=8 bytes are used for size+type+refcnt, remaining bytes for block numbers
 MAX_INODE_BLOCK_NUMBERS = (INODE_SIZE - 8) // 4
 
+# Number of block numbers that fit in an indirect block
+POINTERS_PER_BLOCK = BLOCK_SIZE // 4
+
+# The last entries of an inode's block_numbers[] point to indirect blocks, the others to data blocks
+# With 2 or more entries the last one is a single indirect block (a block of POINTERS_PER_BLOCK data block numbers);
+# with 3 or more the last one is double indirect (a block of single indirect block numbers) and the one before single
+NUM_INDIRECT_BLOCK_NUMBERS = min(2, MAX_INODE_BLOCK_NUMBERS - 1)
+NUM_DIRECT_BLOCK_NUMBERS = MAX_INODE_BLOCK_NUMBERS - NUM_INDIRECT_BLOCK_NUMBERS
+
+# maximum number of data blocks of a file, through direct, single and double indirect entries
+MAX_FILE_BLOCKS = NUM_DIRECT_BLOCK_NUMBERS + [0, POINTERS_PER_BLOCK, POINTERS_PER_BLOCK + POINTERS_PER_BLOCK ** 2][
+    NUM_INDIRECT_BLOCK_NUMBERS]
+
 # maximum size of a file
-# maximum number of entries in an inode's block_numbers[], times block size
-MAX_FILE_SIZE = MAX_INODE_BLOCK_NUMBERS * BLOCK_SIZE
+# maximum number of data blocks, times block size, limited by the 4 bytes of the inode's size field
+MAX_FILE_SIZE = min(MAX_FILE_BLOCKS * BLOCK_SIZE, 2 ** 32 - 1)
 
 # Data blocks start at INODE_BLOCK_OFFSET + INODE_NUM_BLOCKS
 DATA_BLOCKS_OFFSET = INODE_BLOCK_OFFSET + INODE_NUM_BLOCKS
@@ -64,6 +94,44 @@ FILE_NAME_DIRENTRY_SIZE = MAX_FILENAME + INODE_NUMBER_DIRENTRY_SIZE
 # Number of filename+inode entries that can be stored in a single block
 FILE_ENTRIES_PER_DATA_BLOCK = BLOCK_SIZE // FILE_NAME_DIRENTRY_SIZE
 
+# Version of the on-disk layout, stored in the superblock (entry 4): volumes of another layout are not mounted
+# Superblocks without a version are from before the layout was versioned, and are not mounted either
+FORMAT_VERSION = 1
+
+# Number of free bitmap blocks loaded together when building the free space summary
+FREEBITMAP_PREFETCH = 16
+
+# Lease of a lock taken from the lock service, in seconds: a lock held by a client that died is freed after this
+LOCK_LEASE = 30
+
+# Held locks are renewed this many times per lease, by a background thread of the client, see DiskBlocks.RenewLocks
+LOCK_RENEWALS = 3
+
+# Longest time a single lock request waits on the server, in seconds; a waiting client then asks again
+LOCK_WAIT = 10
+
+# Largest number of connections kept open to each server, i.e. of concurrent calls to a server
+CONNECTIONS_PER_SERVER = 4
+
+# Time allowed to a server call, in seconds; longer than LOCK_WAIT, as a lock request waits on the server
+RPC_TIMEOUT = 2 * LOCK_WAIT
+
+# Servers not heard from for this many seconds get a heartbeat, see HealthMonitor
+HEARTBEAT_INTERVAL = 2
+
+# Name of the lock protecting the whole file system, see FileName.ACQUIRE/RELEASE
+FILE_SYSTEM_LOCK = 'filesystem'
+
+# Lock word counting, on the other servers, the outages during which a server missed writes (name followed by
+# the index of the server), see DiskBlocks.MissedWrites
+MISSED_WRITES_WORD = 'missed:'
+
+# Stripes read ahead of sequential reads of an open file, see FileHandle
+READAHEAD_STRIPES = 2
+
+# Stripes of data buffered by writes to an open file before they are written out, see FileHandle
+WRITE_BUFFER_STRIPES = 4
+
 # Supported inode types
 INODE_TYPE_INVALID = 0
 INODE_TYPE_FILE = 1
@@ -71,16 +139,186 @@ INODE_TYPE_DIR = 2
 INODE_TYPE_SYM = 3
 
 
+## Sets the file system geometry and recomputes all derived parameters
+## Called when formatting a new file system and when mounting one, with the values stored in its superblock
+
+def SetGeometry(total_num_blocks, block_size, max_num_inodes, inode_size):
+    global TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE, INODES_PER_BLOCK, FREEBITMAP_NUM_BLOCKS, \
+        FREEBITMAP_BITS_PER_BLOCK, INODEBITMAP_BLOCK_OFFSET, INODEBITMAP_NUM_BLOCKS, \
+        INODE_BLOCK_OFFSET, INODE_NUM_BLOCKS, MAX_INODE_BLOCK_NUMBERS, MAX_FILE_SIZE, DATA_BLOCKS_OFFSET, \
+        DATA_NUM_BLOCKS, FILE_ENTRIES_PER_DATA_BLOCK, POINTERS_PER_BLOCK, NUM_INDIRECT_BLOCK_NUMBERS, \
+        NUM_DIRECT_BLOCK_NUMBERS, MAX_FILE_BLOCKS
+
+    # inodes must not straddle blocks, and must hold the 8 Bytes of metadata plus whole block numbers
+    # directory entries must not straddle blocks either
+    if inode_size < 12 or inode_size % 4 != 0 or block_size % inode_size != 0 \
+            or block_size % FILE_NAME_DIRENTRY_SIZE != 0:
+        logging.error('SetGeometry: invalid block size ' + str(block_size) + ' / inode size ' + str(inode_size))
+        quit()
+
+    TOTAL_NUM_BLOCKS = total_num_blocks
+    BLOCK_SIZE = block_size
+    MAX_NUM_INODES = max_num_inodes
+    INODE_SIZE = inode_size
+
+    INODES_PER_BLOCK = BLOCK_SIZE // INODE_SIZE
+    FREEBITMAP_BITS_PER_BLOCK = BLOCK_SIZE * 8
+    FREEBITMAP_NUM_BLOCKS = -(-TOTAL_NUM_BLOCKS // FREEBITMAP_BITS_PER_BLOCK)
+    INODEBITMAP_BLOCK_OFFSET = FREEBITMAP_BLOCK_OFFSET + FREEBITMAP_NUM_BLOCKS
+    INODEBITMAP_NUM_BLOCKS = -(-MAX_NUM_INODES // FREEBITMAP_BITS_PER_BLOCK)
+    INODE_BLOCK_OFFSET = INODEBITMAP_BLOCK_OFFSET + INODEBITMAP_NUM_BLOCKS
+    INODE_NUM_BLOCKS = -(-(MAX_NUM_INODES * INODE_SIZE) // BLOCK_SIZE)
+    MAX_INODE_BLOCK_NUMBERS = (INODE_SIZE - 8) // 4
+    POINTERS_PER_BLOCK = BLOCK_SIZE // 4
+    NUM_INDIRECT_BLOCK_NUMBERS = min(2, MAX_INODE_BLOCK_NUMBERS - 1)
+    NUM_DIRECT_BLOCK_NUMBERS = MAX_INODE_BLOCK_NUMBERS - NUM_INDIRECT_BLOCK_NUMBERS
+    MAX_FILE_BLOCKS = NUM_DIRECT_BLOCK_NUMBERS + [0, POINTERS_PER_BLOCK, POINTERS_PER_BLOCK + POINTERS_PER_BLOCK ** 2][
+        NUM_INDIRECT_BLOCK_NUMBERS]
+    MAX_FILE_SIZE = min(MAX_FILE_BLOCKS * BLOCK_SIZE, 2 ** 32 - 1)
+    DATA_BLOCKS_OFFSET = INODE_BLOCK_OFFSET + INODE_NUM_BLOCKS
+    DATA_NUM_BLOCKS = TOTAL_NUM_BLOCKS - DATA_BLOCKS_OFFSET
+    FILE_ENTRIES_PER_DATA_BLOCK = BLOCK_SIZE // FILE_NAME_DIRENTRY_SIZE
+
+    if DATA_NUM_BLOCKS <= 0:
+        logging.error('SetGeometry: no room for data blocks in ' + str(TOTAL_NUM_BLOCKS) + ' blocks')
+        quit()
+
+
+# Blocks at least this large are XORed with NumPy when it is available; smaller blocks are faster as integers
+NUMPY_XOR_MIN_SIZE = 1024
+
+
+#### PARITY ENGINE
+
+# Blocks are XORed whole, as wide little-endian integers or as NumPy arrays, instead of byte by byte
+# A shorter block behaves as if padded with zeroes up to the length of the longer one
+
+## Returns a new bytearray with the xor of two blocks
+
+def xor_blocks(b1, b2):
+    if len(b1) < len(b2):
+        b1, b2 = b2, b1
+    return xor_into(bytearray(b1), b2)
+
+## XORs block into accumulator in place and returns accumulator
+## accumulator must be a bytearray at least as long as block
+
+def xor_into(accumulator, block):
+    if numpy is not None and len(block) >= NUMPY_XOR_MIN_SIZE:
+        target = numpy.frombuffer(accumulator, dtype=numpy.uint8, count=len(block))
+        numpy.bitwise_xor(target, numpy.frombuffer(block, dtype=numpy.uint8), out=target)
+    else:
+        value = int.from_bytes(accumulator, 'little') ^ int.from_bytes(block, 'little')
+        accumulator[:] = value.to_bytes(len(accumulator), 'little')
+    return accumulator
+
+## Returns a new bytearray of the given size with the xor of all blocks, e.g. the parity of a stripe
+
+def xor_many(blocks, size):
+    if numpy is not None and size >= NUMPY_XOR_MIN_SIZE:
+        result = bytearray(size)
+        for block in blocks:
+            xor_into(result, block)
+        return result
+    value = 0
+    for block in blocks:
+        value ^= int.from_bytes(block, 'little')
+    return bytearray(value.to_bytes(size, 'little'))
+
+
 #### BLOCK LAYER
 
+## Raised by writes when a lock of the client was lost (its lease could not be renewed on a majority of the
+## servers): another client may hold it by now, so what the client was doing under the lock is aborted
+
+class LockLost(Exception):
+    pass
+
+
 class DiskBlocks():
-    def __init__(self, server_url_list):
+    def __init__(self, server_url_list, parallel=False, cache_size=0, write_back=False, shared=False,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
         # self.server = xmlrpc.client.ServerProxy(server_url, allow_none=True, use_builtin_types=True)
         # This class connects the servers over rpc and provide blovk layer functionalities
         self.servers = []
 
+        # Servers are reached over XML-RPC (http://host:port) or over the binary block protocol (block://host:port),
+        # through a pool of persistent connections per server that can be used by several threads at once
+        # The pool of a server that stopped answering fails calls at once: reads and writes then skip the server
+        # and work in degraded mode, from and to the rest of the stripe (see ReadPhysicalBlocks)
         for server_url in server_url_list:
-            self.servers.append(xmlrpc.client.ServerProxy(server_url, allow_none=True, use_builtin_types=True))
+            self.servers.append(ServerPool(lambda timeout, url=server_url: self.Connect(url, timeout),
+                                           CONNECTIONS_PER_SERVER, RPC_TIMEOUT, server_url))
+        # A server that missed writes while it was down is not used again before it is rebuilt, see AdmitServer;
+        # missed_writes are the servers this client recorded as such since they went down
+        for server in range(len(self.servers)):
+            self.servers[server].admit = lambda connection, server=server: self.AdmitServer(server, connection)
+        self.missed_writes = set()
+
+        # Heartbeats detect failed servers in the background, and probe them until they are back (0 disables)
+        self.monitor = None
+        if heartbeat_interval > 0:
+            self.monitor = HealthMonitor(self.servers, heartbeat_interval)
+
+        # In parallel mode the calls to different servers are issued at the same time, one thread per server
+        self.executor = None
+        if parallel:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.servers))
+
+        # LRU cache of virtual blocks, holding at most cache_size blocks (0 disables the cache)
+        # In write-back mode Puts only update dirty_blocks; they are written to the servers by Flush()
+        # Cached blocks are only valid while the file system lock is held, see FileName.ACQUIRE/RELEASE
+        self.cache_size = cache_size
+        self.write_back = write_back and cache_size > 0
+        self.cache = collections.OrderedDict()
+        self.dirty_blocks = {}
+
+        # Decoded form of cached blocks (e.g. the inodes of an inode table block), so that a block is decoded
+        # once rather than on every access; entries are dropped when their block is written or the cache invalidated
+        self.decoded_blocks = {}
+
+        # Identifies this client as the owner of the locks it takes from the lock service
+        # held_locks: lock name -> [servers holding it, shared, lease, time of the next renewal, versions], see
+        # AcquireLock. Their leases are renewed by a background thread, started with the first lock and woken up
+        # by new locks; lost_locks are the held locks it could not renew, see CheckLocks
+        # lock_versions: lock name -> versions of the lock when this client last gave it back, see LockChanged
+        # Versions are dictionaries server number -> version on that server
+        self.owner = uuid.uuid4().hex
+        self.held_locks = {}
+        self.lock_versions = {}
+        self.held_locks_mutex = threading.Lock()
+        self.lost_locks = set()
+        self.renewer = None
+        self.renewer_wakeup = threading.Event()
+
+        # shared: other clients use the file system at the same time, so blocks that several clients update
+        # are updated under lock by UpdateBlocks (bitmaps) or a range at a time (inode table), and the LockManager
+        # takes its locks
+        self.shared = shared
+
+    ## Opens a connection to a server
+
+    def Connect(self, server_url, timeout):
+        if server_url.startswith('block://'):
+            client = BlockClient.FromURL(server_url)
+            client.timeout = timeout
+            return client
+        return xmlrpc.client.ServerProxy(server_url, allow_none=True, use_builtin_types=True,
+                                         transport=TimeoutTransport(timeout, use_builtin_types=True))
+
+    ## Returns the health of the connection pool of every server
+
+    def ServerHealth(self):
+        return [server.Health() for server in self.servers]
+
+    ## Calls function(server, argument) for every server in requests, which maps server number to argument
+    ## Returns a dictionary mapping server number to the function result
+
+    def CallServers(self, function, requests):
+        if self.executor is None or len(requests) < 2:
+            return {server: function(server, argument) for server, argument in requests.items()}
+        futures = {server: self.executor.submit(function, server, argument) for server, argument in requests.items()}
+        return {server: future.result() for server, future in futures.items()}
 
 
     # Put: interface to write a raw block of data to the block indexed by physical_block number in server
@@ -108,57 +346,756 @@ class DiskBlocks():
                           + ' physical block number ' + str(physical_block_number) + "error " + str(e))
             return -1
 
-    def Put(self, block_number, block_data):
+    # GetMany/PutMany: read or write a list of physical blocks in server with a single call
+
+    def PutMany_RPC(self, server_number, block_list):
+        logging.debug('PutMany: server_number ' + str(server_number) + ' block numbers ' + str(
+            [block[0] for block in block_list]))
+        try:
+            return self.servers[server_number].PutMany(block_list)
+        except Exception as e:
+            logging.debug('PutMany: server_number ' + str(server_number) + " error " + str(e))
+            return -1
+
+    ## XorMany: XORs a list of (physical block number, delta) pairs into the blocks of server
+    ## Returns the block numbers the server could not update (damaged blocks), or -1 if the call failed
+
+    def XorMany_RPC(self, server_number, block_list):
+        logging.debug('XorMany: server_number ' + str(server_number) + ' block numbers ' + str(
+            [block[0] for block in block_list]))
+        try:
+            return self.servers[server_number].XorMany(block_list)
+        except Exception as e:
+            logging.debug('XorMany: server_number ' + str(server_number) + " error " + str(e))
+            return -1
+
+    ## RepairMany: writes a list of (physical block number, data) pairs rebuilt from their stripe to server, each
+    ## block only if it is still damaged
+    ## Returns the block numbers the server left as they were (no longer damaged), or -1 if the call failed
+
+    def RepairMany_RPC(self, server_number, block_list):
+        logging.debug('RepairMany: server_number ' + str(server_number) + ' block numbers ' + str(
+            [block[0] for block in block_list]))
+        try:
+            return self.servers[server_number].RepairMany(block_list)
+        except Exception as e:
+            logging.debug('RepairMany: server_number ' + str(server_number) + " error " + str(e))
+            return -1
+
+    def GetMany_RPC(self, server_number, physical_block_numbers):
         logging.debug(
-            'Put: block number ' + str(block_number) + ' len ' + str(len(block_data)) + '\n' + str(block_data.hex()))
-        server_block_number = self.virtual_to_physical_block_map(block_number)
-        target_server = server_block_number[0]
-        physical_block_number = server_block_number[1]
-        parity_server = server_block_number[2]
-        get_old_data = self.Get(block_number)
-        get_old_parity = self.Get_RPC(parity_server, physical_block_number)
-
-        # Put new data to the server, might not succeed in server down case but new parity will be saved correctly
-        self.Put_RPC(target_server, physical_block_number, block_data)
-
-        # If old parity is valid, compute new parity in efficient way
-        if get_old_parity != -1:
-            new_parity = self.byte_xor(get_old_parity, get_old_data)
-            new_parity = self.byte_xor(new_parity, block_data)
-            self.Put_RPC(parity_server, physical_block_number, new_parity)
-
-        # If old parity is not available, then compute new parity by calling other servers
-        if get_old_parity == -1:
-            result = block_data
+            'GetMany: server_number ' + str(server_number) + ' physical block numbers ' + str(physical_block_numbers))
+        try:
+            result = []
+            for block_data in self.servers[server_number].GetMany(physical_block_numbers):
+                if block_data != -1:
+                    block_data = bytearray(block_data)
+                result.append(block_data)
+            return result
+        except Exception as e:
+            logging.debug('GetMany: server_number ' + str(server_number) + " error " + str(e))
+            return -1
+
+    ## Reads physical blocks from several servers, one GetMany call per server
+    ## requests maps server number to a list of physical block numbers
+    ## returns a dictionary mapping (server, physical block number) to the block data, or -1 on failure
+    ## Servers that are down are not called: their blocks are -1, to be rebuilt from the rest of their stripe
+
+    def ReadPhysicalBlocks(self, requests):
+        requests = {server: list(dict.fromkeys(physical_block_numbers))
+                    for server, physical_block_numbers in requests.items()}
+        replies = self.CallServers(self.GetMany_RPC, {server: physical_block_numbers
+                                                      for server, physical_block_numbers in requests.items()
+                                                      if self.servers[server].Available()})
+        result = {}
+        for server, physical_block_numbers in requests.items():
+            blocks = replies.get(server, -1)
+            for i in range(0, len(physical_block_numbers)):
+                result[(server, physical_block_numbers[i])] = -1 if blocks == -1 else blocks[i]
+        return result
+
+    ## Writes physical blocks to several servers, one PutMany call per server
+    ## requests maps server number to a list of (physical block number, data) pairs, and xor_requests to a list
+    ## of (physical block number, delta) pairs to XOR into parity blocks, one XorMany call per server
+    ## Returns the physical block numbers whose delta could not be applied
+    ## Servers that are down are skipped: their blocks are kept by the parity of the stripe, written to the others
+    ## A server that missed writes this way must be rebuilt before its blocks are trusted again, see MissedWrites
+
+    def WritePhysicalBlocks(self, requests, xor_requests={}):
+        def Write(server, lists):
+            block_list, delta_list = lists
+            if block_list and self.PutMany_RPC(server, block_list) == -1:
+                return -1
+            return self.XorMany_RPC(server, delta_list) if delta_list else []
+
+        servers = list(dict.fromkeys(list(requests) + list(xor_requests)))
+        replies = self.CallServers(Write, {server: (requests.get(server, []), xor_requests.get(server, []))
+                                           for server in servers if self.servers[server].Available()})
+        missed = [server for server in servers if replies.get(server, -1) == -1]
+        if missed:
+            self.MissedWrites(missed)
+        return [physical_block_number for failed in replies.values() if failed != -1
+                for physical_block_number in failed]
+
+    ## Writes blocks rebuilt from their stripe, one RepairMany call per server: a block is only written if it is
+    ## still damaged, so that the newer data a client wrote to it meanwhile is not overwritten
+    ## requests maps server number to a list of (physical block number, data) pairs
+    ## Returns the physical block numbers that were left as they were, as they are no longer damaged
+    ## Servers that are down are skipped, like by WritePhysicalBlocks: they missed writes
+
+    def RepairPhysicalBlocks(self, requests):
+        replies = self.CallServers(self.RepairMany_RPC, {server: block_list for server, block_list in requests.items()
+                                                         if self.servers[server].Available()})
+        missed = [server for server in requests if replies.get(server, -1) == -1]
+        if missed:
+            self.MissedWrites(missed)
+        return [physical_block_number for undamaged in replies.values() if undamaged != -1
+                for physical_block_number in undamaged]
+
+    ## Records on the other servers that the given servers missed writes, once per outage: their blocks are
+    ## stale until they are rebuilt, see AdmitServer
+
+    def MissedWrites(self, servers):
+        def Count(peer, word):
+            try:
+                value = ''
+                while True:
+                    previous = self.servers[peer].CompareAndSwap(word, value, str(int(value or '0') + 1))
+                    if previous == value:
+                        return True
+                    value = previous
+            except Exception as e:
+                logging.debug('MissedWrites: server_number ' + str(peer) + ' error ' + str(e))
+                return None
+
+        for server in servers:
+            if server in self.missed_writes:
+                continue
+            logging.warning('MissedWrites: server ' + str(server) + ' missed writes, it must be rebuilt')
+            word = MISSED_WRITES_WORD + str(server)
+            self.CallServers(Count, {peer: word for peer in range(len(self.servers))
+                                     if peer != server and self.servers[peer].Available()})
+            self.missed_writes.add(server)
+
+    ## Returns how many outages of server other servers recorded writes missed during, see MissedWrites
+
+    def MissedOutages(self, server):
+        outages = 0
+        for peer in range(len(self.servers)):
+            if peer != server and self.servers[peer].Available():
+                try:
+                    outages = max(outages, int(self.servers[peer].CompareAndSwap(
+                        MISSED_WRITES_WORD + str(server), '', '') or '0'))
+                except Exception as e:
+                    logging.debug('MissedOutages: server_number ' + str(peer) + ' error ' + str(e))
+        return outages
+
+    ## Whether server, which was down, may be used again: not if it missed writes meanwhile, as it would serve
+    ## the old content of the blocks, unless it is being rebuilt (restarted with --rebuilding), which restores
+    ## them. connection is a connection to the server. Called by the ServerPool of the server on a probe
+
+    def AdmitServer(self, server, connection):
+        if connection.RebuildStatus() == -1 and self.MissedOutages(server) > 0:
+            logging.error('AdmitServer: server ' + str(server) + ' missed writes while it was down: restart it '
+                          'with --rebuilding and run memoryfs_rebuild')
+            return False
+        self.missed_writes.discard(server)
+        return True
+
+    ## Rebuilds the content of block (server, physical_block_number) by XORing the other blocks of its stripe
+    ## stripe_blocks maps (server, physical block number) to the blocks already read
+
+    def ReconstructBlock(self, server, physical_block_number, stripe_blocks):
+        peers = []
+        for peer in range(len(self.servers)):
+            if peer != server:
+                peer_data = stripe_blocks[(peer, physical_block_number)]
+                if peer_data == -1:
+                    logging.error('ReconstructBlock: more than one block lost in stripe ' + str(physical_block_number))
+                    return -1
+                peers.append(peer_data)
+        return xor_many(peers, BLOCK_SIZE)
+
+    ## Reads the blocks of every server for the given physical block numbers, except the ones already in known
+
+    def ReadStripes(self, physical_block_numbers, known):
+        requests = {}
+        for physical_block_number in physical_block_numbers:
             for server in range(len(self.servers)):
-                if server != parity_server and server != target_server:
-                    result = self.byte_xor(result, self.Get_RPC(server, physical_block_number))
+                if (server, physical_block_number) not in known:
+                    requests.setdefault(server, []).append(physical_block_number)
+        known.update(self.ReadPhysicalBlocks(requests))
+        return known
+
+    ## Put: interface to write a raw block of data to the block indexed by block number
 
-            self.Put_RPC(parity_server, physical_block_number, result)
+    def Put(self, block_number, block_data):
+        self.PutMany([(block_number, block_data)])
+
+    ## PutMany: writes a list of (block number, data) pairs through the block cache
+
+    def PutMany(self, block_list):
+        if self.cache_size == 0:
+            return self.WriteBlocks(block_list)
+
+        for block_number, block_data in block_list:
+            if len(block_data) > BLOCK_SIZE:
+                logging.error('Put: Block larger than BLOCK_SIZE: ' + str(len(block_data)))
+                quit()
+            self.decoded_blocks.pop(block_number, None)
+            block_data = bytearray(block_data).ljust(BLOCK_SIZE, b'\x00')
+            self.CacheBlock(block_number, block_data)
+            if self.write_back:
+                self.dirty_blocks[block_number] = block_data
+
+        if not self.write_back:
+            return self.WriteBlocks(block_list)
+
+        # Bound the number of dirty blocks by the cache size
+        if len(self.dirty_blocks) >= self.cache_size:
+            self.Flush()
+
+    ## Writes all dirty blocks to the servers in a single batch
+    ## Repeated Puts to a block were already collapsed in dirty_blocks, and WriteBlocks
+    ## updates the parity of each stripe once however many of its blocks are dirty
+
+    def Flush(self):
+        if self.dirty_blocks:
+            logging.debug('Flush: ' + str(list(self.dirty_blocks)))
+            block_list = list(self.dirty_blocks.items())
+            self.dirty_blocks = {}
+            self.WriteBlocks(block_list)
+
+    ## Writes back dirty blocks and drops every cached block
+    ## Must be called when a lock is acquired that other clients changed blocks under, see LockChanged
+
+    def InvalidateCache(self):
+        self.Flush()
+        self.cache.clear()
+        self.decoded_blocks = {}
+
+    ## Returns decode(block) for a block, decoding it only once while the block stays unchanged in the cache
+    ## The decoded object is shared: callers must not modify it
+    ## Returns -1, and caches nothing, if the block cannot be read
+
+    def GetDecoded(self, block_number, decode):
+        if block_number in self.decoded_blocks:
+            return self.decoded_blocks[block_number]
+        block_data = self.Get(block_number)
+        if block_data == -1:
+            return -1
+        if self.cache_size == 0:
+            return decode(block_data)
+        self.decoded_blocks[block_number] = decode(block_data)
+        return self.decoded_blocks[block_number]
+
+    ## Adds a block to the cache, evicting the least recently used block when full
+
+    def CacheBlock(self, block_number, block_data):
+        self.cache[block_number] = block_data
+        self.cache.move_to_end(block_number)
+        while len(self.cache) > self.cache_size:
+            evicted = self.cache.popitem(last=False)[0]
+            # dirty blocks are not lost on eviction: they remain in dirty_blocks until the next Flush
+            logging.debug('CacheBlock: evicted ' + str(evicted))
+
+    ## WriteBlocks: writes a list of (block number, data) pairs to the servers
+    ## Old data of all blocks is read with one GetMany per server, then new data is written with one PutMany per
+    ## server while parity servers XOR the delta old data ^ new data into their parity blocks (XorMany): a small
+    ## write takes 3 calls, and the parity updates of clients writing different blocks of a stripe commute
+    ## Old data that cannot be read (damaged block, server down) is rebuilt from the rest of its stripe for the delta,
+    ## so that degraded writes commute too
+    ## Stripes whose N-1 data blocks are all written skip the reads: parity is computed from the new data
+
+    def WriteBlocks(self, block_list):
+        logging.debug('WriteBlocks: block numbers ' + str([block[0] for block in block_list]))
+        self.CheckLocks()
+
+        # server, physical block number and new data of every block, grouped by stripe
+        stripes = {}
+        for block_number, block_data in block_list:
+            if len(block_data) > BLOCK_SIZE:
+                logging.error('Put: Block larger than BLOCK_SIZE: ' + str(len(block_data)))
+                quit()
+            target_server, physical_block_number, parity_server = self.virtual_to_physical_block_map(block_number)
+            stripe = stripes.setdefault(physical_block_number, {'parity_server': parity_server, 'data': {}})
+            stripe['data'][target_server] = bytearray(block_data).ljust(BLOCK_SIZE, b'\x00')
+
+        write_requests = {}
+        read_requests = {}
+        for physical_block_number in list(stripes):
+            stripe = stripes[physical_block_number]
+            if len(stripe['data']) == len(self.servers) - 1:
+                # Full stripe write: no need for old data or old parity
+                new_parity = xor_many(stripe['data'].values(), BLOCK_SIZE)
+                for server, block_data in stripe['data'].items():
+                    write_requests.setdefault(server, []).append((physical_block_number, block_data))
+                write_requests.setdefault(stripe['parity_server'], []).append((physical_block_number, new_parity))
+                del stripes[physical_block_number]
+            elif not self.servers[stripe['parity_server']].Available():
+                # Parity server down: parity cannot be written, so there is no need to compute it
+                for server, block_data in stripe['data'].items():
+                    write_requests.setdefault(server, []).append((physical_block_number, block_data))
+                del stripes[physical_block_number]
+            else:
+                for server in stripe['data']:
+                    read_requests.setdefault(server, []).append(physical_block_number)
+
+        # Read old data of the partially written stripes
+        old_blocks = self.ReadPhysicalBlocks(read_requests)
+
+        # Stripes with an unreadable block need the rest of the stripe to rebuild it
+        damaged = {physical_block_number for physical_block_number, stripe in stripes.items()
+                   if any(old_blocks[(server, physical_block_number)] == -1 for server in stripe['data'])}
+        if damaged:
+            self.ReadStripes(damaged, old_blocks)
+
+        xor_requests = {}
+        # Stripes whose parity cannot take a delta, as the old data of a block is lost along with another block
+        recompute = []
+        for physical_block_number, stripe in stripes.items():
+            # Put new data to the server, might not succeed in server down case but the parity keeps it
+            for server, block_data in stripe['data'].items():
+                write_requests.setdefault(server, []).append((physical_block_number, block_data))
+
+            delta = bytearray(BLOCK_SIZE)
+            for server, block_data in stripe['data'].items():
+                old_data = old_blocks[(server, physical_block_number)]
+                if old_data == -1:
+                    old_data = self.ReconstructBlock(server, physical_block_number, old_blocks)
+                if old_data == -1:
+                    recompute.append(physical_block_number)
+                    break
+                xor_into(delta, old_data)
+                xor_into(delta, block_data)
+            else:
+                xor_requests.setdefault(stripe['parity_server'], []).append((physical_block_number, delta))
+
+        # Parity blocks that could not take their delta (damaged, or not rebuilt yet) are computed again from
+        # their stripe, now that the new data is written
+        failed = self.WritePhysicalBlocks(write_requests, xor_requests)
+        if failed or recompute:
+            self.WriteParity(failed + recompute)
+
+    ## Brings the parity of the stripes of the given physical block numbers in line with their data
+    ## A damaged parity block is computed from the data of its stripe and written by RepairMany, which leaves it
+    ## alone if it was repaired meanwhile; such a stripe is then done again. A parity block that reads fine gets
+    ## the syndrome of its stripe (the XOR of all its blocks) XORed into it, which commutes with the parity deltas
+    ## of the clients writing the stripe at the same time
+
+    def WriteParity(self, physical_block_numbers):
+        logging.warning('WriteParity: computing parity of stripes ' + str(physical_block_numbers))
+        servers = range(len(self.servers))
+        while physical_block_numbers:
+            stripe_blocks = self.ReadStripes(physical_block_numbers, {})
+            repairs = {}
+            xor_requests = {}
+            for physical_block_number in physical_block_numbers:
+                parity_server = self.ParityServer(physical_block_number)
+                if stripe_blocks[(parity_server, physical_block_number)] == -1:
+                    new_parity = self.ReconstructBlock(parity_server, physical_block_number, stripe_blocks)
+                    if new_parity != -1:
+                        repairs.setdefault(parity_server, []).append((physical_block_number, new_parity))
+                elif all(stripe_blocks[(server, physical_block_number)] != -1 for server in servers):
+                    syndrome = xor_many([stripe_blocks[(server, physical_block_number)] for server in servers],
+                                        BLOCK_SIZE)
+                    if syndrome != bytes(BLOCK_SIZE):
+                        xor_requests.setdefault(parity_server, []).append((physical_block_number, syndrome))
+            physical_block_numbers = self.RepairPhysicalBlocks(repairs) + self.WritePhysicalBlocks({}, xor_requests)
 
     ## Get: interface to read a raw block of data from block indexed by block number
     ## Equivalent to the textbook's BLOCK_NUMBER_TO_BLOCK(b)
 
     def Get(self, block_number):
+        return self.GetMany([block_number])[0]
+
+    ## GetMany: reads a list of blocks through the block cache
+    ## Returns a new bytearray per block, which the caller is free to modify
+
+    def GetMany(self, block_numbers):
+        if self.cache_size == 0:
+            return self.ReadBlocks(block_numbers)
+
+        result = {}
+        missing = []
+        for block_number in block_numbers:
+            if block_number in self.dirty_blocks:
+                result[block_number] = self.dirty_blocks[block_number]
+            elif block_number in self.cache:
+                self.cache.move_to_end(block_number)
+                result[block_number] = self.cache[block_number]
+            else:
+                missing.append(block_number)
 
-        logging.debug('Get: ' + str(block_number))
-        server_block_number = self.virtual_to_physical_block_map(block_number)
-        target_server = server_block_number[0]
-        physical_block_number = server_block_number[1]
-
-        block_data = self.Get_RPC(target_server, physical_block_number)
+        missing = list(dict.fromkeys(missing))
+        logging.debug('GetMany: cache misses ' + str(missing))
+        for block_number, block_data in zip(missing, self.ReadBlocks(missing)):
+            if block_data != -1:
+                self.CacheBlock(block_number, block_data)
+            result[block_number] = block_data
+
+        return [bytearray(result[block_number]) if result[block_number] != -1 else -1
+                for block_number in block_numbers]
+
+    ## ReadBlocks: reads a list of blocks from the servers with one GetMany call per server
+    ## Blocks that cannot be read are rebuilt by XORing the other blocks of their stripe
+
+    def ReadBlocks(self, block_numbers):
+        logging.debug('ReadBlocks: ' + str(block_numbers))
+
+        locations = []
+        read_requests = {}
+        for block_number in block_numbers:
+            target_server, physical_block_number, parity_server = self.virtual_to_physical_block_map(block_number)
+            locations.append((target_server, physical_block_number))
+            read_requests.setdefault(target_server, []).append(physical_block_number)
+            if not self.servers[target_server].Available():
+                # degraded read: the block is rebuilt from the rest of its stripe, read in the same batch
+                for server in range(len(self.servers)):
+                    if server != target_server:
+                        read_requests.setdefault(server, []).append(physical_block_number)
+
+        blocks = self.ReadPhysicalBlocks(read_requests)
+
+        damaged = [location[1] for location in locations if blocks[location] == -1]
+        if damaged:
+            self.ReadStripes(damaged, blocks)
+
+        result = []
+        for target_server, physical_block_number in locations:
+            block_data = blocks[(target_server, physical_block_number)]
+            if block_data == -1:
+                block_data = self.ReconstructBlock(target_server, physical_block_number, blocks)
+            else:
+                # each caller gets its own copy, since callers update blocks in place
+                block_data = bytearray(block_data)
+            result.append(block_data)
+        return result
 
+    ## GetRange: reads length Bytes at offset of a block, from the cache or else from the server of the block,
+    ## which only sends the range
+
+    def GetRange(self, block_number, offset, length):
+        if block_number in self.dirty_blocks or block_number in self.cache:
+            return bytearray(self.GetMany([block_number])[0][offset:offset + length])
+        target_server, physical_block_number, parity_server = self.virtual_to_physical_block_map(block_number)
+        block_data = -1
+        if self.servers[target_server].Available():
+            try:
+                block_data = self.servers[target_server].GetRange(physical_block_number, offset, length)
+            except Exception as e:
+                logging.debug('GetRange: server_number ' + str(target_server) + " error " + str(e))
         if block_data == -1:
-            block_data = bytearray(BLOCK_SIZE)
-            for server in range(len(self.servers)):
-                if server != target_server:
-                    block_data = self.byte_xor(block_data, self.Get_RPC(server, physical_block_number))
+            # damaged block or server down: rebuild the whole block from its stripe
+            block_data = self.ReadBlocks([block_number])[0]
+            if block_data == -1:
+                logging.error('GetRange: block ' + str(block_number) + ' cannot be read or rebuilt')
+                return -1
+            return block_data[offset:offset + length]
+        return bytearray(block_data)
+
+    ## PutRange: writes data at offset of a block, leaving the rest of the block as it is
+    ## In write-back mode, unless the file system is shared, the range is written to the cached block like by Put.
+    ## Otherwise only the range travels: the server of the block writes it atomically and returns its old content,
+    ## then the parity server XORs the delta of the range into the parity; so clients sharing the file system can
+    ## update different ranges of a block (e.g. the inodes of an inode table block) without locking it
+    ## Returns 0, or -1 if the block is damaged and cannot be rebuilt from its stripe (then nothing is written)
+
+    def PutRange(self, block_number, offset, data):
+        logging.debug('PutRange: ' + str(block_number) + ' offset ' + str(offset) + ' length ' + str(len(data)))
+        if offset + len(data) > BLOCK_SIZE:
+            logging.error('PutRange: range larger than BLOCK_SIZE: ' + str(offset + len(data)))
+            quit()
+        if self.write_back and not self.shared:
+            block_data = self.GetMany([block_number])[0]
+            if block_data == -1:
+                logging.error('PutRange: block ' + str(block_number) + ' cannot be read or rebuilt')
+                return -1
+            block_data[offset:offset + len(data)] = data
+            self.PutMany([(block_number, block_data)])
+            return 0
 
-        return block_data
+        if self.WriteRange(block_number, offset, data) == -1:
+            return -1
+        # keep the cached copy of the block, and the dirty one flushed later, in line with the servers
+        for blocks in (self.dirty_blocks, self.cache):
+            if block_number in blocks:
+                blocks[block_number][offset:offset + len(data)] = data
+        self.decoded_blocks.pop(block_number, None)
+        return 0
+
+    ## Writes a range of a block to its server and the delta to its parity server
+    ## When the block cannot be updated in place (server down, damaged block) the old range is rebuilt from the
+    ## stripe, and the block written whole by RepairMany, unless a client wrote it meanwhile (then the range is
+    ## written in place after all). Either way the parity server only takes the delta of the range, so that
+    ## clients updating different ranges of the block at the same time do not undo each other's writes
+    ## Returns 0, or -1 if the block is damaged and cannot be rebuilt
+
+    def WriteRange(self, block_number, offset, data):
+        self.CheckLocks()
+        target_server, physical_block_number, parity_server = self.virtual_to_physical_block_map(block_number)
+        while True:
+            old_data = -1
+            if self.servers[target_server].Available():
+                try:
+                    old_data = self.servers[target_server].PutRange(physical_block_number, offset, data)
+                except Exception as e:
+                    logging.debug('PutRange: server_number ' + str(target_server) + " error " + str(e))
+            if old_data != -1:
+                break
+            block_data = self.ReadBlocks([block_number])[0]
+            if block_data == -1:
+                logging.error('PutRange: block ' + str(block_number) + ' cannot be read or rebuilt')
+                return -1
+            old_data = block_data[offset:offset + len(data)]
+            block_data[offset:offset + len(data)] = data
+            if not self.RepairPhysicalBlocks({target_server: [(physical_block_number, block_data)]}):
+                break
+
+        if self.servers[parity_server].Available():
+            try:
+                if self.servers[parity_server].XorRange(physical_block_number, offset, xor_blocks(old_data, data)) == -1:
+                    self.WriteParity([physical_block_number])
+                return 0
+            except Exception as e:
+                logging.debug('XorRange: server_number ' + str(parity_server) + " error " + str(e))
+        self.MissedWrites([parity_server])
+        return 0
+
+    ## ReadSetBlock: atomically sets a block on its server and returns the previous content
+    ## Used for the file system lock, so it bypasses the block cache
 
     def ReadSetBlock(self, block_number, data):
         logging.debug('ReadSetBlock: ' + str(block_number))
-        return bytearray(self.server.ReadSetBlock(block_number, data))
+        target_server, physical_block_number, parity_server = self.virtual_to_physical_block_map(block_number)
+        self.cache.pop(block_number, None)
+        self.decoded_blocks.pop(block_number, None)
+        return bytearray(self.servers[target_server].ReadSetBlock(physical_block_number, data))
+
+    ## Lock service: a lock is held on a majority of the servers (LockQuorum), so that it survives the failure or
+    ## the restart (which loses its locks) of any one server. It is taken on every server that is up, in server
+    ## order: clients that see the same servers block each other on the first one, and since any two majorities
+    ## share a server, a client that sees fewer servers cannot take a lock held by another client either
+    ## Lock words (CompareAndSwap) are not replicated: each lives on one server, chosen from a hash of its name
+
+    def LockServer(self, name):
+        return zlib.crc32(name.encode()) % len(self.servers)
+
+    def LockQuorum(self):
+        return len(self.servers) // 2 + 1
+
+    ## Calls a method of the lock service on several servers at once
+    ## Returns a dictionary mapping server number to the result, without the servers the call failed on
+
+    def CallLockServers(self, servers, method, *args):
+        def Call(server, unused):
+            try:
+                return [getattr(self.servers[server], method)(*args)]
+            except Exception as e:
+                logging.debug(method + ': server_number ' + str(server) + ' error ' + str(e))
+                return None
+
+        results = self.CallServers(Call, {server: None for server in servers})
+        return {server: result[0] for server, result in results.items() if result is not None}
+
+    ## AcquireLock: blocks until this client holds lock name, or until timeout seconds passed (None waits forever)
+    ## Returns True if the lock was acquired. A free lock takes a single call to every server at once; otherwise
+    ## the lock is waited for server after server, on the server, in calls of at most LOCK_WAIT seconds
+    ## Shared locks can be held by several clients at once
+    ## Raises ServerUnavailable if fewer than LockQuorum() servers are up
+
+    def AcquireLock(self, name, shared=False, lease=LOCK_LEASE, timeout=None):
+        logging.debug('AcquireLock: ' + name + (' shared' if shared else ''))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # servers holding the lock already, when taking a lock this client holds (which renews it)
+        previous = self.held_locks[name][0] if name in self.held_locks else []
+
+        replicas = []
+        if not previous:
+            # granted by every server that is up, without waiting: the lock is free
+            up = [server for server in range(len(self.servers)) if self.servers[server].Available()]
+            granted = self.CallLockServers(up, 'Acquire', name, self.owner, lease, 0, shared)
+            replicas = [server for server in up if granted.get(server)]
+            if len(replicas) == len(up) and len(replicas) >= self.LockQuorum():
+                self.HoldLock(name, replicas, shared, lease, {server: granted[server] for server in replicas})
+                return True
+            self.CallLockServers(replicas, 'Release', name, self.owner)
+            replicas = []
+
+        versions = {}
+
+        for server in range(len(self.servers)):
+            while self.servers[server].Available():
+                wait = LOCK_WAIT
+                if deadline is not None:
+                    wait = max(0, min(wait, deadline - time.monotonic()))
+                try:
+                    granted = self.servers[server].Acquire(name, self.owner, lease, wait, shared)
+                except Exception as e:
+                    logging.warning('AcquireLock: ' + name + ' on server ' + str(server) + ' failed: ' + str(e))
+                    break
+                if granted:
+                    replicas.append(server)
+                    versions[server] = granted
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.CallLockServers([server for server in replicas if server not in previous], 'Release',
+                                         name, self.owner)
+                    return False
+
+        if len(replicas) < self.LockQuorum():
+            self.CallLockServers([server for server in replicas if server not in previous], 'Release',
+                                 name, self.owner)
+            raise ServerUnavailable('lock ' + name + ': ' + str(len(replicas)) + ' of ' + str(len(self.servers))
+                                    + ' servers up, ' + str(self.LockQuorum()) + ' needed')
+        self.HoldLock(name, replicas, shared, lease, versions)
+        return True
+
+    ## Records a lock taken on the given servers, and has its lease renewed
+
+    def HoldLock(self, name, replicas, shared, lease, versions):
+        with self.held_locks_mutex:
+            self.held_locks[name] = [replicas, shared, lease, time.monotonic() + lease / LOCK_RENEWALS, versions]
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self.RenewLocks, daemon=True)
+                self.renewer.start()
+        self.renewer_wakeup.set()
+
+    ## ReleaseLock: returns False if this client no longer held the lock on a majority of the servers, e.g.
+    ## because its lease expired
+
+    def ReleaseLock(self, name):
+        logging.debug('ReleaseLock: ' + name)
+        with self.held_locks_mutex:
+            replicas = self.held_locks.pop(name, [range(len(self.servers))])[0]
+            lost = name in self.lost_locks
+            self.lost_locks.discard(name)
+        released = self.CallLockServers(replicas, 'Release', name, self.owner)
+        if lost or sum(1 for result in released.values() if result) < self.LockQuorum():
+            self.lock_versions.pop(name, None)
+            return False
+        self.lock_versions[name] = {server: version for server, version in released.items() if version}
+        return True
+
+    ## HoldsLock: whether this client still holds lock name: it took the lock, and renewed its lease in time
+
+    def HoldsLock(self, name):
+        with self.held_locks_mutex:
+            held = self.held_locks.get(name)
+            if held is None or name in self.lost_locks:
+                return False
+            # time of the last renewal, plus the lease
+            return held[3] - held[2] / LOCK_RENEWALS + held[2] > time.monotonic()
+
+    ## LockChanged: whether another client may have changed what lock name protects since this client last gave
+    ## it back, so that what this client cached under the lock must be dropped. Called once the lock is held again
+    ## Any two majorities share a server, so an exclusive owner in between changed the version on one of the
+    ## servers that granted the lock; a server this client has no version of (e.g. it was down) counts as changed
+
+    def LockChanged(self, name):
+        with self.held_locks_mutex:
+            held = self.held_locks.get(name)
+        last = self.lock_versions.get(name, {})
+        return held is None or any(last.get(server) != version for server, version in held[4].items())
+
+    ## RenewLock: extends the lease of a held lock; returns False if this client no longer held it on a majority
+    ## of the servers. The lock is taken again on the servers that are up and lost it (restarted) or did not hold
+    ## it (were down when it was taken), so that it keeps a majority through the next failure
+
+    def RenewLock(self, name, lease=LOCK_LEASE):
+        with self.held_locks_mutex:
+            held = self.held_locks.get(name)
+        renewed = self.CallLockServers(range(len(self.servers)) if held is None else held[0], 'Renew', name,
+                                       self.owner, lease)
+        replicas = [server for server, result in renewed.items() if result]
+        if len(replicas) < self.LockQuorum():
+            return False
+        if held is not None:
+            missing = [server for server in range(len(self.servers))
+                       if server not in replicas and self.servers[server].Available()]
+            granted = self.CallLockServers(missing, 'Acquire', name, self.owner, lease, 0, held[1])
+            with self.held_locks_mutex:
+                if self.held_locks.get(name) is held:
+                    held[0] = sorted(replicas + [server for server, result in granted.items() if result])
+        return True
+
+    ## Background thread renewing the lease of every held lock LOCK_RENEWALS times per lease
+    ## A lock that cannot be renewed is lost: it is added to lost_locks, see CheckLocks
+
+    def RenewLocks(self):
+        while True:
+            self.renewer_wakeup.clear()
+            with self.held_locks_mutex:
+                now = time.monotonic()
+                held = [(name, self.held_locks[name]) for name in self.held_locks if name not in self.lost_locks]
+            due = [(name, entry) for name, entry in held if entry[3] <= now]
+            if not due:
+                next_renewal = min([entry[3] for name, entry in held] + [now + LOCK_LEASE / LOCK_RENEWALS])
+                self.renewer_wakeup.wait(next_renewal - now)
+                continue
+            for name, entry in due:
+                renewed = self.RenewLock(name, entry[2])
+                with self.held_locks_mutex:
+                    if self.held_locks.get(name) is not entry:
+                        # released meanwhile
+                        continue
+                    if renewed:
+                        entry[3] = time.monotonic() + entry[2] / LOCK_RENEWALS
+                    else:
+                        logging.error('RenewLocks: lock ' + name + ' lost, its lease could not be renewed')
+                        self.lost_locks.add(name)
+
+    ## Raises LockLost if a held lock could not be renewed; the blocks cached and written back under it can no
+    ## longer be trusted, they are dropped. Called before every write to the servers
+
+    def CheckLocks(self):
+        if not self.lost_locks:
+            return
+        self.dirty_blocks = {}
+        self.cache.clear()
+        self.decoded_blocks = {}
+        with self.held_locks_mutex:
+            lost = sorted(self.lost_locks)
+        raise LockLost('locks ' + str(lost) + ' lost: their lease expired')
+
+
+    ## CompareAndSwap: sets lock word name to new if it equals expected, returns the previous value
+
+    def CompareAndSwap(self, name, expected, new):
+        return self.servers[self.LockServer(name)].CompareAndSwap(name, expected, new)
+
+    ## UpdateBlocks: read-modify-write of blocks that several clients update, e.g. bitmaps
+    ## Blocks that are also written with PutRange must not be updated this way, as the whole block is written
+    ## update(blocks) modifies in place the dictionary {block number: data} of the blocks, and its result is returned
+    ## On a shared file system the blocks are locked on the lock service, read from the servers rather than
+    ## from the cache, and written through, so that concurrent updates of different parts of a block are not lost
+
+    def UpdateBlocks(self, block_numbers, update):
+        block_numbers = sorted(set(block_numbers))
+        if not self.shared:
+            blocks = dict(zip(block_numbers, self.GetMany(block_numbers)))
+            result = update(blocks)
+            self.PutMany(list(blocks.items()))
+            return result
+
+        # block locks are always taken last, in increasing block number, so they cannot deadlock
+        lock_names = ['block:' + str(block_number) for block_number in block_numbers]
+        for name in lock_names:
+            self.AcquireLock(name)
+        try:
+            if any(block_number in self.dirty_blocks for block_number in block_numbers):
+                self.Flush()
+            blocks = dict(zip(block_numbers, self.ReadBlocks(block_numbers)))
+            result = update(blocks)
+            self.WriteBlocks(list(blocks.items()))
+            for block_number, block_data in blocks.items():
+                self.decoded_blocks.pop(block_number, None)
+                if self.cache_size > 0:
+                    self.CacheBlock(block_number, bytearray(block_data))
+            return result
+        finally:
+            for name in reversed(lock_names):
+                self.ReleaseLock(name)
 
     ## Serializes and saves block[] data structure to a disk file
     def DumpToDisk(self, prefix):
@@ -180,16 +1117,81 @@ class DiskBlocks():
             self.Put(i, block[i])
         file.close()
 
+    ## Returns [number of blocks, block size] of the first server that answers
+    ## All servers of a file system are expected to have the same geometry
+
+    def ServerGeometry(self):
+        for server in range(len(self.servers)):
+            try:
+                return self.servers[server].Geometry()
+            except Exception as e:
+                logging.debug('ServerGeometry: server_number ' + str(server) + " error " + str(e))
+        logging.error('ServerGeometry: no server available')
+        quit()
+
+    ## Number of virtual blocks the servers can hold: N-1 blocks of data per stripe
+
+    def Capacity(self):
+        return self.ServerGeometry()[0] * (len(self.servers) - 1)
+
+    ## Mounts the file system: reads the superblock and sets the geometry it was formatted with
+    ## Returns 1 if a file system was found, 0 if the servers hold a blank volume that needs InitializeBlocks,
+    ## -1 if they hold something else (another layout version, not a file system): it must not be formatted over
+
+    def Mount(self):
+        # servers that missed writes while they were down must not be used before they are rebuilt
+        for server in range(len(self.servers)):
+            try:
+                admitted = self.AdmitServer(server, self.servers[server])
+            except Exception as e:
+                logging.debug('Mount: server_number ' + str(server) + ' error ' + str(e))
+                continue
+            if not admitted:
+                self.servers[server].MarkDown('missed writes, not rebuilt')
+        server_num_blocks, server_block_size = self.ServerGeometry()
+        # the superblock must be read with the servers' block size, the rest of the geometry is not known yet
+        SetGeometry(TOTAL_NUM_BLOCKS, server_block_size, MAX_NUM_INODES, INODE_SIZE)
+        block = self.Get(1)
+        if block == -1:
+            logging.error('Mount: superblock cannot be read')
+            return -1
+        if not any(block):
+            logging.info('Mount: no file system found')
+            return 0
+        try:
+            superblock = pickle.loads(block)
+        except Exception:
+            superblock = None
+        if not isinstance(superblock, list) or len(superblock) not in (4, 5):
+            logging.error('Mount: block 1 is not a superblock')
+            return -1
+        if len(superblock) == 4 or superblock[4] != FORMAT_VERSION:
+            logging.error('Mount: layout version ' + (str(superblock[4]) if len(superblock) == 5 else 'unknown')
+                          + ' does not match version ' + str(FORMAT_VERSION))
+            return -1
+        if superblock[1] != server_block_size:
+            logging.error('Mount: superblock block size ' + str(superblock[1]) + ' does not match servers ' + str(
+                server_block_size))
+            quit()
+        SetGeometry(superblock[0], superblock[1], superblock[2], superblock[3])
+        logging.info('Mount: file system geometry ' + str(superblock))
+        return 1
+
     ## Initialize blocks, either from a clean slate (cleanslate == True), or from a pickled dump file with prefix
 
     def InitializeBlocks(self, cleanslate, prefix):
         if cleanslate:
+            if TOTAL_NUM_BLOCKS > self.Capacity():
+                logging.error('InitializeBlocks: ' + str(TOTAL_NUM_BLOCKS) + ' blocks exceed servers capacity ' + str(
+                    self.Capacity()))
+                quit()
+
             # Block 0: No real boot code here, just write the given prefix
             self.Put(0, prefix)
 
             # Block 1: Superblock contains basic file system constants
             # First, we write it as a list
-            superblock = [TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE]
+            superblock = [TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE, FORMAT_VERSION]
             # Now we serialize it into a byte array
             self.Put(1, pickle.dumps(superblock))
 
@@ -214,12 +1216,16 @@ class DiskBlocks():
         logging.info('inodes per block          : ' + str(INODES_PER_BLOCK))
         logging.info('Free bitmap offset        : ' + str(FREEBITMAP_BLOCK_OFFSET))
         logging.info('Free bitmap size (blocks) : ' + str(FREEBITMAP_NUM_BLOCKS))
+        logging.info('Inode bitmap offset       : ' + str(INODEBITMAP_BLOCK_OFFSET))
+        logging.info('Inode bitmap size (blocks): ' + str(INODEBITMAP_NUM_BLOCKS))
         logging.info('Inode table offset        : ' + str(INODE_BLOCK_OFFSET))
         logging.info('Inode table size (blocks) : ' + str(INODE_NUM_BLOCKS))
-        logging.info('Max blocks per file       : ' + str(MAX_INODE_BLOCK_NUMBERS))
+        logging.info('Direct blocks per inode   : ' + str(NUM_DIRECT_BLOCK_NUMBERS))
+        logging.info('Indirect levels per inode : ' + str(NUM_INDIRECT_BLOCK_NUMBERS))
+        logging.info('Max blocks per file       : ' + str(MAX_FILE_BLOCKS))
         logging.info('Data blocks offset        : ' + str(DATA_BLOCKS_OFFSET))
         logging.info('Data block size (blocks)  : ' + str(DATA_NUM_BLOCKS))
-        logging.info('Raw block layer layout: (B: boot, S: superblock, F: free bitmap, I: inode, D: data')
+        logging.info('Raw block layer layout: (B: boot, S: superblock, F: free bitmap, N: inode bitmap, I: inode, D: data')
         Layout = "BS"
         Id = "01"
         IdCount = 2
@@ -227,6 +1233,10 @@ class DiskBlocks():
             Layout += "F"
             Id += str(IdCount)
             IdCount = (IdCount + 1) % 10
+        for i in range(0, INODEBITMAP_NUM_BLOCKS):
+            Layout += "N"
+            Id += str(IdCount)
+            IdCount = (IdCount + 1) % 10
         for i in range(0, INODE_NUM_BLOCKS):
             Layout += "I"
             Id += str(IdCount)
@@ -243,7 +1253,13 @@ class DiskBlocks():
     def PrintBlocks(self, tag, min, max):
         logging.info('#### Raw disk blocks: ' + tag)
         for i in range(min, max):
-            logging.info('Block [' + str(i) + '] : ' + str((self.Get(i)).hex()))
+            block_data = self.Get(i)
+            logging.info('Block [' + str(i) + '] : ' + (block_data.hex() if block_data != -1 else 'unreadable'))
+
+    ## Returns the server holding the parity of the stripe of physical_block_number
+
+    def ParityServer(self, physical_block_number):
+        return len(self.servers) - 1 - (physical_block_number % len(self.servers))
 
     # return array containing the target server, pysical block number and the parity server
     def virtual_to_physical_block_map(self, block_number):
@@ -251,7 +1267,7 @@ class DiskBlocks():
         total_server = len(self.servers)
         physical_block_number = block_number // (total_server - 1)
         server = block_number % (total_server - 1)
-        parity_server = total_server - 1 - (physical_block_number % total_server)
+        parity_server = self.ParityServer(physical_block_number)
 
         if parity_server <= server:
             server = server + 1
@@ -262,15 +1278,9 @@ class DiskBlocks():
 
         return server_block_number
 
-    # return bytearray containing the xor of two byte arrays
+    # return bytearray containing the xor of two byte arrays, padded to BLOCK_SIZE
     def byte_xor(self, b1, b2):
-        result = bytearray()
-        b1 = b1.ljust(BLOCK_SIZE, b'\x00')
-        b2 = b2.ljust(BLOCK_SIZE, b'\x00')
-        # for b1, b2 in zip(b1, b2):
-        for i in range(0, len(b1)):
-            result.append(b1[i] ^ b2[i])
-        return result
+        return xor_blocks(b1, b2).ljust(BLOCK_SIZE, b'\x00')
 
 
 #### INODE LAYER
@@ -358,6 +1368,14 @@ class Inode():
         # Return the byte array
         return temparray
 
+    ## Copies the values of another Inode object into this one
+
+    def CopyFrom(self, other):
+        self.size = other.size
+        self.type = other.type
+        self.refcnt = other.refcnt
+        self.block_numbers = list(other.block_numbers)
+
     ## Prints out this inode object's information to the log
 
     def Print(self):
@@ -372,6 +1390,17 @@ class Inode():
         logging.info(s)
 
 
+## Decodes all the inodes stored in an inode table block, returns a list of Inode objects
+
+def BlockToInodes(block):
+    inodes = []
+    for start in range(0, BLOCK_SIZE, INODE_SIZE):
+        inode = Inode()
+        inode.InodeFromBytearray(block[start:start + INODE_SIZE])
+        inodes.append(inode)
+    return inodes
+
+
 #### Inode number layer
 
 
@@ -389,8 +1418,16 @@ class InodeNumber():
         # Raw block storage
         self.RawBlocks = RawBlocks
 
+        # Resolved map of this inode: block index -> data block number, so that translating an offset
+        # through indirect blocks does not go to the servers again while this object is alive
+        self.block_map = {}
+
+        # Whether the inode is marked used in the inode bitmap, as far as this object knows (None: not loaded)
+        self.stored_valid = None
+
     ## Load inode data structure from raw storage, indexed by inode number
     ## The inode data structure loaded from raw storage goes in the self.inode object
+    ## Returns -1, leaving self.inode unchanged, if the inode block cannot be read
 
     def InodeNumberToInode(self):
         logging.debug('InodeNumberToInode: ' + str(self.inode_number))
@@ -398,25 +1435,23 @@ class InodeNumber():
         # locate which block has the inode we want
         raw_block_number = INODE_BLOCK_OFFSET + ((self.inode_number * INODE_SIZE) // BLOCK_SIZE)
 
-        # Get the entire block containing inode from raw storage
-        tempblock = self.RawBlocks.Get(raw_block_number)
-
-        # Find the slice of the block for this inode_number
-        start = (self.inode_number * INODE_SIZE) % BLOCK_SIZE
-        end = start + INODE_SIZE
-
-        # extract byte array for this inode
-        tempinode = tempblock[start:end]
+        # Get all the inodes of the block containing inode, decoded once per block by the block layer
+        inodes = self.RawBlocks.GetDecoded(raw_block_number, BlockToInodes)
+        if inodes == -1:
+            logging.error('InodeNumberToInode: inode block ' + str(raw_block_number) + ' cannot be read')
+            return -1
 
-        # load inode from byte array
-        self.inode.InodeFromBytearray(tempinode)
+        # load inode from the decoded block
+        self.inode.CopyFrom(inodes[self.inode_number % INODES_PER_BLOCK])
+        self.block_map = {}
+        self.stored_valid = self.inode.type != INODE_TYPE_INVALID
 
         logging.debug('InodeNumberToInode : inode_number ' + str(self.inode_number) + ' raw_block_number: ' + str(
-            raw_block_number) + ' slice start: ' + str(start) + ' end: ' + str(end))
-        logging.debug('tempinode: ' + str(tempinode.hex()))
+            raw_block_number))
 
     ## Stores (Put) this inode into raw storage
-    ## Since an inode is a slice of a block, we first Get() the block, update the slice, and Put()
+    ## Since an inode is a slice of a block shared with other inodes, only its slice is written (PutRange);
+    ## the inode bitmap block is updated with UpdateBlocks when the inode becomes valid or invalid
 
     def StoreInode(self):
         logging.debug('StoreInode: ' + str(self.inode_number))
@@ -425,10 +1460,6 @@ class InodeNumber():
         raw_block_number = INODE_BLOCK_OFFSET + ((self.inode_number * INODE_SIZE) // BLOCK_SIZE)
         logging.debug('StoreInode: raw_block_number ' + str(raw_block_number))
 
-        # Get the entire block containing inode from raw storage
-        tempblock = self.RawBlocks.Get(raw_block_number)
-        logging.debug('StoreInode: tempblock:\n' + str(tempblock.hex()))
-
         # Find the slice of the block for this inode_number
         start = (self.inode_number * INODE_SIZE) % BLOCK_SIZE
         end = start + INODE_SIZE
@@ -437,12 +1468,30 @@ class InodeNumber():
         # serialize inode into byte array
         inode_bytearray = self.inode.InodeToBytearray()
 
-        # Update slice of block with this inode's bytearray
-        tempblock[start:end] = inode_bytearray
-        logging.debug('StoreInode: tempblock:\n' + str(tempblock.hex()))
+        # Keep inode bitmap in sync when the inode becomes valid or invalid
+        valid = self.inode.type != INODE_TYPE_INVALID
+        bitmap_block_number = None
+        if valid != self.stored_valid:
+            bitmap_block_number = INODEBITMAP_BLOCK_OFFSET + self.inode_number // FREEBITMAP_BITS_PER_BLOCK
+        bit = self.inode_number % FREEBITMAP_BITS_PER_BLOCK
+
+        # Only the bytes of this inode are written: clients sharing the volume write the other inodes of the
+        # block at the same time, without locking it, so the block is never written whole
+        if self.RawBlocks.PutRange(raw_block_number, start, inode_bytearray) == -1:
+            logging.error('StoreInode: inode ' + str(self.inode_number) + ' could not be written')
+            return -1
+        if bitmap_block_number is None:
+            return
+
+        def Update(blocks):
+            if valid:
+                blocks[bitmap_block_number][bit // 8] |= 1 << (bit % 8)
+            else:
+                blocks[bitmap_block_number][bit // 8] &= ~(1 << (bit % 8))
 
-        # Update raw storage with new inode
-        self.RawBlocks.Put(raw_block_number, tempblock)
+        # Update the inode bitmap
+        self.RawBlocks.UpdateBlocks([bitmap_block_number], Update)
+        self.stored_valid = valid
 
     ## Returns a block of data from raw storage, given its offset
     ## Equivalent to textbook's INODE_NUMBER_TO_BLOCK
@@ -451,17 +1500,188 @@ class InodeNumber():
         logging.debug('InodeNumberToBlock: ' + str(offset))
 
         # Load object's inode
-        self.InodeNumberToInode()
+        if self.InodeNumberToInode() == -1:
+            return -1
 
         # Calculate offset
         o = offset // BLOCK_SIZE
 
         # Retrieve block indexed by offset
         # as in the textbook's INDEX_TO_BLOCK_NUMBER
-        b = self.inode.block_numbers[o]
+        b = self.IndexToBlockNumber(o)
+        if b == -1:
+            return -1
         block = self.RawBlocks.Get(b)
         return block
 
+    ## Returns the path to a block index: the entry in the inode's block_numbers[],
+    ## followed by the entry in each level of indirect block
+
+    def IndexToPath(self, index):
+        if index >= MAX_FILE_BLOCKS:
+            logging.error('IndexToPath: block index exceeds maximum file blocks: ' + str(index))
+            quit()
+        if index < NUM_DIRECT_BLOCK_NUMBERS:
+            return [index]
+        index -= NUM_DIRECT_BLOCK_NUMBERS
+        if index < POINTERS_PER_BLOCK:
+            return [NUM_DIRECT_BLOCK_NUMBERS, index]
+        index -= POINTERS_PER_BLOCK
+        return [NUM_DIRECT_BLOCK_NUMBERS + 1, index // POINTERS_PER_BLOCK, index % POINTERS_PER_BLOCK]
+
+    ## Returns the data block number at a block index, 0 if it is not allocated
+    ## Same as the textbook's INDEX_TO_BLOCK_NUMBER
+
+    def IndexToBlockNumber(self, index):
+        return self.IndexToBlockNumbers([index])[0]
+
+    ## Returns the data block numbers of a list of block indexes, 0 for those not allocated
+    ## and -1 for those behind an indirect block that cannot be read (these are not cached)
+    ## Indirect blocks are read one level at a time, with a single GetMany per level
+
+    def IndexToBlockNumbers(self, indexes):
+        missing = [index for index in dict.fromkeys(indexes) if index not in self.block_map]
+        paths = {index: self.IndexToPath(index) for index in missing}
+        current = {index: self.inode.block_numbers[paths[index][0]] for index in missing}
+
+        level = 1
+        while True:
+            # indexes that still go through an allocated indirect block at this level
+            pending = [index for index in missing if len(paths[index]) > level and current[index] not in (0, -1)]
+            if not pending:
+                break
+            pointer_numbers = list(dict.fromkeys(current[index] for index in pending))
+            pointer_blocks = dict(zip(pointer_numbers, self.RawBlocks.GetMany(pointer_numbers)))
+            for index in pending:
+                if pointer_blocks[current[index]] == -1:
+                    logging.error("IndexToBlockNumbers: indirect block " + str(current[index]) + " cannot be read")
+                    current[index] = -1
+                    continue
+                start = paths[index][level] * 4
+                current[index] = int.from_bytes(pointer_blocks[current[index]][start:start + 4], byteorder='big')
+            level += 1
+
+        self.block_map.update({index: block_number for index, block_number in current.items() if block_number != -1})
+        return [current[index] if index in current else self.block_map[index] for index in indexes]
+
+    ## Sets data block numbers of block indexes, given as a dictionary index -> block number
+    ## Missing indirect blocks are allocated with allocate(), modified indirect blocks are written with one PutMany
+    ## The inode itself is not stored: callers call StoreInode() as with any other inode update
+
+    def SetBlockNumbers(self, block_numbers, allocate):
+        # indirect block number -> block content, written back at the end
+        pointer_blocks = {}
+
+        def LoadPointerBlock(pointer):
+            if pointer not in pointer_blocks:
+                pointer_blocks[pointer] = self.RawBlocks.Get(pointer)
+            return pointer_blocks[pointer]
+
+        def AllocatePointerBlock():
+            pointer = allocate()
+            pointer_blocks[pointer] = bytearray(BLOCK_SIZE)
+            return pointer
+
+        for index, block_number in block_numbers.items():
+            path = self.IndexToPath(index)
+            if len(path) == 1:
+                self.inode.block_numbers[path[0]] = block_number
+            else:
+                pointer = self.inode.block_numbers[path[0]]
+                if pointer == 0:
+                    pointer = AllocatePointerBlock()
+                    self.inode.block_numbers[path[0]] = pointer
+                block = LoadPointerBlock(pointer)
+
+                # walk down the intermediate levels, allocating missing indirect blocks
+                for entry in path[1:-1]:
+                    child = int.from_bytes(block[entry * 4:entry * 4 + 4], byteorder='big')
+                    if child == 0:
+                        child = AllocatePointerBlock()
+                        block[entry * 4:entry * 4 + 4] = child.to_bytes(4, 'big')
+                    pointer = child
+                    block = LoadPointerBlock(pointer)
+
+                block[path[-1] * 4:path[-1] * 4 + 4] = block_number.to_bytes(4, 'big')
+            self.block_map[index] = block_number
+
+        self.RawBlocks.PutMany(list(pointer_blocks.items()))
+
+
+#### Lock manager
+
+## Per-inode reader/writer locks and per-directory locks, taken from the lock service of the servers
+## The data and attributes of a file are protected by the lock of its inode (shared to read, exclusive to write),
+## and the entries of a directory by the lock of the directory (shared to look names up, exclusive to add names)
+## To avoid deadlocks a client takes directory locks before inode locks, each in increasing number, and
+## block locks (see DiskBlocks.UpdateBlocks) last
+## Caches are only trusted while a lock is held: what a lock protects is dropped when the lock is taken from the
+## service and another client held it exclusively since (see DiskBlocks.LockChanged), and dirty blocks are
+## written back before an exclusive lock is given back
+## Locks are counted, so a client can take a lock it already holds; a client that is the only user of the
+## file system (RawBlocks.shared is False) takes no locks at all
+
+class LockManager():
+    def __init__(self, FileObject):
+        self.FileObject = FileObject
+        # lock name -> [number of times taken, True if held shared]
+        self.held = {}
+
+    ## Takes lock name, shared or exclusive, and returns its name for Unlock
+    ## invalidate() drops what the lock protects from the caches, when other clients changed it
+
+    def Lock(self, name, shared=False, invalidate=None):
+        if not self.FileObject.RawBlocks.shared:
+            return name
+        held = self.held.get(name)
+        if held is not None and (shared or not held[1]):
+            held[0] += 1
+            return name
+        if held is not None:
+            # upgrade from shared to exclusive: two clients upgrading a lock they share would each wait for the
+            # other to give it back, so the lock is given back and taken again exclusive (the lock service
+            # refuses to upgrade a lock other owners hold). Another client may have taken it in between
+            self.FileObject.RawBlocks.ReleaseLock(name)
+            self.FileObject.RawBlocks.AcquireLock(name)
+            held[0] += 1
+            held[1] = False
+        else:
+            self.FileObject.RawBlocks.AcquireLock(name, shared)
+            self.held[name] = [1, shared]
+        if self.FileObject.RawBlocks.LockChanged(name):
+            (invalidate or self.FileObject.InvalidateCache)()
+        return name
+
+    def Unlock(self, name):
+        if not self.FileObject.RawBlocks.shared:
+            return
+        held = self.held[name]
+        held[0] -= 1
+        if held[0] > 0:
+            return
+        del self.held[name]
+        try:
+            if not held[1]:
+                # write-back blocks must reach the servers before another client can take the lock; if the lock
+                # was lost, they are dropped and LockLost raised
+                self.FileObject.RawBlocks.Flush()
+        finally:
+            if not self.FileObject.RawBlocks.ReleaseLock(name):
+                logging.warning('Unlock: lease of ' + name + ' expired before it was released')
+
+    ## Whether lock name, taken with Lock, is still held
+
+    def Held(self, name):
+        return not self.FileObject.RawBlocks.shared or self.FileObject.RawBlocks.HoldsLock(name)
+
+    ## The lock of a file protects its inode and blocks, the lock of a directory also its names
+
+    def LockInode(self, inode_number, shared=False):
+        return self.Lock('inode:' + str(inode_number), shared, self.FileObject.RawBlocks.InvalidateCache)
+
+    def LockDirectory(self, dir, shared=False):
+        return self.Lock('dir:' + str(dir), shared, lambda: self.FileObject.InvalidateDirectory(dir))
+
 
 #### File name layer
 
@@ -469,11 +1689,60 @@ class InodeNumber():
 ## This class implements methods for the file name layer
 
 class FileName():
-    def __init__(self, RawBlocks):
+    def __init__(self, RawBlocks, dentry_cache_size=1024):
         self.RawBlocks = RawBlocks
         self.LOCKED = "LOCKED"
         self.UNLOCKED = "UNLOCKED"
 
+        # Fine-grained locks of this client, see LockManager
+        self.locks = LockManager(self)
+
+        # Dentry cache: (directory inode number, file name) -> inode number, or -1 for names known not to exist
+        # LRU with at most dentry_cache_size entries; namespace changes invalidate the entries they affect
+        self.dentry_cache_size = dentry_cache_size
+        self.dentry_cache = collections.OrderedDict()
+
+        # Free space summary, loaded lazily from the free bitmap:
+        # bitmap block index -> [bitmap block content, sorted list of free extents [start, length] it describes]
+        self.free_extents = {}
+
+        # Next-fit cursor: allocation resumes at the block after the last one allocated
+        # It is only a hint, so unlike the summary it is kept when caches are invalidated
+        self.allocation_cursor = 0
+
+        # Directory index: directory inode number -> {padded file name: inode number}
+        # Built from the directory blocks on the first Lookup, kept up to date by InsertFilenameInodeNumber,
+        # and dropped together with the block cache by InvalidateCache()
+        self.directory_index = {}
+
+    ## Drops everything cached from raw storage, writing back dirty blocks first
+    ## Must be called when the file system lock is acquired and changed, as other clients may have changed any block
+
+    def InvalidateCache(self):
+        self.RawBlocks.InvalidateCache()
+        self.directory_index = {}
+        self.dentry_cache.clear()
+        self.free_extents = {}
+
+    ## Drops what is cached of directory dir: its names, and the blocks, which are not tracked by directory
+    ## Must be called when the lock of the directory is acquired and changed
+
+    def InvalidateDirectory(self, dir):
+        self.RawBlocks.InvalidateCache()
+        self.directory_index.pop(dir, None)
+        for entry in [entry for entry in self.dentry_cache if entry[0] == dir]:
+            del self.dentry_cache[entry]
+
+    ## Adds a (dir, filename) -> inode number entry to the dentry cache, evicting the least recently used when full
+
+    def CacheDentry(self, dir, filename, inode_number):
+        if self.dentry_cache_size == 0:
+            return
+        self.dentry_cache[(dir, filename)] = inode_number
+        self.dentry_cache.move_to_end((dir, filename))
+        while len(self.dentry_cache) > self.dentry_cache_size:
+            self.dentry_cache.popitem(last=False)
+
     ## This helper function extracts a file name string from a directory data block
     ## The index selects which file name entry to extract within the block - e.g. index 0 is the first file name, 1 second file name
 
@@ -533,113 +1802,156 @@ class FileName():
                 # Allocate the block
                 new_block = self.AllocateDataBlock()
                 # update inode (it will be written to raw storage before the method returns)
-                insert_to.inode.block_numbers[block_number_index] = new_block
+                insert_to.SetBlockNumbers({block_number_index: new_block}, self.AllocateDataBlock)
 
         # Retrieve the data block where the new (filename,inodenumber) will be stored
-        block_number = insert_to.inode.block_numbers[block_number_index]
-        block = self.RawBlocks.Get(block_number)
+        block_number = insert_to.IndexToBlockNumber(block_number_index)
 
         # Compute module of index to locate entry within block
         index_modulo = index % BLOCK_SIZE
 
-        # Locate the byte slice holding the file name with MAX_FILENAME size
-        string_start = index_modulo
-        string_end = string_start + MAX_FILENAME
-        stringbyte = bytearray(filename, "utf-8")
-
-        # Locate the byte slice holding the inode number with INODE_NUMBER_DIRENTRY_SIZE size
-        inode_start = index_modulo + MAX_FILENAME
-        inode_end = inode_start + INODE_NUMBER_DIRENTRY_SIZE
+        # The entry is the file name with MAX_FILENAME size, followed by the inode number with
+        # INODE_NUMBER_DIRENTRY_SIZE size
+        stringbyte = bytearray(filename, "utf-8")[:MAX_FILENAME].ljust(MAX_FILENAME, b'\x00')
+        entry = stringbyte + inodenumber.to_bytes(INODE_NUMBER_DIRENTRY_SIZE, 'big')
 
-        logging.debug('InsertFilenameInodeNumber: \n' + str(block.hex()))
-        logging.debug('InsertFilenameInodeNumber: inode_start ' + str(inode_start) + ', inode_end ' + str(inode_end))
-        logging.debug(
-            'InsertFilenameInodeNumber: string_start ' + str(string_start) + ', string_end ' + str(string_end))
+        logging.debug('InsertFilenameInodeNumber: block ' + str(block_number) + ', entry at ' + str(index_modulo))
 
-        # Update and write data block with (filename,inode) mapping
-        block[inode_start:inode_end] = inodenumber.to_bytes(INODE_NUMBER_DIRENTRY_SIZE, 'big')
-        block[string_start:string_end] = bytearray(stringbyte.ljust(MAX_FILENAME, b'\x00'))
+        # Write the (filename,inode) mapping into the data block
+        if self.RawBlocks.PutRange(block_number, index_modulo, entry) == -1:
+            logging.error('InsertFilenameInodeNumber: entry of ' + filename + ' could not be written')
+            return -1
 
-        self.RawBlocks.Put(block_number, block)
+        # Keep directory index and dentry cache up to date
+        self.dentry_cache.pop((insert_to.inode_number, filename), None)
+        if insert_to.inode_number in self.directory_index:
+            self.directory_index[insert_to.inode_number].setdefault(bytes(stringbyte), inodenumber)
 
         # Increment size, and write inode
         insert_to.inode.size += FILE_NAME_DIRENTRY_SIZE
         insert_to.StoreInode()
 
-    ## Lookup string filename in the context of inode dir - same as textbook's LOOKUP
+    ## Returns the list of (filename, inodenumber) entries of directory dir, in order, or -1 if dir is not a directory
+    ## filename is the padded MAX_FILENAME bytearray of the entry
+    ## All directory data blocks are read with a single GetMany
 
-    def Lookup(self, filename, dir):
+    def ReadDirectory(self, dir):
 
-        logging.debug('Lookup: ' + str(filename) + ', ' + str(dir))
+        logging.debug('ReadDirectory: ' + str(dir))
 
         # Initialize inode_number object from raw storage
         inode_number = InodeNumber(self.RawBlocks, dir)
         inode_number.InodeNumberToInode()
 
         if inode_number.inode.type != INODE_TYPE_DIR:
-            logging.error("Lookup: not a directory inode: " + str(dir) + " , " + str(inode_number.inode.type))
+            logging.error("ReadDirectory: not a directory inode: " + str(dir) + " , " + str(inode_number.inode.type))
             return -1
 
-        offset = 0
-        scanned = 0
-
-        # Iterate over all data blocks indexed by directory inode, until we reach inode's size
-        while offset < inode_number.inode.size:
-
-            # Retrieve directory data block given current offset
-            b = inode_number.InodeNumberToBlock(offset)
-
-            # A directory data block has multiple (filename,inode) entries
-            # Iterate over file entries to search for matches
-            for i in range(0, FILE_ENTRIES_PER_DATA_BLOCK):
+        num_blocks = -(-inode_number.inode.size // BLOCK_SIZE)
+        block_numbers = inode_number.IndexToBlockNumbers(list(range(0, num_blocks)))
+        blocks = self.RawBlocks.GetMany(block_numbers) if -1 not in block_numbers else [-1]
+        if -1 in blocks:
+            logging.error("ReadDirectory: a block of directory " + str(dir) + " cannot be read")
+            return -1
 
-                # don't search beyond file size
-                if inode_number.inode.size > scanned:
+        entries = []
+        for i in range(0, inode_number.inode.size // FILE_NAME_DIRENTRY_SIZE):
+            b = blocks[i // FILE_ENTRIES_PER_DATA_BLOCK]
+            index = i % FILE_ENTRIES_PER_DATA_BLOCK
+            entries.append((self.HelperGetFilenameString(b, index), self.HelperGetFilenameInodeNumber(b, index)))
+        return entries
+
+    ## Returns the directory index of dir, {padded file name: inode number}, or -1 if dir is not a directory
+
+    def DirectoryIndex(self, dir):
+        if dir not in self.directory_index:
+            entries = self.ReadDirectory(dir)
+            if entries == -1:
+                return -1
+            index = {}
+            for filestring, fileinode in entries:
+                # like a linear scan, the first entry with a given name wins
+                index.setdefault(bytes(filestring), fileinode)
+            self.directory_index[dir] = index
+        return self.directory_index[dir]
 
-                    scanned += FILE_NAME_DIRENTRY_SIZE
+    ## Lookup string filename in the context of inode dir - same as textbook's LOOKUP
+    ## Served from the dentry cache, or else from the directory index, so a lookup in a cached or indexed
+    ## directory costs no block reads
 
-                    # Extract padded MAX_FILENAME string as a bytearray from data block for comparison
-                    filestring = self.HelperGetFilenameString(b, i)
+    def Lookup(self, filename, dir):
 
-                    logging.debug(
-                        "Lookup for " + filename + " in " + str(dir) + ": searching string " + str(filestring))
+        logging.debug('Lookup: ' + str(filename) + ', ' + str(dir))
 
-                    # Pad filename with zeroes and make it a byte array
-                    padded_filename = bytearray(filename, "utf-8")
-                    padded_filename = bytearray(padded_filename.ljust(MAX_FILENAME, b'\x00'))
+        if (dir, filename) in self.dentry_cache:
+            self.dentry_cache.move_to_end((dir, filename))
+            logging.debug("Lookup: dentry cache hit: " + str(self.dentry_cache[(dir, filename)]))
+            return self.dentry_cache[(dir, filename)]
 
-                    # these are now two byte arrays of the same MAX_FILENAME size, ready for comparison
-                    if filestring == padded_filename:
-                        # On a match, retrieve and return inode number
-                        fileinode = self.HelperGetFilenameInodeNumber(b, i)
-                        logging.debug("Lookup successful: " + str(fileinode))
-                        return fileinode
+        index = self.DirectoryIndex(dir)
+        if index == -1:
+            logging.error("Lookup: not a directory inode: " + str(dir))
+            return -1
 
-            # Skip to the next block, back to while loop
-            offset += BLOCK_SIZE
+        # Pad filename with zeroes and make it a byte array, the form it has in directory entries
+        padded_filename = bytearray(filename, "utf-8")
+        padded_filename = bytes(padded_filename.ljust(MAX_FILENAME, b'\x00'))
 
-        logging.debug("Lookup: file not found: " + str(filename) + " in " + str(dir))
-        return -1
+        fileinode = index.get(padded_filename, -1)
+        self.CacheDentry(dir, filename, fileinode)
+        if fileinode == -1:
+            logging.debug("Lookup: file not found: " + str(filename) + " in " + str(dir))
+        else:
+            logging.debug("Lookup successful: " + str(fileinode))
+        return fileinode
 
-    ## Scans inode table to find an available entry
+    ## Scans inode bitmap to find an available entry
 
     def FindAvailableInode(self):
 
         logging.debug('FindAvailableInode: ')
 
-        for i in range(0, MAX_NUM_INODES):
-
-            # Initialize inode_number object from raw storage
-            inode_number = InodeNumber(self.RawBlocks, i)
-            inode_number.InodeNumberToInode()
-
-            if inode_number.inode.type == INODE_TYPE_INVALID:
-                logging.debug("FindAvailableInode: " + str(i))
-                return i
+        blocks = self.RawBlocks.GetMany(
+            [INODEBITMAP_BLOCK_OFFSET + i for i in range(0, INODEBITMAP_NUM_BLOCKS)])
+
+        for i in range(0, INODEBITMAP_NUM_BLOCKS):
+            # index of the first byte with a free inode, i.e. not 0xff
+            byte = len(blocks[i]) - len(blocks[i].lstrip(b'\xff'))
+            if byte < len(blocks[i]):
+                free_bits = blocks[i][byte] ^ 0xff
+                bit = (free_bits & -free_bits).bit_length() - 1
+                inode_number = i * FREEBITMAP_BITS_PER_BLOCK + byte * 8 + bit
+                if inode_number < MAX_NUM_INODES:
+                    logging.debug("FindAvailableInode: " + str(inode_number))
+                    return inode_number
+                break
 
         logging.debug("FindAvailableInode: no available inodes")
         return -1
 
+    ## Claims a free inode in the inode bitmap and returns its number, -1 if none is available
+    ## The bit is set with UpdateBlocks, so that two clients never claim the same inode; the inode itself
+    ## is then written by the caller with StoreInode
+
+    def AllocateInode(self):
+        inode_number = self.FindAvailableInode()
+        while inode_number != -1:
+            bitmap_block_number = INODEBITMAP_BLOCK_OFFSET + inode_number // FREEBITMAP_BITS_PER_BLOCK
+            bit = inode_number % FREEBITMAP_BITS_PER_BLOCK
+
+            def Claim(blocks):
+                if (blocks[bitmap_block_number][bit // 8] >> (bit % 8)) & 1:
+                    return False
+                blocks[bitmap_block_number][bit // 8] |= 1 << (bit % 8)
+                return True
+
+            if self.RawBlocks.UpdateBlocks([bitmap_block_number], Claim):
+                logging.debug('AllocateInode: ' + str(inode_number))
+                return inode_number
+            # another client claimed it first; the bitmap block just read is now in the cache
+            inode_number = self.FindAvailableInode()
+        return -1
+
     ## Returns index to an available entry in directory data block
 
     def FindAvailableFileEntry(self, dir):
@@ -648,7 +1960,8 @@ class FileName():
 
         # Initialize inode_number object from raw storage
         inode_number = InodeNumber(self.RawBlocks, dir)
-        inode_number.InodeNumberToInode()
+        if inode_number.InodeNumberToInode() == -1:
+            return -1
 
         # Check if there is still room for another (filename,inode) entry
         # the inode cannot exceed maximum size
@@ -659,45 +1972,126 @@ class FileName():
         logging.debug("FindAvailableFileEntry: " + str(inode_number.inode.size))
         return inode_number.inode.size
 
-    ## Allocate a data block, update free bitmap, and return its number
-
-    def AllocateDataBlock(self):
-
-        logging.debug('AllocateDataBlock: ')
-
-        # Scan through all available data blocks
-        for block_number in range(DATA_BLOCKS_OFFSET, TOTAL_NUM_BLOCKS):
+    ## Returns the free extents of the data blocks covered by a free bitmap block, loading it if needed
+    ## Bitmap blocks are loaded FREEBITMAP_PREFETCH at a time, with a single GetMany
+    ## The list is owned by the free space summary: allocations update it in place
+
+    def FreeExtents(self, bitmap_index):
+        if bitmap_index not in self.free_extents:
+            prefetch = [i for i in range(bitmap_index, min(bitmap_index + FREEBITMAP_PREFETCH, FREEBITMAP_NUM_BLOCKS))
+                        if i not in self.free_extents]
+            blocks = self.RawBlocks.GetMany([FREEBITMAP_BLOCK_OFFSET + i for i in prefetch])
+            for i, block in zip(prefetch, blocks):
+                self.LoadFreeExtents(i, block)
+        return self.free_extents[bitmap_index][1]
+
+    ## Builds the free extents summary of a free bitmap block
+
+    def LoadFreeExtents(self, bitmap_index, block):
+        base = bitmap_index * FREEBITMAP_BITS_PER_BLOCK
+        extents = []
+        for block_number in range(max(base, DATA_BLOCKS_OFFSET), min(base + FREEBITMAP_BITS_PER_BLOCK,
+                                                                      TOTAL_NUM_BLOCKS)):
+            bit = block_number - base
+            if (block[bit // 8] >> (bit % 8)) & 1 == 0:
+                if extents and extents[-1][0] + extents[-1][1] == block_number:
+                    extents[-1][1] += 1
+                else:
+                    extents.append([block_number, 1])
+        self.free_extents[bitmap_index] = [block, extents]
+
+    ## Allocate count data blocks, update free bitmap, and return their numbers
+    ## Next fit: blocks are taken from the free extents following the cursor, so consecutive allocations
+    ## (and the blocks of a single call) are contiguous whenever the free space allows it
+
+    def AllocateDataBlocks(self, count):
+
+        logging.debug('AllocateDataBlocks: ' + str(count))
+
+        cursor = self.allocation_cursor
+        if cursor < DATA_BLOCKS_OFFSET or cursor >= TOTAL_NUM_BLOCKS:
+            cursor = DATA_BLOCKS_OFFSET
+
+        allocated = []
+
+        # Scan from the cursor to the end of the volume, then wrap around to the data blocks before the cursor
+        for low, high in ((cursor, TOTAL_NUM_BLOCKS), (DATA_BLOCKS_OFFSET, cursor)):
+            bitmap_index = low // FREEBITMAP_BITS_PER_BLOCK
+            while len(allocated) < count and bitmap_index * FREEBITMAP_BITS_PER_BLOCK < high:
+                # The summary tells which bitmap blocks are worth updating; the bitmap block itself is
+                # updated with UpdateBlocks, as other clients may allocate from it at the same time
+                if any(start < high and start + length > low for start, length in self.FreeExtents(bitmap_index)):
+                    bitmap_block_number = FREEBITMAP_BLOCK_OFFSET + bitmap_index
+
+                    def Update(blocks):
+                        return self.AllocateFromBitmap(bitmap_index, blocks[bitmap_block_number], low, high,
+                                                       count - len(allocated))
+
+                    allocated.extend(self.RawBlocks.UpdateBlocks([bitmap_block_number], Update))
+                bitmap_index += 1
+
+        if len(allocated) < count:
+            logging.debug('AllocateDataBlocks: no free data blocks available')
+            quit()
 
-            # GET() raw block that stores the bitmap entry for block_number
-            bitmap_block = FREEBITMAP_BLOCK_OFFSET + (block_number // BLOCK_SIZE)
-            block = self.RawBlocks.Get(bitmap_block)
+        self.allocation_cursor = allocated[-1] + 1
+        logging.debug('AllocateDataBlocks: allocated ' + str(allocated))
+        return allocated
+
+    ## Allocates up to count blocks numbered from low to high - 1 in free bitmap block bitmap_index, whose
+    ## current content is block; marks them used in block and returns their numbers
+    ## The free space summary of the bitmap block is rebuilt first if another client changed it
+
+    def AllocateFromBitmap(self, bitmap_index, block, low, high, count):
+        if self.free_extents[bitmap_index][0] != block:
+            self.LoadFreeExtents(bitmap_index, block)
+        self.free_extents[bitmap_index][0] = block
+        extents = self.free_extents[bitmap_index][1]
+
+        allocated = []
+        i = 0
+        while len(allocated) < count and i < len(extents):
+            start, length = extents[i]
+            first = max(start, low)
+            last = min(start + length, high, first + count - len(allocated))
+            if first >= last:
+                i += 1
+                continue
 
-            # Locate proper byte within the block
-            byte_bitmap = block[block_number % BLOCK_SIZE]
+            # Mark blocks as used in bitmap
+            for block_number in range(first, last):
+                bit = block_number - bitmap_index * FREEBITMAP_BITS_PER_BLOCK
+                block[bit // 8] |= 1 << (bit % 8)
+            allocated.extend(range(first, last))
+
+            # Keep what is left of the extent on each side of the allocated run
+            remaining = []
+            if first > start:
+                remaining.append([start, first - start])
+            if last < start + length:
+                remaining.append([last, start + length - last])
+            extents[i:i + 1] = remaining
+            i += len(remaining)
+        return allocated
 
-            # Data block block_number is free
-            if byte_bitmap == 0:
-                # Mark it as used in bitmap
-                block[block_number % BLOCK_SIZE] = 1
-                self.RawBlocks.Put(bitmap_block, block)
-                logging.debug('AllocateDataBlock: allocated ' + str(block_number))
-                return block_number
+    ## Allocate a data block, update free bitmap, and return its number
 
-        logging.debug('AllocateDataBlock: no free data blocks available')
-        quit()
+    def AllocateDataBlock(self):
+        return self.AllocateDataBlocks(1)[0]
 
     ## Initializes the root inode
 
     def InitRootInode(self):
 
         # Root inode has well-known value 0
+        self.directory_index.pop(0, None)
         root_inode = InodeNumber(self.RawBlocks, 0)
         root_inode.InodeNumberToInode()
         root_inode.inode.type = INODE_TYPE_DIR
         root_inode.inode.size = 0
         root_inode.inode.refcnt = 1
         # Allocate one data block and set as first entry in block_numbers[]
-        root_inode.inode.block_numbers[0] = self.AllocateDataBlock()
+        root_inode.SetBlockNumbers({0: self.AllocateDataBlock()}, self.AllocateDataBlock)
         # Add "."
         self.InsertFilenameInodeNumber(root_inode, ".", 0)
         root_inode.inode.Print()
@@ -717,12 +2111,6 @@ class FileName():
             logging.debug("Create: type not supported")
             return -1
 
-        # Find if there is an available inode
-        inode_position = self.FindAvailableInode()
-        if inode_position == -1:
-            logging.debug("Create: no free inode available")
-            return -1
-
         # Obtain dir_inode_number_inode, ensure it is a directory
         dir_inode = InodeNumber(self.RawBlocks, dir)
         dir_inode.InodeNumberToInode()
@@ -742,6 +2130,12 @@ class FileName():
             logging.debug("Create: name already exists")
             return -1
 
+        # Claim an available inode
+        inode_position = self.AllocateInode()
+        if inode_position == -1:
+            logging.debug("Create: no free inode available")
+            return -1
+
         logging.debug(
             "Create: inode_position: " + str(inode_position) + ", fileentry_position: " + str(fileentry_position))
 
@@ -753,7 +2147,7 @@ class FileName():
             newdir_inode.inode.size = 0
             newdir_inode.inode.refcnt = 1
             # Allocate one data block and set as first entry in block_numbers[]
-            newdir_inode.inode.block_numbers[0] = self.AllocateDataBlock()
+            newdir_inode.SetBlockNumbers({0: self.AllocateDataBlock()}, self.AllocateDataBlock)
             newdir_inode.StoreInode()
 
             # Add to directory (filename,inode) table
@@ -809,6 +2203,11 @@ class FileName():
             logging.debug("Write: not a file")
             return -1
 
+        return self.WriteInode(file_inode, offset, data)
+
+    ## Writes data to the file of a loaded InodeNumber, see Write
+
+    def WriteInode(self, file_inode, offset, data):
         if offset > file_inode.inode.size:
             logging.debug("Write: offset " + str(offset) + " larger than file size " + str(file_inode.inode.size))
             return -1
@@ -821,6 +2220,10 @@ class FileName():
         current_offset = offset
         bytes_written = 0
 
+        # (block index, write_start, write_end, data slice) of every block touched by this write
+        # blocks are collected first so they can be mapped, read and written in batches
+        block_writes = []
+
         # this loop iterates through one or more blocks, ending when all data is written
         while bytes_written < len(data):
 
@@ -851,24 +2254,8 @@ class FileName():
 
             logging.debug('Write: write_start: ' + str(write_start) + ' , write_end: ' + str(write_end))
 
-            # retrieve index of block to be written from inode's list
-            block_number = file_inode.inode.block_numbers[current_block_index]
-
-            # if the block is not allocated, allocate
-            if block_number == 0:
-                new_block = self.AllocateDataBlock()
-                # update inode (it will be written to raw storage before the method returns)
-                file_inode.inode.block_numbers[current_block_index] = new_block
-                block_number = new_block
-
-            # first, we read the whole block from raw storage
-            block = file_inode.RawBlocks.Get(block_number)
-
-            # copy slice of data into the right position in the block
-            block[write_start:write_end] = data[bytes_written:bytes_written + (write_end - write_start)]
-
-            # now write modified block back to disk
-            file_inode.RawBlocks.Put(block_number, block)
+            block_writes.append((current_block_index, write_start, write_end,
+                                 data[bytes_written:bytes_written + (write_end - write_start)]))
 
             # update offset, bytes written
             current_offset += write_end - write_start
@@ -877,8 +2264,41 @@ class FileName():
             logging.debug('Write: current_offset: ' + str(current_offset) + ' , bytes_written: ' + str(
                 bytes_written) + ' , len(data): ' + str(len(data)))
 
-        # Update inode's metadata and write to storage
-        file_inode.inode.size += bytes_written
+        # retrieve numbers of blocks to be written from inode's map
+        block_numbers = file_inode.IndexToBlockNumbers([block_write[0] for block_write in block_writes])
+        if -1 in block_numbers:
+            logging.error("Write: an indirect block cannot be read")
+            return -1
+
+        # if a block is not allocated, allocate; all missing blocks are allocated at once so they are contiguous
+        # (inode will be written to raw storage before the method returns)
+        missing = [i for i in range(0, len(block_writes)) if block_numbers[i] == 0]
+        new_blocks = {}
+        for i, new_block in zip(missing, self.AllocateDataBlocks(len(missing)) if missing else []):
+            block_numbers[i] = new_block
+            new_blocks[block_writes[i][0]] = new_block
+        if new_blocks:
+            file_inode.SetBlockNumbers(new_blocks, self.AllocateDataBlock)
+
+        # existing blocks that are only partially overwritten get their range written (PutRange); the others
+        # are written whole, in one batch
+        block_list = []
+        for i in range(0, len(block_writes)):
+            block_index, write_start, write_end, data_slice = block_writes[i]
+            if (write_start != 0 or write_end != BLOCK_SIZE) and block_index not in new_blocks:
+                if file_inode.RawBlocks.PutRange(block_numbers[i], write_start, data_slice) == -1:
+                    logging.debug('Write: block ' + str(block_numbers[i]) + ' could not be written')
+                    return -1
+            else:
+                block = bytearray(BLOCK_SIZE)
+                block[write_start:write_end] = data_slice
+                block_list.append((block_numbers[i], block))
+
+        # now write the other blocks to disk
+        file_inode.RawBlocks.PutMany(block_list)
+
+        # Update inode's metadata and write to storage; data written over the end of the file extends it
+        file_inode.inode.size = max(file_inode.inode.size, offset + bytes_written)
         file_inode.StoreInode()
 
         return bytes_written
@@ -899,14 +2319,25 @@ class FileName():
             logging.debug("Read: not a file")
             return -1
 
+        return self.ReadInode(file_inode, offset, count)
+
+    ## Reads data from the file of a loaded InodeNumber, see Read
+
+    def ReadInode(self, file_inode, offset, count):
         if offset > file_inode.inode.size:
             logging.debug("Read: offset larger than file size " + str(file_inode.inode.size))
             return -1
 
+        # don't read beyond file size
+        count = min(count, file_inode.inode.size - offset)
+
         # initialize variables used in the while loop
         current_offset = offset
         bytes_read = 0
-        data = []
+        data = bytearray()
+
+        # (block index, read_start, read_end) of every block to be read, mapped and fetched in one batch after the loop
+        block_reads = []
 
         # this loop iterates through one or more blocks, ending when all data is read
         while bytes_read < count:
@@ -938,19 +2369,7 @@ class FileName():
 
             logging.debug('Read: read_start: ' + str(read_start) + ' , read_end: ' + str(read_end))
 
-            # retrieve index of block to be read from inode's list
-            block_number = file_inode.inode.block_numbers[current_block_index]
-
-            # if the block is free, stop reading,
-            if block_number == 0:
-                bytes_read = count
-                continue
-
-            # first, we read the whole block from raw storage
-            block = file_inode.RawBlocks.Get(block_number)
-
-            # read data from the right position in the block
-            data.extend(block[read_start:read_end])
+            block_reads.append((current_block_index, read_start, read_end))
 
             # update offset, bytes read
             current_offset += read_end - read_start
@@ -958,7 +2377,44 @@ class FileName():
 
             logging.debug('Read: current_offset: ' + str(current_offset) + ' , bytes_read: ' + str(
                 bytes_read) + ' , count: ' + str(count))
-        return bytearray(data)
+
+        # retrieve numbers of blocks to be read from inode's map
+        block_numbers = file_inode.IndexToBlockNumbers([block_read[0] for block_read in block_reads])
+
+        # if a block is free, stop reading
+        if 0 in block_numbers:
+            block_numbers = block_numbers[:block_numbers.index(0)]
+
+        # read the whole blocks from raw storage
+        blocks = file_inode.RawBlocks.GetMany(block_numbers) if -1 not in block_numbers else [-1]
+        if -1 in blocks:
+            logging.error("Read: a block cannot be read or rebuilt")
+            return -1
+
+        # read data from the right position in each block
+        for i in range(0, len(blocks)):
+            data += blocks[i][block_reads[i][1]:block_reads[i][2]]
+        return data
+
+    ## Opens a file: mode is 'r' to read, 'r+' to read and write, 'a' to write at the end of the file
+    ## The inode stays locked until the handle is closed, shared in mode 'r' and exclusive otherwise
+    ## returns a FileHandle, or -1 if the inode is not a file
+
+    def Open(self, file_inode_number, mode='r'):
+        if mode not in ('r', 'r+', 'a'):
+            logging.debug("Open: invalid mode " + str(mode))
+            return -1
+
+        lock = self.locks.LockInode(file_inode_number, shared=(mode == 'r'))
+        file_inode = InodeNumber(self.RawBlocks, file_inode_number)
+        file_inode.InodeNumberToInode()
+
+        if file_inode.inode.type != INODE_TYPE_FILE:
+            logging.debug("Open: not a file")
+            self.locks.Unlock(lock)
+            return -1
+
+        return FileHandle(self, file_inode, mode, lock)
 
     ## Recuresively resolve the path
     ## offset must be less than or equal to the file's size
@@ -971,13 +2427,24 @@ class FileName():
             path = path[:-1]
 
         if self.IsPlainName(path):
-            return self.Lookup(path, dir)
+            return self.LockedLookup(path, dir)
         else:
             split_path = path.split("/", 1)
-            dir = self.Lookup(split_path[0], dir)
+            dir = self.LockedLookup(split_path[0], dir)
+            if dir == -1:
+                return -1
             path = split_path[1]
             return self.PathToInodeNumber(path, dir)
 
+    ## Lookup of filename in directory dir, holding the shared lock of the directory
+
+    def LockedLookup(self, filename, dir):
+        lock = self.locks.LockDirectory(dir, shared=True)
+        try:
+            return self.Lookup(filename, dir)
+        finally:
+            self.locks.Unlock(lock)
+
     def IsPlainName(self, path):
         return "/" not in path
 
@@ -998,52 +2465,310 @@ class FileName():
         else:
             return self.PathToInodeNumber(path, cwd)
 
+    ## Creates a hard link name in directory cwd to the file at path target
+    ## The directory lock of cwd and the inode lock of the target are held while the link is added
+
     def Link(self, target, name, cwd):
 
         if len(name) > MAX_FILENAME:
             print("ln: failed to create hard link,'" + name + "' file name exceeds maximum name size")
             return -1
 
-        if self.Lookup(name, cwd) != -1:
-            print("ln: failed to create hard link '" + name + "': already exists")
-            return -1
-
         target_inodenumber = self.GeneralPathToInodeNumber(target, cwd)
 
         if target_inodenumber == -1:
             print("ln: failed to access '" + target + "': No such file or directory")
             return -1
 
-        target_inode = InodeNumber(self.RawBlocks, target_inodenumber)
-        target_inode.InodeNumberToInode()
+        dir_lock = self.locks.LockDirectory(cwd)
+        target_lock = self.locks.LockInode(target_inodenumber)
+        try:
+            if self.Lookup(name, cwd) != -1:
+                print("ln: failed to create hard link '" + name + "': already exists")
+                return -1
 
-        if target_inode.inode.type != INODE_TYPE_FILE:
-            print("ln: failed to create hard link '" + target + "': hard links only allowed for files")
-            return -1
+            target_inode = InodeNumber(self.RawBlocks, target_inodenumber)
+            target_inode.InodeNumberToInode()
 
-        cwd_inode = InodeNumber(self.RawBlocks, cwd)
-        cwd_inode.InodeNumberToInode()
+            if target_inode.inode.type != INODE_TYPE_FILE:
+                print("ln: failed to create hard link '" + target + "': hard links only allowed for files")
+                return -1
 
-        index = cwd_inode.inode.size
+            cwd_inode = InodeNumber(self.RawBlocks, cwd)
+            if cwd_inode.InodeNumberToInode() == -1:
+                print("ln: failed to create hard link '" + name + "': directory cannot be read")
+                return -1
 
-        # check if there is room for entry
-        if index >= MAX_FILE_SIZE:
-            print('ln: failed to create hard link: no space for another entry in inode')
-            return -1
+            index = cwd_inode.inode.size
+
+            # check if there is room for entry
+            if index >= MAX_FILE_SIZE:
+                print('ln: failed to create hard link: no space for another entry in inode')
+                return -1
+
+            self.InsertFilenameInodeNumber(cwd_inode, name, target_inodenumber)
 
-        self.InsertFilenameInodeNumber(cwd_inode, name, target_inodenumber)
+            # increase the reference count
+            target_inode.inode.refcnt += 1
 
-        # increase the reference count
-        target_inode.inode.refcnt += 1
+            # store the updated node in raw storage
+            target_inode.StoreInode()
+        finally:
+            self.locks.Unlock(target_lock)
+            self.locks.Unlock(dir_lock)
 
-        # store the updated node in raw storage
-        target_inode.StoreInode()
+    ## ACQUIRE/RELEASE: file system lock, taken from the lock service of the servers
+    ## Waiting clients sleep on the server until the lock is released or the lease of its owner expires
 
     def ACQUIRE(self):
-        data = bytes(self.LOCKED, 'utf-8')
-        value = self.RawBlocks.ReadSetBlock(0, data)[0:len(self.LOCKED)].decode()
-        while value == self.LOCKED:
-            value = self.RawBlocks.ReadSetBlock(0, data)[0:len(self.LOCKED)].decode()
+        self.RawBlocks.AcquireLock(FILE_SYSTEM_LOCK)
+        # other clients may have changed blocks since we last held the lock
+        if self.RawBlocks.LockChanged(FILE_SYSTEM_LOCK):
+            self.InvalidateCache()
 
     def RELEASE(self):
-        self.RawBlocks.ReadSetBlock(0, bytes(self.UNLOCKED, 'utf-8'))
+        # write-back blocks must reach the servers before another client can take the lock
+        self.RawBlocks.Flush()
+        if not self.RawBlocks.ReleaseLock(FILE_SYSTEM_LOCK):
+            logging.warning('RELEASE: lease of the file system lock expired before it was released')
+
+
+## An open file, see FileName.Open
+## The inode is loaded once and kept while the file is open: the inode lock keeps other clients from changing it.
+## The lock is renewed in the background; writes check that it is still held, as once it is lost another client
+## may have changed the file, and writing the inode kept here would undo its changes
+## Reads that continue where the previous read stopped are sequential: the blocks of the next READAHEAD_STRIPES
+## stripes of the file are then read in the background, so that the next read finds them already fetched
+## Writes are collected in a buffer of contiguous data, written out in whole stripes once it holds
+## WRITE_BUFFER_STRIPES stripes, so that parity is computed from the new data rather than updated block by block;
+## the rest is written by flush(), close(), or a read or write elsewhere in the file
+
+class FileHandle():
+    def __init__(self, FileObject, file_inode, mode, lock):
+        self.FileObject = FileObject
+        self.RawBlocks = FileObject.RawBlocks
+        self.file_inode = file_inode
+        self.mode = mode
+        self.lock = lock
+        self.closed = False
+        self.position = file_inode.inode.size if mode == 'a' else 0
+
+        # Bytes of a stripe, and of the data blocks read ahead and written out at once
+        self.stripe_size = (len(self.RawBlocks.servers) - 1) * BLOCK_SIZE
+        self.readahead_blocks = READAHEAD_STRIPES * (len(self.RawBlocks.servers) - 1)
+        self.write_buffer_size = WRITE_BUFFER_STRIPES * self.stripe_size
+
+        # Buffered writes: write_data goes at write_offset of the file
+        self.write_offset = 0
+        self.write_data = bytearray()
+
+        # Read ahead: block index -> (future of the ReadBlocks of a batch of blocks, position in the batch)
+        # read_end: end of the last read, to tell sequential reads; reading from where the file was opened is too
+        self.readahead = {}
+        self.read_end = self.position
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ## Size of the file, including buffered data
+
+    def Size(self):
+        return max(self.file_inode.inode.size, self.write_offset + len(self.write_data))
+
+    def tell(self):
+        return self.position
+
+    ## Moves to offset, from the start of the file (whence 0), the current position (1) or the end (2)
+    ## returns the new position, or -1 if it would be outside of the file
+
+    def seek(self, offset, whence=0):
+        position = offset + [0, self.position, self.Size()][whence]
+        if position < 0 or position > self.Size():
+            logging.debug("seek: position " + str(position) + " outside of file of size " + str(self.Size()))
+            return -1
+        self.position = position
+        return position
+
+    ## Writes data at the current position, which must be less than or equal to the file's size
+    ## returns number of bytes written (buffered), or -1
+
+    def write(self, data):
+        if self.mode == 'r':
+            logging.debug("write: file not open for writing")
+            return -1
+        if self.mode == 'a':
+            self.position = self.Size()
+        if self.position > self.Size() or self.position + len(data) > MAX_FILE_SIZE:
+            logging.debug("write: position " + str(self.position) + " and len(data) " + str(len(data))
+                          + " outside of file of size " + str(self.Size()))
+            return -1
+
+        # the buffer only holds contiguous data
+        if self.write_data and self.position != self.write_offset + len(self.write_data):
+            if self.flush() == -1:
+                return -1
+        if not self.write_data:
+            self.write_offset = self.position
+        self.write_data += data
+        self.position += len(data)
+        self.DropReadahead()
+
+        # write out the whole stripes of a full buffer, keep the rest for the next writes
+        if len(self.write_data) >= self.write_buffer_size:
+            end = (self.write_offset + len(self.write_data)) // self.stripe_size * self.stripe_size
+            if self.WriteBuffer(end - self.write_offset) == -1:
+                return -1
+        return len(data)
+
+    ## Writes the first length bytes of the write buffer to the file
+    ## returns number of bytes written, or -1
+
+    def WriteBuffer(self, length):
+        if length == 0:
+            return 0
+        if self.CheckLock() == -1:
+            return -1
+        bytes_written = self.FileObject.WriteInode(self.file_inode, self.write_offset, self.write_data[:length])
+        if bytes_written == -1:
+            logging.debug("WriteBuffer: writing " + str(length) + " bytes at " + str(self.write_offset) + " failed")
+            return -1
+        del self.write_data[:length]
+        self.write_offset += length
+        return bytes_written
+
+    ## Writes the buffered data to the file, and write-back blocks to the servers
+    ## returns 0, or -1 if the buffered data could not be written
+
+    def flush(self):
+        if self.WriteBuffer(len(self.write_data)) == -1 or self.CheckLock() == -1:
+            return -1
+        self.RawBlocks.Flush()
+        return 0
+
+    ## Returns 0 if the inode lock is still held, or -1 if it was lost
+
+    def CheckLock(self):
+        if self.FileObject.locks.Held(self.lock):
+            return 0
+        logging.error("FileHandle: lock " + self.lock + " lost, the file may have been changed by another client")
+        return -1
+
+    ## Reads count bytes (all up to the end of the file if count is negative) from the current position
+    ## returns the read bytearray, or -1 if the buffered data could not be written or a block could not be read
+
+    def read(self, count=-1):
+        # buffered data is written first, reads then see it in the blocks
+        if self.write_data and self.flush() == -1:
+            return -1
+
+        offset = self.position
+        size = self.file_inode.inode.size
+        if count < 0 or count > size - offset:
+            count = max(size - offset, 0)
+        if count == 0:
+            return bytearray()
+
+        first_index = offset // BLOCK_SIZE
+        indexes = list(range(first_index, (offset + count - 1) // BLOCK_SIZE + 1))
+
+        # retrieve numbers of blocks to be read from inode's map; if a block is free, stop reading
+        block_numbers = self.file_inode.IndexToBlockNumbers(indexes)
+        if -1 in block_numbers:
+            logging.error("read: an indirect block cannot be read")
+            return -1
+        if 0 in block_numbers:
+            block_numbers = block_numbers[:block_numbers.index(0)]
+            indexes = indexes[:len(block_numbers)]
+
+        # blocks come from the read ahead, unless a newer copy is in the block cache
+        blocks = {}
+        for index, block_number in zip(indexes, block_numbers):
+            prefetched = self.readahead.pop(index, None)
+            if prefetched is not None and block_number not in self.RawBlocks.dirty_blocks \
+                    and block_number not in self.RawBlocks.cache:
+                block_data = prefetched[0].result()[prefetched[1]]
+                if block_data != -1:
+                    blocks[index] = block_data
+        missing = [i for i in range(0, len(indexes)) if indexes[i] not in blocks]
+        for i, block_data in zip(missing, self.RawBlocks.GetMany([block_numbers[i] for i in missing])):
+            if block_data == -1:
+                logging.error("read: block " + str(block_numbers[i]) + " cannot be read or rebuilt")
+                return -1
+            blocks[indexes[i]] = block_data
+
+        data = bytearray(b''.join(memoryview(blocks[index]) for index in indexes))
+        data = data[offset - first_index * BLOCK_SIZE:offset - first_index * BLOCK_SIZE + count]
+
+        if offset == self.read_end:
+            self.ReadAhead(indexes[-1] + 1 if indexes else first_index)
+        self.position += len(data)
+        self.read_end = self.position
+        return data
+
+    ## Reads into buffer (a bytearray or memoryview) from the current position
+    ## returns number of bytes read, or -1
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        if data == -1:
+            return -1
+        buffer[:len(data)] = data
+        return len(data)
+
+    ## Starts reading the blocks of the file from block index first in the background, unless already started
+    ## Blocks read ahead of the previous position are dropped, as the reads have moved past them
+
+    def ReadAhead(self, first):
+        for index in [index for index in self.readahead if index < first]:
+            del self.readahead[index]
+        if first in self.readahead:
+            return
+
+        last = min(first + self.readahead_blocks, -(-self.file_inode.inode.size // BLOCK_SIZE))
+        indexes = [index for index in range(first, last) if index not in self.readahead]
+        block_numbers = self.file_inode.IndexToBlockNumbers(indexes)
+        for stop in (0, -1):
+            if stop in block_numbers:
+                block_numbers = block_numbers[:block_numbers.index(stop)]
+        if not block_numbers:
+            return
+
+        logging.debug('ReadAhead: block indexes ' + str(first) + ' to ' + str(first + len(block_numbers)))
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = self.executor.submit(self.RawBlocks.ReadBlocks, block_numbers)
+        for i in range(0, len(block_numbers)):
+            self.readahead[indexes[i]] = (future, i)
+
+    ## Drops the blocks read ahead, which a write may have made stale
+
+    def DropReadahead(self):
+        for future, i in self.readahead.values():
+            future.cancel()
+        self.readahead = {}
+        self.read_end = None
+
+    ## Writes the buffered data, and unlocks the inode
+    ## returns 0, or -1 if the buffered data could not be written
+
+    def close(self):
+        if self.closed:
+            return 0
+        self.closed = True
+        result = -1
+        try:
+            result = self.flush()
+        finally:
+            self.DropReadahead()
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            try:
+                self.FileObject.locks.Unlock(self.lock)
+            except LockLost as e:
+                logging.error("close: " + str(e))
+                result = -1
+        return result
@@ -0,0 +1,584 @@
+import socket
+import struct
+import json
+import threading
+import concurrent.futures
+import urllib.parse
+import collections
+import time
+import xmlrpc.client
+import logging
+
+## Binary block protocol, an alternative to XML-RPC between DiskBlocks clients and block servers
+## Requests and responses are frames sent over a persistent TCP connection:
+##   header: payload length (4 Bytes), request id (4 Bytes), opcode of a request or status of a response (1 Byte)
+##   payload: raw bytes, block data is never encoded
+## A client may send any number of requests without waiting for their responses (pipelining): each response
+## carries the id of its request, and may come back out of order
+## Server methods that have no opcode of their own (Geometry, the lock service, ...) go through OP_CALL,
+## whose payload is the JSON encoded [method name, [arguments]]
+## OP_XORMANY has the payload of OP_PUTMANY, with deltas to XOR into the blocks instead of their new data, and
+## returns the list of block numbers of a OP_GETMANY request: the blocks that could not be updated
+## OP_REPAIRMANY has the payload of OP_PUTMANY too, and returns the block numbers left as they were because they
+## are no longer damaged
+## OP_GETRANGE, OP_PUTRANGE and OP_XORRANGE address a range of a block: their payload starts with the block number
+## and the offset of the range (BLOCK_RANGE), followed by the length of the range for OP_GETRANGE, and by the data
+## of the range otherwise. OP_GETRANGE and OP_PUTRANGE return the (old) data of the range
+## OP_REBUILDPUT carries the blocks of a server rebuild (see memoryfs_rebuild): the rebuild watermark followed
+## by a OP_PUTMANY payload
+
+FRAME_HEADER = struct.Struct('>IIB')
+
+# Largest payload accepted, in Bytes
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Request opcodes
+OP_GET = 1
+OP_PUT = 2
+OP_READSET = 3
+OP_GETMANY = 4
+OP_PUTMANY = 5
+OP_CALL = 6
+OP_REBUILDPUT = 7
+OP_XORMANY = 8
+OP_GETRANGE = 9
+OP_PUTRANGE = 10
+OP_XORRANGE = 11
+OP_REPAIRMANY = 12
+
+# Response status: for OP_GET and OP_READSET, STATUS_BAD_BLOCK stands for the -1 result of a block that
+# fails its checksum; STATUS_ERROR carries the error message of a failed request
+STATUS_OK = 0
+STATUS_BAD_BLOCK = 1
+STATUS_ERROR = 2
+
+# Block numbers and lengths inside payloads
+BLOCK_NUMBER = struct.Struct('>Q')
+COUNT = struct.Struct('>I')
+ITEM_HEADER = struct.Struct('>BI')
+BLOCK_ITEM = struct.Struct('>QI')
+BLOCK_RANGE = struct.Struct('>QI')
+
+
+# Circuit breaker of a server: after BREAKER_FAILURES failed calls in a row the server is considered down,
+# and calls fail at once without touching it; it is probed again after a backoff, doubled after each failed
+# probe from PROBE_BACKOFF_MIN up to PROBE_BACKOFF_MAX seconds
+BREAKER_FAILURES = 2
+PROBE_BACKOFF_MIN = 0.5
+PROBE_BACKOFF_MAX = 30
+
+# Time allowed to a heartbeat or probe call, in seconds
+HEARTBEAT_TIMEOUT = 1
+
+
+## Raised by a client when the server reports a failed request, like xmlrpc.client.Fault
+
+class BlockProtocolError(Exception):
+    pass
+
+
+## Raised instead of calling a server that is considered down
+
+class ServerUnavailable(ConnectionError):
+    pass
+
+
+## Reads exactly size Bytes from sock; returns None if the connection is closed first
+
+def RecvExactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return buffer
+
+
+## Reads a frame from sock, returns (request id, opcode or status, payload) or None if the connection is closed
+
+def RecvFrame(sock):
+    header = RecvExactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, request_id, code = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise BlockProtocolError('frame of ' + str(length) + ' Bytes exceeds ' + str(MAX_FRAME_SIZE))
+    payload = RecvExactly(sock, length)
+    if payload is None:
+        return None
+    return request_id, code, payload
+
+
+## Sends a frame made of the given payload parts, without joining them (scatter/gather)
+
+def SendFrame(sock, request_id, code, parts):
+    buffers = [memoryview(FRAME_HEADER.pack(sum(len(part) for part in parts), request_id, code))]
+    buffers += [memoryview(part).cast('B') for part in parts if len(part) > 0]
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        # drop what was sent, sendmsg may stop in the middle of a buffer
+        while sent > 0:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+## Encodes a list of [block number, data] pairs as a OP_PUTMANY payload
+
+def EncodeBlockList(block_list):
+    parts = [COUNT.pack(len(block_list))]
+    for block_number, block_data in block_list:
+        parts.append(BLOCK_ITEM.pack(block_number, len(block_data)))
+        parts.append(block_data)
+    return parts
+
+
+## Encodes a list of block numbers, as the payload of a OP_GETMANY request
+
+def EncodeBlockNumbers(block_numbers):
+    return COUNT.pack(len(block_numbers)) + struct.pack('>' + str(len(block_numbers)) + 'Q', *block_numbers)
+
+
+def DecodeBlockNumbers(payload):
+    count, = COUNT.unpack_from(payload, 0)
+    return list(struct.unpack_from('>' + str(count) + 'Q', payload, COUNT.size))
+
+
+## Decodes a OP_PUTMANY payload into a list of [block number, data] pairs
+
+def DecodeBlockList(payload):
+    view = memoryview(payload)
+    count, = COUNT.unpack_from(view, 0)
+    offset = COUNT.size
+    block_list = []
+    for i in range(0, count):
+        block_number, length = BLOCK_ITEM.unpack_from(view, offset)
+        offset += BLOCK_ITEM.size
+        block_list.append([block_number, bytes(view[offset:offset + length])])
+        offset += length
+    return block_list
+
+
+## Encodes the results of GetMany, data or -1 per block, as a OP_GETMANY response payload
+
+def EncodeBlockResults(results):
+    parts = []
+    for block_data in results:
+        if isinstance(block_data, int):
+            parts.append(ITEM_HEADER.pack(STATUS_BAD_BLOCK, 0))
+        else:
+            parts.append(ITEM_HEADER.pack(STATUS_OK, len(block_data)))
+            parts.append(block_data)
+    return parts
+
+
+def DecodeBlockResults(payload):
+    view = memoryview(payload)
+    offset = 0
+    results = []
+    while offset < len(view):
+        status, length = ITEM_HEADER.unpack_from(view, offset)
+        offset += ITEM_HEADER.size
+        if status == STATUS_BAD_BLOCK:
+            results.append(-1)
+        else:
+            results.append(bytearray(view[offset:offset + length]))
+        offset += length
+    return results
+
+
+## Client end of the binary protocol, one persistent connection to a block server
+## It has the methods of the server like a ServerProxy, and unlike a ServerProxy it can be used by several
+## threads at once: their requests are pipelined over the connection and matched to responses by request id
+## Submit() issues a request without waiting and returns a Future
+## The connection is opened on the first request, and opened again after it fails
+## timeout bounds in seconds both connecting and waiting for a response (None waits forever)
+
+class BlockClient():
+    def __init__(self, host, port, timeout=None):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.socket = None
+        # guards socket, next_id and pending, and keeps frames of concurrent requests from interleaving
+        self.lock = threading.Lock()
+        self.next_id = 0
+        # request id -> (Future, function decoding the response payload)
+        self.pending = {}
+
+    ## Returns a BlockClient for a URL of the form block://host:port
+
+    @staticmethod
+    def FromURL(url):
+        parts = urllib.parse.urlsplit(url)
+        return BlockClient(parts.hostname, parts.port)
+
+    def Connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        self.socket = sock
+        threading.Thread(target=self.Receive, args=(sock,), daemon=True).start()
+
+    ## Receives the responses of a connection until it is closed, and completes their Futures
+
+    def Receive(self, sock):
+        error = None
+        try:
+            while True:
+                frame = RecvFrame(sock)
+                if frame is None:
+                    error = ConnectionError('connection to ' + str(self.address) + ' closed')
+                    break
+                request_id, status, payload = frame
+                with self.lock:
+                    future, decode = self.pending.pop(request_id)
+                if status == STATUS_ERROR:
+                    future.set_exception(BlockProtocolError(payload.decode()))
+                elif status == STATUS_BAD_BLOCK:
+                    future.set_result(-1)
+                else:
+                    try:
+                        future.set_result(decode(payload))
+                    except Exception as e:
+                        future.set_exception(e)
+        except Exception as e:
+            error = e
+        self.Disconnect(sock, error)
+
+    ## Closes a connection and fails the requests still waiting for a response on it
+
+    def Disconnect(self, sock, error):
+        logging.debug('BlockClient: ' + str(self.address) + ' disconnected: ' + str(error))
+        with self.lock:
+            if self.socket is sock:
+                self.socket = None
+            pending = self.pending
+            self.pending = {}
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for future, decode in pending.values():
+            future.set_exception(error)
+
+    def Close(self):
+        with self.lock:
+            sock = self.socket
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+
+    ## Sends a request and returns a Future of its result
+
+    def Submit(self, opcode, parts, decode):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.socket is None:
+                self.Connect()
+            request_id = self.next_id
+            self.next_id = (self.next_id + 1) % (1 << 32)
+            self.pending[request_id] = (future, decode)
+            sock = self.socket
+            try:
+                SendFrame(sock, request_id, opcode, parts)
+            except OSError:
+                self.pending.pop(request_id, None)
+                raise
+        return future
+
+    def Call(self, opcode, parts, decode):
+        future = self.Submit(opcode, parts, decode)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError('no response from ' + str(self.address) + ' in ' + str(self.timeout) + ' seconds')
+
+    ## Block server interface
+
+    def Get(self, block_number):
+        return self.Call(OP_GET, [BLOCK_NUMBER.pack(block_number)], bytearray)
+
+    def Put(self, block_number, block_data):
+        return self.Call(OP_PUT, [BLOCK_NUMBER.pack(block_number), block_data], lambda payload: 0)
+
+    def ReadSetBlock(self, block_number, block_data):
+        return self.Call(OP_READSET, [BLOCK_NUMBER.pack(block_number), block_data], bytearray)
+
+    def GetMany(self, block_numbers):
+        return self.Call(OP_GETMANY, [EncodeBlockNumbers(block_numbers)], DecodeBlockResults)
+
+    def PutMany(self, block_list):
+        return self.Call(OP_PUTMANY, EncodeBlockList(block_list), lambda payload: 0)
+
+    def GetRange(self, block_number, offset, length):
+        return self.Call(OP_GETRANGE, [BLOCK_RANGE.pack(block_number, offset), COUNT.pack(length)], bytearray)
+
+    def PutRange(self, block_number, offset, data):
+        return self.Call(OP_PUTRANGE, [BLOCK_RANGE.pack(block_number, offset), data], bytearray)
+
+    def XorRange(self, block_number, offset, delta):
+        return self.Call(OP_XORRANGE, [BLOCK_RANGE.pack(block_number, offset), delta], lambda payload: 0)
+
+    def XorMany(self, block_list):
+        return self.Call(OP_XORMANY, EncodeBlockList(block_list), DecodeBlockNumbers)
+
+    def XorInto(self, block_number, delta):
+        return -1 if self.XorMany([[block_number, delta]]) else 0
+
+    def RepairMany(self, block_list):
+        return self.Call(OP_REPAIRMANY, EncodeBlockList(block_list), DecodeBlockNumbers)
+
+    def RebuildPutMany(self, block_list, watermark):
+        return self.Call(OP_REBUILDPUT, [BLOCK_NUMBER.pack(watermark)] + EncodeBlockList(block_list), lambda payload: 0)
+
+    ## Any other server method is called through OP_CALL
+
+    def CallMethod(self, name, args):
+        return self.Call(OP_CALL, [json.dumps([name, list(args)]).encode()], json.loads)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self.CallMethod(name, args)
+
+
+## XML-RPC transport whose connections time out after timeout seconds
+
+class TimeoutTransport(xmlrpc.client.Transport):
+    def __init__(self, timeout, use_builtin_types=False):
+        xmlrpc.client.Transport.__init__(self, use_builtin_types=use_builtin_types)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = xmlrpc.client.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+## Pool of persistent connections to one block server
+## connect(timeout) opens a connection: an xmlrpc.client.ServerProxy, whose HTTP/1.1 connection is kept alive
+## between calls, or a BlockClient. Each call takes an idle connection (or opens one, up to size connections)
+## for its duration, so up to size threads call the server at once; connections are reused, so connection setup
+## is paid once per session rather than once per call
+## The pool has the methods of the server like a ServerProxy, keeps track of the health of the server, and
+## is the circuit breaker of the server: while it is down (state BREAKER_OPEN), calls raise ServerUnavailable
+## without touching the server, until a probe (a heartbeat, or the first call after the backoff) succeeds
+## admit(connection), if set, is asked before a server that was down is used again: the probe fails, and the
+## server stays down, unless it returns True
+
+BREAKER_CLOSED = 'up'
+BREAKER_OPEN = 'down'
+
+
+class ServerPool():
+    def __init__(self, connect, size, timeout, name=''):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.name = name
+        self.idle = collections.deque()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+        # Health: calls that reached the server or failed to, failures in a row, time and error of the last
+        # failure, time of the last success, and moving average of the call latency (seconds)
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_failure = None
+        self.last_error = None
+        self.last_success = 0
+        self.latency = 0.0
+
+        # Circuit breaker: state, current probe backoff, and time of the next probe while down
+        self.state = BREAKER_CLOSED
+        self.backoff = PROBE_BACKOFF_MIN
+        self.next_probe = 0
+        self.admit = None
+
+    ## Whether the server may be called: it is up, or it is down but due for a probe
+
+    def Available(self):
+        with self.lock:
+            return self.state == BREAKER_CLOSED or time.monotonic() >= self.next_probe
+
+    ## Returns an idle connection, or a new one
+
+    def Checkout(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect(self.timeout)
+
+    ## Closes a connection that failed, so that a later call opens a new one
+
+    def Discard(self, connection):
+        try:
+            if isinstance(connection, xmlrpc.client.ServerProxy):
+                connection('close')()
+            else:
+                connection.Close()
+        except Exception:
+            pass
+
+    def Call(self, name, args):
+        with self.lock:
+            probe = self.state == BREAKER_OPEN
+            if probe:
+                now = time.monotonic()
+                if now < self.next_probe:
+                    raise ServerUnavailable(self.name + ' is down')
+                # this call is the probe; the calls made until it completes still fail at once
+                self.next_probe = now + self.backoff
+
+        with self.slots:
+            connection = self.Checkout()
+            start = time.monotonic()
+            try:
+                if probe:
+                    # the server must answer before it is marked up: connections are opened lazily
+                    connection.Geometry()
+                    self.Admit(connection)
+                result = getattr(connection, name)(*args)
+            except (xmlrpc.client.Fault, BlockProtocolError):
+                # the server answered: the connection is fine, the request is not
+                self.RecordSuccess(time.monotonic() - start)
+                self.Checkin(connection)
+                raise
+            except Exception as e:
+                self.RecordFailure(e)
+                self.Discard(connection)
+                raise
+            self.RecordSuccess(time.monotonic() - start)
+            self.Checkin(connection)
+            return result
+
+    def Checkin(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+
+    def RecordSuccess(self, latency):
+        with self.lock:
+            self.calls += 1
+            self.consecutive_failures = 0
+            self.last_success = time.monotonic()
+            self.latency = latency if self.calls == 1 else 0.9 * self.latency + 0.1 * latency
+
+    ## Marks the server up again, once it answered a probe and admit accepts it; raises ServerUnavailable if
+    ## admit refuses it
+
+    def Admit(self, connection):
+        if self.admit is not None and not self.admit(connection):
+            raise ServerUnavailable(self.name + ' is not admitted back')
+        with self.lock:
+            if self.state == BREAKER_OPEN:
+                logging.info('ServerPool: ' + self.name + ' is up again')
+                self.state = BREAKER_CLOSED
+                self.backoff = PROBE_BACKOFF_MIN
+
+    ## Marks the server down; it is probed after PROBE_BACKOFF_MIN
+
+    def MarkDown(self, error):
+        with self.lock:
+            self.Open(error)
+
+    ## Opens the breaker, with self.lock held
+
+    def Open(self, error):
+        logging.warning('ServerPool: ' + self.name + ' is down: ' + str(error))
+        self.state = BREAKER_OPEN
+        self.backoff = PROBE_BACKOFF_MIN
+        self.next_probe = time.monotonic() + self.backoff
+        idle = list(self.idle)
+        self.idle.clear()
+        for connection in idle:
+            self.Discard(connection)
+
+    def RecordFailure(self, error):
+        logging.debug('ServerPool: ' + self.name + ' call failed: ' + str(error))
+        with self.lock:
+            now = time.monotonic()
+            self.calls += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_failure = now
+            self.last_error = str(error)
+            if self.state == BREAKER_OPEN:
+                # failed probe
+                self.backoff = min(self.backoff * 2, PROBE_BACKOFF_MAX)
+                self.next_probe = now + self.backoff
+            elif self.consecutive_failures >= BREAKER_FAILURES:
+                self.Open(error)
+
+    ## Heartbeat: calls Geometry on a fresh connection with a short timeout when the server is down and due for
+    ## a probe, or when it is up but was not heard from for interval seconds; called by the HealthMonitor
+
+    def Heartbeat(self, interval):
+        with self.lock:
+            now = time.monotonic()
+            probe = self.state == BREAKER_OPEN
+            if probe:
+                if now < self.next_probe:
+                    return
+                self.next_probe = now + self.backoff
+            elif now - self.last_success < interval:
+                return
+        connection = None
+        try:
+            connection = self.connect(HEARTBEAT_TIMEOUT)
+            connection.Geometry()
+            if probe:
+                self.Admit(connection)
+        except Exception as e:
+            self.RecordFailure(e)
+        else:
+            self.RecordSuccess(time.monotonic() - now)
+        if connection is not None:
+            self.Discard(connection)
+
+    ## Returns a dictionary describing the health of the server
+
+    def Health(self):
+        with self.lock:
+            return {'server': self.name, 'state': self.state, 'calls': self.calls, 'failures': self.failures,
+                    'consecutive_failures': self.consecutive_failures, 'last_error': self.last_error,
+                    'latency': self.latency, 'connections': len(self.idle)}
+
+    def Close(self):
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for connection in idle:
+            self.Discard(connection)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self.Call(name, args)
+
+
+## Background thread sending heartbeats to a list of ServerPools: servers that stopped answering are marked
+## down before clients pay for it, and servers that are down are probed with exponential backoff
+
+class HealthMonitor():
+    def __init__(self, pools, interval):
+        self.pools = pools
+        self.interval = interval
+        self.stopped = threading.Event()
+        threading.Thread(target=self.Run, daemon=True).start()
+
+    def Run(self):
+        while not self.stopped.wait(min(self.interval, PROBE_BACKOFF_MIN)):
+            for pool in self.pools:
+                pool.Heartbeat(self.interval)
+
+    def Stop(self):
+        self.stopped.set()
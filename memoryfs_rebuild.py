@@ -0,0 +1,202 @@
+import argparse
+import sys
+from memoryfs_client import *
+
+## Online rebuild of a server that replaced a failed one
+## The replacement is started blank with --rebuilding (see memoryfs_server). Every physical block of the failed
+## server index is rebuilt by XORing the blocks of the same physical block number on the other servers: data
+## blocks from the rest of their stripe, parity blocks from the data they cover. Blocks are rebuilt in batches,
+## one GetMany per peer and one RebuildPutMany to the replacement, and the replacement is told how far the
+## rebuild went after each batch. Meanwhile clients keep going: the replacement reports the blocks it does not
+## have yet as damaged, so that clients read them from the rest of their stripe (degraded mode), and keeps the
+## blocks that clients write to it over the rebuilt ones.
+## Clients skip the writes to a server their circuit breaker considers down: start the rebuild once the
+## replacement has been up for PROBE_BACKOFF_MAX seconds, so that every client writes to it again
+## Clients record on the other servers the outages during which a server missed writes, and do not use it again
+## until it is rebuilt (see DiskBlocks.AdmitServer): a complete rebuild clears the record
+## Usage: python memoryfs_rebuild.py failed_server number_of_servers host:port ... [--batch-size] [--rate]
+
+# Physical blocks rebuilt per batch
+REBUILD_BATCH_SIZE = 256
+
+# Times a batch is read again when clients updated its stripes while it was being rebuilt
+REBUILD_RETRIES = 3
+
+
+## Limits a loop over blocks to rate blocks per second (None: no limit)
+
+class Throttle():
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.perf_counter()
+
+    def Elapsed(self):
+        return time.perf_counter() - self.started
+
+    ## Sleeps until the done blocks fit in the rate
+
+    def Wait(self, done):
+        if self.rate is not None and done / self.rate > self.Elapsed():
+            time.sleep(done / self.rate - self.Elapsed())
+
+
+## Rebuilds server (index into RawBlocks.servers) from the other servers of RawBlocks
+## rate limits the rebuild to that many blocks per second (None: as fast as possible), so that it leaves
+## bandwidth to the clients; progress(done, total, elapsed) is called after every batch
+
+class Rebuild():
+    def __init__(self, RawBlocks, server, batch_size=REBUILD_BATCH_SIZE, rate=None, progress=None):
+        self.RawBlocks = RawBlocks
+        self.server = server
+        self.peers = [peer for peer in range(len(RawBlocks.servers)) if peer != server]
+        self.batch_size = batch_size
+        self.rate = rate
+        self.progress = progress
+        # blocks that could not be rebuilt: another block of their stripe is damaged too
+        self.lost = []
+        # stripes read again because they changed while they were rebuilt
+        self.retried = 0
+
+    ## Rebuilds the given physical blocks from the peers
+    ## Returns a list of [physical block number, data] pairs, without the lost blocks
+    ## A client updating a stripe writes its data and parity blocks one after the other, so a stripe read in
+    ## between rebuilds to a wrong block: the peers are read again after rebuilding, and the stripes that
+    ## changed are rebuilt from the new read
+
+    def RebuildBatch(self, physical_block_numbers):
+        stripes = self.RawBlocks.ReadPhysicalBlocks({peer: physical_block_numbers for peer in self.peers})
+        rebuilt = {}
+        pending = physical_block_numbers
+        for attempt in range(0, REBUILD_RETRIES + 1):
+            for physical_block_number in pending:
+                rebuilt[physical_block_number] = self.RawBlocks.ReconstructBlock(self.server, physical_block_number,
+                                                                                 stripes)
+            if attempt == REBUILD_RETRIES:
+                logging.warning('Rebuild: stripes still changing, rebuilt from the last read: ' + str(pending))
+                break
+            check = self.RawBlocks.ReadPhysicalBlocks({peer: pending for peer in self.peers})
+            pending = [physical_block_number for physical_block_number in pending
+                       if any(check[(peer, physical_block_number)] != stripes[(peer, physical_block_number)]
+                              for peer in self.peers)]
+            if not pending:
+                break
+            self.retried += len(pending)
+            stripes.update(check)
+
+        block_list = []
+        for physical_block_number in physical_block_numbers:
+            if rebuilt[physical_block_number] == -1:
+                self.lost.append(physical_block_number)
+            else:
+                block_list.append([physical_block_number, rebuilt[physical_block_number]])
+        return block_list
+
+    ## Runs the rebuild, from where the replacement says a previous run stopped
+    ## Returns True once the replacement is rebuilt, False if the rebuild stopped on a server failure or the
+    ## replacement missed writes meanwhile
+
+    def Run(self):
+        target = self.RawBlocks.servers[self.server]
+        try:
+            total = target.Geometry()[0]
+            start = target.RebuildStatus()
+        except Exception as e:
+            logging.error('Rebuild: server ' + str(self.server) + ' not reachable: ' + str(e))
+            return False
+        if start == -1:
+            logging.error('Rebuild: server ' + str(self.server) + ' is not being rebuilt (start it with --rebuilding)')
+            return False
+        missed = self.MissedOutages()
+
+        throttle = Throttle(self.rate)
+        done = 0
+        for first in range(start, total, self.batch_size):
+            # a peer that is down leaves every stripe with two missing blocks: stop, the rebuild can be resumed
+            down = [peer for peer in self.peers if not self.RawBlocks.servers[peer].Available()]
+            if down:
+                logging.error('Rebuild: servers ' + str(down) + ' are down, stopping at block ' + str(first))
+                return False
+            last = min(first + self.batch_size, total)
+            block_list = self.RebuildBatch(list(range(first, last)))
+            try:
+                target.RebuildPutMany(block_list, last)
+            except Exception as e:
+                logging.error('Rebuild: writing to server ' + str(self.server) + ' failed at block '
+                              + str(first) + ': ' + str(e))
+                return False
+            done += last - first
+
+            if self.progress is not None:
+                self.progress(start + done, total, throttle.Elapsed())
+            throttle.Wait(done)
+
+        if self.lost:
+            logging.error('Rebuild: ' + str(len(self.lost)) + ' blocks lost, damaged on another server too: '
+                          + str(self.lost))
+        return self.ClearMissedOutages(missed)
+
+    ## Returns the lock words of the peers counting the outages during which the server missed writes
+
+    def MissedOutages(self):
+        word = MISSED_WRITES_WORD + str(self.server)
+        missed = {}
+        for peer in self.peers:
+            try:
+                missed[peer] = self.RawBlocks.servers[peer].CompareAndSwap(word, '', '')
+            except Exception as e:
+                logging.warning('Rebuild: server ' + str(peer) + ' not reachable: ' + str(e))
+        return missed
+
+    ## Clears the lock words read by MissedOutages, so that clients use the server again
+    ## Returns False if the server missed writes again during the rebuild: the blocks rebuilt before are stale
+
+    def ClearMissedOutages(self, missed):
+        word = MISSED_WRITES_WORD + str(self.server)
+        cleared = True
+        for peer, value in missed.items():
+            try:
+                cleared = self.RawBlocks.servers[peer].CompareAndSwap(word, value, '') == value and cleared
+            except Exception as e:
+                logging.warning('Rebuild: server ' + str(peer) + ' not reachable: ' + str(e))
+        if not cleared:
+            logging.error('Rebuild: server ' + str(self.server) + ' missed writes during the rebuild: restart it '
+                          'with --rebuilding and rebuild it again')
+        return cleared
+
+
+## Prints the progress of a rebuild on one line
+
+def PrintProgress(done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0
+    print('\rrebuilt %d/%d blocks (%.0f%%), %.0f blocks/s' % (done, total, 100 * done / total, rate),
+          end='', flush=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='memoryfs_rebuild.log', filemode='w', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='memoryfs server rebuild')
+    parser.add_argument('failed_server', type=int, help='index of the replaced server in the server list')
+    parser.add_argument('number_of_servers', type=int)
+    parser.add_argument('servers', nargs='+', help='host:port of each block server')
+    parser.add_argument('--protocol', choices=['xmlrpc', 'binary'], default='xmlrpc',
+                        help='binary: the servers are the binary protocol ports of the block servers')
+    parser.add_argument('--batch-size', type=int, default=REBUILD_BATCH_SIZE,
+                        help='physical blocks rebuilt per batch')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='rebuild at most this many blocks per second (default: no limit)')
+    args = parser.parse_args()
+
+    server_url_list = []
+    for i in range(0, args.number_of_servers):
+        server_url_list.append(("block://" if args.protocol == 'binary' else "http://") + args.servers[i].strip())
+
+    RawBlocks = DiskBlocks(server_url_list, parallel=True)
+    # the rebuilt blocks are the size of the servers' blocks
+    SetGeometry(RawBlocks.Capacity(), RawBlocks.ServerGeometry()[1], MAX_NUM_INODES, INODE_SIZE)
+    rebuild = Rebuild(RawBlocks, args.failed_server, args.batch_size, args.rate, PrintProgress)
+    complete = rebuild.Run()
+    print()
+    if rebuild.lost:
+        print('lost blocks (damaged on another server too): ' + str(rebuild.lost))
+    print('rebuild ' + ('complete' if complete else 'stopped, run again to resume'))
+    sys.exit(0 if complete and not rebuild.lost else 1)
@@ -0,0 +1,217 @@
+import argparse
+import sys
+import memoryfs_client
+from memoryfs_client import *
+from memoryfs_rebuild import Throttle
+
+# BLOCK_SIZE is set from the servers' geometry in __main__, so it is read through the memoryfs_client module
+
+## Scrubbing: finds and repairs the damage that reads alone would only find when it is too late
+## Servers verify the checksum of a block only when it is read, and a stripe whose parity was not updated
+## (a Put that failed half way, a server that missed writes while it was down) looks fine until another block of
+## the stripe is lost. The scrubber reads every physical block of every server, in batches of one GetMany per
+## server, after having the servers verify their checksums (VerifyMany, whatever their verify policy), and for
+## each stripe:
+##   - a block that fails its checksum is rebuilt from the rest of the stripe and written back by RepairMany,
+##     which leaves it alone if a client wrote it since
+##   - a stripe whose blocks do not XOR to zero gets that syndrome XORed into its parity (XorMany), which
+##     commutes with the parity deltas of the clients writing the stripe
+##   - a stripe with more than one damaged block cannot be repaired, it is reported
+## Clients keep going during a scrub: a stripe is only repaired if it read the same once more recheck_delay
+## seconds later, so that a client write in progress (new data written, parity delta not applied yet) is not
+## mistaken for damage
+## Usage: python memoryfs_scrub.py number_of_servers host:port ... [--batch-size] [--rate] [--interval]
+
+# Physical blocks verified per batch
+SCRUB_BATCH_SIZE = 256
+
+# Seconds between the passes of a background scrubber
+SCRUB_INTERVAL = 3600
+
+# Seconds before the suspect stripes of a batch are read again, for the client writes in progress to complete
+SCRUB_RECHECK_DELAY = 0.5
+
+
+## Scrubs the servers of RawBlocks; rate limits a pass to that many physical blocks (of each server) per second
+## metrics counts, over all passes:
+##   passes, blocks (physical blocks read), stripes, checksum_errors, parity_mismatches, repaired,
+##   unrecoverable (stripes with several damaged blocks), changed (suspect stripes updated by a client meanwhile,
+##   left to the next pass)
+
+class Scrubber():
+    def __init__(self, RawBlocks, batch_size=SCRUB_BATCH_SIZE, rate=None, progress=None,
+                 recheck_delay=SCRUB_RECHECK_DELAY):
+        self.RawBlocks = RawBlocks
+        self.batch_size = batch_size
+        self.recheck_delay = recheck_delay
+        self.rate = rate
+        self.progress = progress
+        self.metrics = collections.Counter()
+        # (server, physical block number) of the blocks that could not be repaired in the last pass
+        self.unrecoverable = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    ## Checks the stripes of the given physical block numbers, and repairs them
+
+    def ScrubBatch(self, physical_block_numbers):
+        servers = range(len(self.RawBlocks.servers))
+        try:
+            failed = self.RawBlocks.CallServers(lambda server, block_numbers:
+                                                self.RawBlocks.servers[server].VerifyMany(block_numbers),
+                                                {server: physical_block_numbers for server in servers})
+        except Exception as e:
+            logging.error('Scrub: verifying blocks ' + str(physical_block_numbers[0]) + '... failed: ' + str(e))
+            return
+        # blocks that failed verification, which a Get that does not verify may still return
+        failed = [(server, physical_block_number) for server in servers for physical_block_number in failed[server]]
+        stripes = self.RawBlocks.ReadPhysicalBlocks({server: physical_block_numbers for server in servers})
+        stripes.update((block, -1) for block in failed)
+        self.metrics['blocks'] += len(physical_block_numbers) * len(servers)
+        self.metrics['stripes'] += len(physical_block_numbers)
+
+        # server whose block of the stripe is to be repaired, and syndrome of the stripes whose parity does not
+        # match, by physical block number
+        suspects = {}
+        syndromes = {}
+        for physical_block_number in physical_block_numbers:
+            damaged = [server for server in servers if stripes[(server, physical_block_number)] == -1]
+            self.metrics['checksum_errors'] += len(damaged)
+            if len(damaged) > 1:
+                logging.error('Scrub: stripe ' + str(physical_block_number) + ' lost blocks of servers ' + str(damaged))
+                self.metrics['unrecoverable'] += 1
+                self.unrecoverable.extend((server, physical_block_number) for server in damaged)
+            elif len(damaged) == 1:
+                suspects[physical_block_number] = damaged[0]
+            else:
+                syndrome = xor_many([stripes[(server, physical_block_number)] for server in servers],
+                                    memoryfs_client.BLOCK_SIZE)
+                if syndrome != bytes(memoryfs_client.BLOCK_SIZE):
+                    logging.warning('Scrub: parity mismatch in stripe ' + str(physical_block_number))
+                    self.metrics['parity_mismatches'] += 1
+                    suspects[physical_block_number] = self.RawBlocks.ParityServer(physical_block_number)
+                    syndromes[physical_block_number] = syndrome
+        if not suspects:
+            return
+
+        # read the suspect stripes again: leave the ones a client changed meanwhile to the next pass
+        self.stopped.wait(self.recheck_delay)
+        check = self.RawBlocks.ReadPhysicalBlocks({server: list(suspects) for server in servers})
+        check.update((block, -1) for block in failed if block in check)
+        repairs = {}
+        deltas = {}
+        for physical_block_number, server in suspects.items():
+            if any(check[(peer, physical_block_number)] != stripes[(peer, physical_block_number)] for peer in servers):
+                self.metrics['changed'] += 1
+            elif physical_block_number in syndromes:
+                deltas.setdefault(server, []).append((physical_block_number, syndromes[physical_block_number]))
+            else:
+                block_data = self.RawBlocks.ReconstructBlock(server, physical_block_number, stripes)
+                repairs.setdefault(server, []).append((physical_block_number, block_data))
+
+        # the blocks a client wrote since they were read, and the parity blocks damaged since, are left to the
+        # next pass
+        for requests, function, skipped in ((repairs, self.RawBlocks.RepairMany_RPC, 'changed'),
+                                            (deltas, self.RawBlocks.XorMany_RPC, 'damaged')):
+            replies = self.RawBlocks.CallServers(function, requests)
+            for server, block_list in requests.items():
+                if replies[server] == -1:
+                    logging.error('Scrub: repairing blocks of server ' + str(server) + ' failed')
+                    continue
+                if replies[server]:
+                    logging.warning('Scrub: blocks ' + str(replies[server]) + ' of server ' + str(server) + ' '
+                                    + skipped + ' since they were read, not repaired')
+                self.metrics['changed'] += len(replies[server])
+                self.metrics['repaired'] += len(block_list) - len(replies[server])
+
+    ## Runs one pass over every stripe
+    ## Returns True if the pass completed; a pass is not started, or is stopped, while a server is down or being
+    ## rebuilt, since the stripes would all look damaged
+
+    def Run(self):
+        self.unrecoverable = []
+        try:
+            total = self.RawBlocks.ServerGeometry()[0]
+            rebuilding = [server for server in range(len(self.RawBlocks.servers))
+                          if self.RawBlocks.servers[server].RebuildStatus() != -1]
+        except Exception as e:
+            logging.error('Scrub: servers not reachable: ' + str(e))
+            return False
+        if rebuilding:
+            logging.warning('Scrub: servers ' + str(rebuilding) + ' are being rebuilt, not scrubbing')
+            return False
+
+        throttle = Throttle(self.rate)
+        for first in range(0, total, self.batch_size):
+            down = [server for server in range(len(self.RawBlocks.servers))
+                    if not self.RawBlocks.servers[server].Available()]
+            if down or self.stopped.is_set():
+                logging.warning('Scrub: stopped at block ' + str(first) + ', servers down: ' + str(down))
+                return False
+            last = min(first + self.batch_size, total)
+            self.ScrubBatch(list(range(first, last)))
+            if self.progress is not None:
+                self.progress(last, total, throttle.Elapsed())
+            throttle.Wait(last)
+
+        self.metrics['passes'] += 1
+        self.metrics['seconds'] += throttle.Elapsed()
+        logging.info('Scrub: pass complete ' + str(dict(self.metrics)))
+        return True
+
+    ## Scrubs in the background, one pass every interval seconds, until Stop()
+
+    def Start(self, interval=SCRUB_INTERVAL):
+        def Loop():
+            while not self.stopped.is_set():
+                self.Run()
+                self.stopped.wait(interval)
+
+        self.thread = threading.Thread(target=Loop, daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+## Prints the progress of a scrub pass on one line
+
+def PrintProgress(done, total, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0
+    print('\rscrubbed %d/%d stripes (%.0f%%), %.0f stripes/s' % (done, total, 100 * done / total, rate),
+          end='', flush=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='memoryfs_scrub.log', filemode='w', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='memoryfs scrubber')
+    parser.add_argument('number_of_servers', type=int)
+    parser.add_argument('servers', nargs='+', help='host:port of each block server')
+    parser.add_argument('--protocol', choices=['xmlrpc', 'binary'], default='xmlrpc',
+                        help='binary: the servers are the binary protocol ports of the block servers')
+    parser.add_argument('--batch-size', type=int, default=SCRUB_BATCH_SIZE,
+                        help='stripes verified per batch')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='scrub at most this many stripes per second (default: no limit)')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='keep scrubbing, one pass every this many seconds (default: a single pass)')
+    args = parser.parse_args()
+
+    server_url_list = []
+    for i in range(0, args.number_of_servers):
+        server_url_list.append(("block://" if args.protocol == 'binary' else "http://") + args.servers[i].strip())
+
+    RawBlocks = DiskBlocks(server_url_list, parallel=True)
+    # the scrubbed blocks are the size of the servers' blocks
+    SetGeometry(RawBlocks.Capacity(), RawBlocks.ServerGeometry()[1], MAX_NUM_INODES, INODE_SIZE)
+    scrubber = Scrubber(RawBlocks, args.batch_size, args.rate, PrintProgress)
+    while True:
+        complete = scrubber.Run()
+        print()
+        print('scrub ' + ('complete' if complete else 'stopped') + ': ' + str(dict(scrubber.metrics)))
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
+    sys.exit(0 if complete and not scrubber.unrecoverable else 1)
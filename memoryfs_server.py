@@ -1,39 +1,419 @@
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
+import socketserver
 import threading
+import collections
+import time
 import xmlrpc.client
 import base64
 import pickle, logging
 import sys
+import os
+import socket
+import mmap
+import struct
+import argparse
 import hashlib
-from memoryfs_client import BLOCK_SIZE, TOTAL_NUM_BLOCKS
+import zlib
+import random
+import json
+from memoryfs_client import BLOCK_SIZE, TOTAL_NUM_BLOCKS, xor_blocks
+from memoryfs_protocol import *
 
 damaged_block = None
+
+# Checksum algorithm of new block stores, see CHECKSUM_ALGORITHMS
+DEFAULT_CHECKSUM = 'md5'
+
+# Checksum verification policies of Get, see DiskBlocks
+VERIFY_POLICIES = ['always', 'sampled', 'once']
+
+# With the sampled policy, one Get in VERIFY_SAMPLE_PERIOD verifies the checksum of its block
+VERIFY_SAMPLE_PERIOD = 16
+
+# Blocks per chunk of the checksum array of a memory store; a chunk is allocated when one of its blocks is written,
+# so small chunks keep scattered writes from allocating the checksums of many unwritten blocks
+CHECKSUM_CHUNK_BLOCKS = 64
+
+# Number of locks striped over the blocks: a block is protected by lock block_number % BLOCK_LOCK_STRIPES
+BLOCK_LOCK_STRIPES = 64
+
+
+#### CHECKSUMS
+
+## Block checksum algorithms: name -> [digest size in Bytes, function returning the digest of a block]
+## MD5 is the strongest and the slowest; CRC32 (zlib) costs a fraction of it. CRC32C and xxHash are offered when
+## the crc32c and xxhash packages are installed
+
+CHECKSUM_ALGORITHMS = {
+    'md5': [16, lambda data: hashlib.md5(data).digest()],
+    'crc32': [4, lambda data: zlib.crc32(data).to_bytes(4, 'big')],
+}
+
+try:
+    import crc32c
+    CHECKSUM_ALGORITHMS['crc32c'] = [4, lambda data: crc32c.crc32c(data).to_bytes(4, 'big')]
+except ImportError:
+    pass
+
+try:
+    import xxhash
+    CHECKSUM_ALGORITHMS['xxh64'] = [8, xxhash.xxh64_digest]
+except ImportError:
+    pass
+
+
+## Digests of the blocks of a store, packed in one contiguous bytearray of size Bytes per block
+## A digest of all zeroes stands for a block that was never written, so a new array needs no initialization
+
+class Checksums():
+    def __init__(self, algorithm, block_size):
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            logging.error('Checksums: checksum ' + algorithm + ' not available, choose from '
+                          + str(list(CHECKSUM_ALGORITHMS)))
+            quit()
+        self.algorithm = algorithm
+        self.size, self.Digest = CHECKSUM_ALGORITHMS[algorithm]
+        self.empty = bytes(self.size)
+        # block of zeroes shared by the unwritten blocks of a store, and its precomputed digest
+        self.zero_block = bytes(block_size)
+        self.zero_block_digest = self.Digest(self.zero_block)
+
+    ## Checks block_data against the digest stored for it; an empty digest matches a block of zeroes
+    ## (and the data whose digest happens to be all zeroes)
+
+    def Matches(self, block_data, checksum):
+        if block_data is self.zero_block and checksum == self.empty:
+            return True
+        digest = self.Digest(block_data)
+        return digest == checksum or (checksum == self.empty and digest in (self.zero_block_digest, self.empty))
+
+
+#### STORAGE LAYER
+
+## Keeps blocks in memory; all data is lost when the server stops
+## The store is sparse: only blocks holding data are kept, in a dictionary, and the others read as the shared
+## zero block, so that memory use follows the data written and an empty store of any size starts at once
+## Checksums are packed in arrays of CHECKSUM_CHUNK_BLOCKS blocks, allocated when a block of the chunk is written
+## Block stores hold the checksums of their blocks, computed by their checksums.Digest
+
+class MemoryBlockStore():
+    def __init__(self, num_blocks, block_size, checksum=DEFAULT_CHECKSUM):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.checksums = Checksums(checksum, block_size)
+        self.block = {}
+        self.checksum_chunks = {}
+
+    def ReadBlock(self, block_number):
+        return self.block.get(block_number, self.checksums.zero_block)
+
+    def ReadChecksum(self, block_number):
+        chunk = self.checksum_chunks.get(block_number // CHECKSUM_CHUNK_BLOCKS)
+        if chunk is None:
+            return self.checksums.empty
+        start = (block_number % CHECKSUM_CHUNK_BLOCKS) * self.checksums.size
+        return bytes(chunk[start:start + self.checksums.size])
+
+    ## A block of zeroes is dropped: it reads as the zero block, with an empty checksum
+
+    def WriteBlock(self, block_number, block_data, checksum):
+        if block_data == self.checksums.zero_block:
+            self.block.pop(block_number, None)
+            checksum = self.checksums.empty
+        else:
+            self.block[block_number] = block_data
+        chunk = self.checksum_chunks.get(block_number // CHECKSUM_CHUNK_BLOCKS)
+        if chunk is None:
+            if checksum == self.checksums.empty:
+                return
+            chunk = self.checksum_chunks[block_number // CHECKSUM_CHUNK_BLOCKS] = \
+                bytearray(CHECKSUM_CHUNK_BLOCKS * self.checksums.size)
+        start = (block_number % CHECKSUM_CHUNK_BLOCKS) * self.checksums.size
+        chunk[start:start + self.checksums.size] = checksum
+
+    def Close(self):
+        pass
+
+
+## Keeps blocks in a preallocated image file mapped in memory
+## Image layout: one page of header, then the checksum region (digest size Bytes per block),
+## then the data region (block_size Bytes per block); both regions start on a page boundary
+## A checksum of all zeroes stands for a block that was never written, so a new image needs no initialization
+## and opening an existing image does not depend on the number of blocks
+## An existing image keeps the geometry and checksum algorithm recorded in its header; num_blocks, block_size
+## and checksum only apply to new images (images without an algorithm in their header use MD5)
+
+class ImageBlockStore():
+    MAGIC = b'MEMFSIMG'
+    HEADER_FORMAT = '>8sIQI8s'
+    HEADER_SIZE = mmap.PAGESIZE
+
+    def __init__(self, filename, num_blocks, block_size, checksum=DEFAULT_CHECKSUM):
+        self.filename = filename
+
+        new_image = not os.path.exists(filename)
+        self.file = open(filename, 'w+b' if new_image else 'r+b')
+        if not new_image:
+            magic, block_size, num_blocks, checksum_size, checksum = struct.unpack(
+                self.HEADER_FORMAT, self.file.read(struct.calcsize(self.HEADER_FORMAT)))
+            checksum = checksum.rstrip(b'\x00').decode() or 'md5'
+            if magic != self.MAGIC or checksum_size != CHECKSUM_ALGORITHMS.get(checksum, [None])[0]:
+                logging.error('ImageBlockStore: ' + filename + ' is not a block image, or its checksum '
+                              + checksum + ' is not available')
+                quit()
+            logging.info('ImageBlockStore: opened image ' + filename + ' with ' + str(num_blocks) + ' blocks of ' + str(
+                block_size) + ' Bytes')
+
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.checksums = Checksums(checksum, block_size)
+
+        checksum_region_size = -(-num_blocks * self.checksums.size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.checksum_offset = self.HEADER_SIZE
+        self.data_offset = self.checksum_offset + checksum_region_size
+        image_size = self.data_offset + num_blocks * block_size
+
+        if new_image:
+            logging.info('ImageBlockStore: creating image ' + filename)
+            # truncate preallocates the image as a sparse file: unwritten regions read as zeroes
+            self.file.truncate(image_size)
+            self.file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, block_size, num_blocks, self.checksums.size,
+                                        checksum.encode()))
+            self.file.flush()
+
+        self.image = mmap.mmap(self.file.fileno(), image_size)
+        self.view = memoryview(self.image)
+
+    ## Returns a zero-copy memoryview of the block
+
+    def ReadBlock(self, block_number):
+        start = self.data_offset + block_number * self.block_size
+        return self.view[start:start + self.block_size]
+
+    def ReadChecksum(self, block_number):
+        start = self.checksum_offset + block_number * self.checksums.size
+        return self.image[start:start + self.checksums.size]
+
+    def WriteBlock(self, block_number, block_data, checksum):
+        start = self.data_offset + block_number * self.block_size
+        self.image[start:start + self.block_size] = block_data
+        start = self.checksum_offset + block_number * self.checksums.size
+        self.image[start:start + self.checksums.size] = checksum
+
+    ## Writes the mapped image back to the file
+
+    def Close(self):
+        self.image.flush()
+        self.view.release()
+        try:
+            self.image.close()
+        except BufferError:
+            # a block view is still referenced; the image is closed when the process exits
+            pass
+        self.file.close()
+
+
+#### LOCK SERVICE
+
+## State of one named lock: its owners with the expiration time of their lease, whether they hold it shared,
+## and the (owner, shared) requests waiting for it
+
+class ServerLock():
+    def __init__(self, mutex):
+        self.owners = {}
+        self.shared = False
+        self.waiters = collections.deque()
+        self.condition = threading.Condition(mutex)
+
+
+## Named reader/writer locks handed out to clients
+## A lock is held either by one owner (exclusive) or by any number of owners (shared), each until it releases
+## the lock or its lease expires, so the lock of a client that died is eventually handed to the next waiter.
+## Waiters sleep on the condition variable of the lock and are served first come first served: a shared
+## request is granted with the shared requests ahead of it, never past a waiting exclusive request.
+## Every lock has a version, which changes each time an exclusive owner gives the lock back (or its lease
+## expires), so that a client can tell whether anyone may have changed what the lock protects since it last
+## held it. Versions are "incarnation.count": the incarnation is drawn when the server starts, as a restarted
+## server has forgotten its counts.
+## Lock words are plain strings updated with CompareAndSwap
+
+class LockService():
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.locks = {}
+        self.words = {}
+        # lock name -> number of times an exclusive owner gave it back; kept when the lock itself is discarded
+        self.versions = {}
+        self.incarnation = '%08x' % random.getrandbits(32)
+
+    ## Returns the current version of lock name
+
+    def Version(self, name):
+        return self.incarnation + '.' + str(self.versions.get(name, 0))
+
+    ## Removes an owner from a lock, and wakes up its waiters
+
+    def RemoveOwner(self, name, lock, owner):
+        del lock.owners[owner]
+        if not lock.shared:
+            self.versions[name] = self.versions.get(name, 0) + 1
+        lock.condition.notify_all()
+
+    ## Returns the owners of a lock, dropping expired leases
+
+    def Owners(self, name, lock, now):
+        for owner, expires in list(lock.owners.items()):
+            if expires <= now:
+                logging.info('LockService: lease of ' + str(owner) + ' expired')
+                self.RemoveOwner(name, lock, owner)
+        return lock.owners
+
+    ## Whether the request of owner, at position in the waiters of lock, can be granted now
+
+    def Grantable(self, lock, owner, shared, position):
+        if owner in lock.owners:
+            # renewal, or upgrade of a shared lock this owner is the only one to hold (see Acquire)
+            return shared or len(lock.owners) == 1
+        waiters_ahead = [lock.waiters[i][1] for i in range(0, position)]
+        if not lock.owners:
+            return position == 0 or (shared and all(waiters_ahead))
+        return shared and lock.shared and all(waiters_ahead)
+
+    ## Forgets a lock nobody holds or waits for
+
+    def Discard(self, name, lock):
+        if not lock.owners and not lock.waiters and self.locks.get(name) is lock:
+            del self.locks[name]
+
+    ## Acquire: waits up to timeout seconds for lock name; returns the version of the lock once owner holds it
+    ## for lease seconds, or False. Acquiring a lock already held by owner renews its lease; acquiring exclusive a
+    ## lock owner holds shared upgrades it if owner is its only owner, and fails at once otherwise
+
+    def Acquire(self, name, owner, lease, timeout, shared=False):
+        deadline = time.monotonic() + timeout
+        request = (owner, shared)
+        with self.mutex:
+            lock = self.locks.get(name)
+            if lock is None:
+                lock = self.locks[name] = ServerLock(self.mutex)
+            lock.waiters.append(request)
+            try:
+                while True:
+                    now = time.monotonic()
+                    owners = self.Owners(name, lock, now)
+                    if self.Grantable(lock, owner, shared, lock.waiters.index(request)):
+                        lock.shared = shared and (lock.shared or not owners)
+                        owners[owner] = now + lease
+                        return self.Version(name)
+                    if owner in owners:
+                        # upgrade of a lock other owners share: they may be upgrading it too, each waiting for
+                        # the others to give it back, so it is refused at once
+                        logging.debug('Acquire: ' + name + ' upgrade refused to ' + str(owner))
+                        return False
+                    if now >= deadline:
+                        logging.debug('Acquire: ' + name + ' timed out for ' + str(owner))
+                        return False
+                    # wake up when the first lease of the current owners runs out at the latest
+                    wait = deadline - now
+                    if owners:
+                        wait = min(wait, min(owners.values()) - now)
+                    lock.condition.wait(wait)
+            finally:
+                lock.waiters.remove(request)
+                # the next waiters may now be first in line
+                lock.condition.notify_all()
+                self.Discard(name, lock)
+
+    ## Release: releases lock name if owner holds it, and returns the version of the lock after the release
+    ## Returns False if owner does not hold the lock (e.g. its lease expired)
+
+    def Release(self, name, owner):
+        with self.mutex:
+            lock = self.locks.get(name)
+            if lock is None or owner not in self.Owners(name, lock, time.monotonic()):
+                return False
+            self.RemoveOwner(name, lock, owner)
+            self.Discard(name, lock)
+            return self.Version(name)
+
+    ## Renew: extends the lease of owner on lock name; returns False if owner no longer holds it
+
+    def Renew(self, name, owner, lease):
+        with self.mutex:
+            lock = self.locks.get(name)
+            now = time.monotonic()
+            if lock is None or owner not in self.Owners(name, lock, now):
+                return False
+            lock.owners[owner] = now + lease
+            return True
+
+    ## CompareAndSwap: sets lock word name to new if it equals expected; returns the previous value
+    ## A lock word that was never set is the empty string
+
+    def CompareAndSwap(self, name, expected, new):
+        with self.mutex:
+            value = self.words.get(name, '')
+            if value == expected:
+                self.words[name] = new
+            return value
+
+
 #### BLOCK LAYER
 
 class DiskBlocks():
-    def __init__(self):
-        # This class stores the raw block array
-        self.block = []
-        self.checksum = []
+    def __init__(self, store, rebuilding=False, verify='always'):
+        # This class checks and stores raw blocks in the given block store
+        self.store = store
+        self.checksums = store.checksums
+        self.block_size = store.block_size
+        self.num_blocks = store.num_blocks
         self.LOCKED = "LOCKED"
         self.UNLOCKED = "UNLOCKED"
-        self.lock = threading.Lock()
-        # Initialize raw blocks
-        for i in range(0, TOTAL_NUM_BLOCKS):
-            putdata = bytearray(BLOCK_SIZE)
-            self.block.insert(i, putdata)
-            self.checksum.insert(i, hashlib.md5(bytes(putdata)).hexdigest())
+        # Requests are served by concurrent threads: each block is read and written under one of the striped
+        # block locks, so operations on different blocks proceed in parallel
+        self.block_locks = [threading.RLock() for i in range(0, BLOCK_LOCK_STRIPES)]
+        self.locks = LockService()
+        # A replacement server is started with rebuilding set, and filled by memoryfs_rebuild from the parity
+        # of the other servers. Blocks from rebuild_watermark up are not rebuilt yet: Get reports them as
+        # damaged, so that clients read them from the rest of their stripe, unless a client wrote them since
+        # the rebuild started (written_blocks). rebuild_watermark is None once the server is rebuilt
+        self.rebuild_watermark = 0 if rebuilding else None
+        self.written_blocks = set()
+        # Checksum verification policy of Get (VERIFY_POLICIES): always verify, verify a sample of the Gets, or
+        # verify the first Get of a block once, and trust the block until it is written again (verified_blocks)
+        # VerifyMany always verifies, whatever the policy, for the scrubber
+        if verify not in VERIFY_POLICIES:
+            logging.error('DiskBlocks: unknown verify policy ' + verify)
+            quit()
+        self.verify = verify
+        self.verified_blocks = set()
+
+    ## Returns the lock protecting a block
+
+    def BlockLock(self, block_number):
+        return self.block_locks[block_number % BLOCK_LOCK_STRIPES]
 
     def ReadSetBlock(self, block_number, data):
-        self.lock.acquire()
-        try:
+        with self.BlockLock(block_number):
             value = self.Get(block_number)
             self.Put(block_number, data)
-        finally:
-            self.lock.release()
             return value
 
+    ## Lock service interface, see LockService
+
+    def Acquire(self, name, owner, lease, timeout, shared=False):
+        return self.locks.Acquire(name, owner, lease, timeout, shared)
+
+    def Release(self, name, owner):
+        return self.locks.Release(name, owner)
+
+    def Renew(self, name, owner, lease):
+        return self.locks.Renew(name, owner, lease)
+
+    def CompareAndSwap(self, name, expected, new):
+        return self.locks.CompareAndSwap(name, expected, new)
+
     ## Put: interface to write a raw block of data to the block indexed by block number
     ## Blocks are padded with zeroes up to BLOCK_SIZE
 
@@ -44,16 +424,19 @@ class DiskBlocks():
         logging.debug(
             'Put: block number ' + str(block_number) + ' len ' + str(len(block_data)) + '\n' + str(
                 block_data.hex()))
-        if len(block_data) > BLOCK_SIZE:
+        if len(block_data) > self.block_size:
             logging.error('Put: Block larger than BLOCK_SIZE: ' + str(len(block_data)))
             quit()
 
-        if block_number in range(0, TOTAL_NUM_BLOCKS):
+        if block_number in range(0, self.num_blocks):
             # ljust does the padding with zeros
-            putdata = bytearray(block_data.ljust(BLOCK_SIZE, b'\x00'))
+            putdata = bytearray(block_data.ljust(self.block_size, b'\x00'))
             # Write block
-            self.block[block_number] = putdata
-            self.checksum[block_number] = hashlib.md5(bytes(putdata)).hexdigest()
+            with self.BlockLock(block_number):
+                self.store.WriteBlock(block_number, putdata, self.checksums.Digest(putdata))
+                self.verified_blocks.discard(block_number)
+                if self.rebuild_watermark is not None and block_number >= self.rebuild_watermark:
+                    self.written_blocks.add(block_number)
             return 0
         else:
             logging.error('Put: Block out of range: ' + str(block_number))
@@ -64,41 +447,346 @@ class DiskBlocks():
 
     def Get(self, block_number):
         logging.debug('Get: ' + str(block_number))
+        return self.CheckedRead(block_number, self.verify)
+
+    ## Reads a block, verifying its checksum according to the verify policy; returns -1 if the block is damaged
+    ## The block is returned as a copy taken under its block lock: the image store returns a view of the image,
+    ## which a Put of the block would change while the caller still reads it
+
+    def CheckedRead(self, block_number, verify):
         if damaged_block == block_number:
             return -1
 
-        if block_number in range(0, TOTAL_NUM_BLOCKS):
+        if block_number in range(0, self.num_blocks):
             # logging.debug ('\n' + str((self.block[block_number]).hex()))
-            if hashlib.md5(bytes(self.block[block_number])).digest().hex() == self.checksum[block_number]:
-                return self.block[block_number]
-            else:
-                return -1
+            with self.BlockLock(block_number):
+                if self.rebuild_watermark is not None and block_number >= self.rebuild_watermark \
+                        and block_number not in self.written_blocks:
+                    return -1
+                block_data = self.store.ReadBlock(block_number)
+                if verify == 'once' and block_number in self.verified_blocks:
+                    return bytes(block_data)
+                if verify == 'sampled' and random.randrange(VERIFY_SAMPLE_PERIOD) != 0:
+                    return bytes(block_data)
+                if self.checksums.Matches(block_data, self.store.ReadChecksum(block_number)):
+                    if block_data is not self.checksums.zero_block:
+                        self.verified_blocks.add(block_number)
+                    return bytes(block_data)
+                else:
+                    return -1
 
         logging.error('Get: Block number larger than TOTAL_NUM_BLOCKS: ' + str(block_number))
         quit()
 
+    ## Geometry: returns [number of blocks, block size] of this server
+
+    def Geometry(self):
+        return [self.num_blocks, self.block_size]
+
+    ## GetMany: reads a list of blocks in a single call
+    ## Returns a list with the data of each block, or -1 for blocks that fail their checksum
+
+    def GetMany(self, block_numbers):
+        logging.debug('GetMany: ' + str(block_numbers))
+        result = []
+        for block_number in block_numbers:
+            result.append(self.Get(block_number))
+        return result
+
+    ## VerifyMany: verifies the checksums of a list of blocks, whatever the verify policy
+    ## Returns the block numbers that fail their checksum (or are not rebuilt yet)
+
+    def VerifyMany(self, block_numbers):
+        logging.debug('VerifyMany: ' + str(block_numbers))
+        damaged = []
+        for block_number in block_numbers:
+            if self.CheckedRead(block_number, 'always') == -1:
+                damaged.append(block_number)
+        return damaged
+
+    ## PutMany: writes a list of [block_number, block_data] pairs in a single call
+
+    def PutMany(self, block_list):
+        logging.debug('PutMany: ' + str([block[0] for block in block_list]))
+        for block_number, block_data in block_list:
+            self.Put(block_number, block_data)
+        return 0
+
+    ## Checks that a range of length Bytes at offset lies within a block
+
+    def CheckRange(self, name, offset, length):
+        if offset < 0 or offset + length > self.block_size:
+            logging.error(name + ': range ' + str(offset) + '+' + str(length) + ' out of block')
+            quit()
+
+    ## GetRange: reads length Bytes at offset of a block; returns -1 if the block fails its checksum
+
+    def GetRange(self, block_number, offset, length):
+        logging.debug('GetRange: ' + str(block_number) + ' offset ' + str(offset) + ' length ' + str(length))
+        self.CheckRange('GetRange', offset, length)
+        block_data = self.Get(block_number)
+        if block_data == -1:
+            return -1
+        return bytes(block_data[offset:offset + length])
+
+    ## PutRange: writes data at offset of a block, atomically under its block lock, leaving the rest of the block
+    ## as it is; returns the old content of the range, or -1 if the block is damaged (then nothing is written)
+    ## Like XorRange, the block is verified whatever the verify policy, as Put gives the result a fresh checksum
+
+    def PutRange(self, block_number, offset, data):
+        if isinstance(data, xmlrpc.client.Binary):
+            data = data.data
+        logging.debug('PutRange: ' + str(block_number) + ' offset ' + str(offset) + ' length ' + str(len(data)))
+        self.CheckRange('PutRange', offset, len(data))
+        with self.BlockLock(block_number):
+            block_data = self.CheckedRead(block_number, 'always')
+            if block_data == -1:
+                return -1
+            old_data = bytes(block_data[offset:offset + len(data)])
+            block_data = bytearray(block_data)
+            block_data[offset:offset + len(data)] = data
+            self.Put(block_number, block_data)
+        return old_data
+
+    ## XorRange: XORs delta into the range at offset of a block, atomically under its block lock, and updates
+    ## its checksum. Clients update parity blocks this way, by sending old data ^ new data, so that the parity
+    ## updates of clients writing different blocks of a stripe at the same time commute
+    ## Returns 0, or -1 if the block is damaged: its content is unknown, and the delta cannot be applied
+    ## The block is verified whatever the verify policy: Put gives the result a fresh checksum, which would make
+    ## a corrupted block look valid to VerifyMany and the scrubber
+
+    def XorRange(self, block_number, offset, delta):
+        if isinstance(delta, xmlrpc.client.Binary):
+            delta = delta.data
+        self.CheckRange('XorRange', offset, len(delta))
+        with self.BlockLock(block_number):
+            block_data = self.CheckedRead(block_number, 'always')
+            if block_data == -1:
+                return -1
+            block_data = bytearray(block_data)
+            block_data[offset:offset + len(delta)] = xor_blocks(block_data[offset:offset + len(delta)], delta)
+            self.Put(block_number, block_data)
+        return 0
+
+    ## XorInto: XORs delta into a whole block, see XorRange
+
+    def XorInto(self, block_number, delta):
+        return self.XorRange(block_number, 0, delta)
+
+    ## XorMany: applies a list of [block_number, delta] pairs in a single call
+    ## Returns the list of block numbers the delta of which could not be applied
+
+    def XorMany(self, block_list):
+        logging.debug('XorMany: ' + str([block[0] for block in block_list]))
+        failed = []
+        for block_number, delta in block_list:
+            if self.XorInto(block_number, delta) == -1:
+                failed.append(block_number)
+        return failed
+
+    ## RepairMany: writes a list of [block_number, block_data] pairs rebuilt from the rest of their stripe, each one
+    ## only if the block is still damaged, checked under its block lock: a client that wrote the block since it
+    ## was found damaged gave it newer data, which the rebuilt block must not overwrite
+    ## Returns the list of block numbers that were not written, as they are no longer damaged
+
+    def RepairMany(self, block_list):
+        logging.debug('RepairMany: ' + str([block[0] for block in block_list]))
+        undamaged = []
+        for block_number, block_data in block_list:
+            with self.BlockLock(block_number):
+                if self.CheckedRead(block_number, 'always') == -1:
+                    self.Put(block_number, block_data)
+                else:
+                    undamaged.append(block_number)
+        return undamaged
+
+    ## RebuildPutMany: writes blocks rebuilt from parity, like PutMany, then marks every block below watermark
+    ## as rebuilt. Blocks written by clients since the rebuild started are newer than the rebuilt ones: they are kept
+
+    def RebuildPutMany(self, block_list, watermark):
+        logging.debug('RebuildPutMany: ' + str([block[0] for block in block_list]) + ' watermark ' + str(watermark))
+        if self.rebuild_watermark is None:
+            logging.error('RebuildPutMany: server is not being rebuilt')
+            return -1
+        for block_number, block_data in block_list:
+            with self.BlockLock(block_number):
+                if block_number not in self.written_blocks:
+                    self.Put(block_number, block_data)
+                    self.written_blocks.discard(block_number)
+        self.rebuild_watermark = max(self.rebuild_watermark, watermark)
+        if self.rebuild_watermark >= self.num_blocks:
+            logging.info('RebuildPutMany: rebuild complete')
+            self.rebuild_watermark = None
+            self.written_blocks = set()
+        return 0
+
+    ## RebuildStatus: returns the rebuild watermark, the number of blocks rebuilt so far, or -1 if the server
+    ## is not being rebuilt
+
+    def RebuildStatus(self):
+        if self.rebuild_watermark is None:
+            return -1
+        return self.rebuild_watermark
+
 
 # Restrict to a particular path.
 class RequestHandler(SimpleXMLRPCRequestHandler):
     rpc_paths = ('/RPC2',)
+    # keep connections open between calls; without Nagle's algorithm the response headers and body
+    # are not held back waiting for the client's delayed ACK
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+
+## Serves each connection in its own thread, so that a client waiting for a lock does not hold up the others
 
+class ThreadedXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    # backlog of connections waiting to be accepted, for dozens of clients connecting at once
+    request_queue_size = 128
 
-port_number = int(sys.argv[1])
 
-if len(sys.argv) > 2:
-    damaged_block = int(sys.argv[2])
+## Serves a connection of the binary block protocol, see memoryfs_protocol
+## Block requests are served in order by the connection thread; OP_CALL requests, which may wait
+## (e.g. for a lock), are served by threads of their own so that they do not hold up the requests behind them
 
+class BlockProtocolHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # keeps the frames of responses sent by different threads from interleaving
+        self.send_lock = threading.Lock()
+
+    def handle(self):
+        while True:
+            try:
+                frame = RecvFrame(self.request)
+            except (OSError, BlockProtocolError) as e:
+                logging.debug('BlockProtocolHandler: ' + str(e))
+                return
+            if frame is None:
+                return
+            if frame[1] == OP_CALL:
+                threading.Thread(target=self.Serve, args=frame, daemon=True).start()
+            else:
+                self.Serve(*frame)
+
+    def Serve(self, request_id, opcode, payload):
+        try:
+            status, parts = self.Dispatch(opcode, payload)
+        except (Exception, SystemExit) as e:
+            logging.error('BlockProtocolHandler: request ' + str(opcode) + ' failed: ' + repr(e))
+            status, parts = STATUS_ERROR, [repr(e).encode()]
+        try:
+            with self.send_lock:
+                SendFrame(self.request, request_id, status, parts)
+        except OSError as e:
+            logging.debug('BlockProtocolHandler: ' + str(e))
+
+    ## Runs a request on the DiskBlocks of the server, returns (status, response payload parts)
+
+    def Dispatch(self, opcode, payload):
+        blocks = self.server.blocks
+        if opcode == OP_GET or opcode == OP_READSET:
+            block_number, = BLOCK_NUMBER.unpack_from(payload, 0)
+            if opcode == OP_GET:
+                block_data = blocks.Get(block_number)
+            else:
+                block_data = blocks.ReadSetBlock(block_number, bytes(payload[BLOCK_NUMBER.size:]))
+            if isinstance(block_data, int):
+                return STATUS_BAD_BLOCK, []
+            return STATUS_OK, [block_data]
+        if opcode == OP_PUT:
+            block_number, = BLOCK_NUMBER.unpack_from(payload, 0)
+            blocks.Put(block_number, bytes(payload[BLOCK_NUMBER.size:]))
+            return STATUS_OK, []
+        if opcode == OP_GETMANY:
+            return STATUS_OK, EncodeBlockResults(blocks.GetMany(DecodeBlockNumbers(payload)))
+        if opcode == OP_PUTMANY:
+            blocks.PutMany(DecodeBlockList(payload))
+            return STATUS_OK, []
+        if opcode == OP_GETRANGE or opcode == OP_PUTRANGE or opcode == OP_XORRANGE:
+            block_number, offset = BLOCK_RANGE.unpack_from(payload, 0)
+            data = bytes(payload[BLOCK_RANGE.size:])
+            if opcode == OP_GETRANGE:
+                result = blocks.GetRange(block_number, offset, COUNT.unpack(data)[0])
+            elif opcode == OP_PUTRANGE:
+                result = blocks.PutRange(block_number, offset, data)
+            else:
+                result = blocks.XorRange(block_number, offset, data)
+            if isinstance(result, int):
+                return (STATUS_OK, []) if result == 0 else (STATUS_BAD_BLOCK, [])
+            return STATUS_OK, [result]
+        if opcode == OP_XORMANY:
+            return STATUS_OK, [EncodeBlockNumbers(blocks.XorMany(DecodeBlockList(payload)))]
+        if opcode == OP_REPAIRMANY:
+            return STATUS_OK, [EncodeBlockNumbers(blocks.RepairMany(DecodeBlockList(payload)))]
+        if opcode == OP_REBUILDPUT:
+            watermark, = BLOCK_NUMBER.unpack_from(payload, 0)
+            status = blocks.RebuildPutMany(DecodeBlockList(memoryview(payload)[BLOCK_NUMBER.size:]), watermark)
+            return (STATUS_OK, []) if status == 0 else (STATUS_ERROR, [b'server is not being rebuilt'])
+        if opcode == OP_CALL:
+            name, args = json.loads(payload)
+            if name.startswith('_') or not callable(getattr(blocks, name, None)):
+                raise BlockProtocolError('unknown method ' + name)
+            return STATUS_OK, [json.dumps(getattr(blocks, name)(*args)).encode()]
+        raise BlockProtocolError('unknown opcode ' + str(opcode))
 
 
+class BlockProtocolServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
 
-# Create server
-with SimpleXMLRPCServer(('localhost', port_number),
-                        requestHandler=RequestHandler, allow_none=True) as server:
-    # Initialize file system data
-    logging.info('Initializing data structures...')
-    RawBlocks = DiskBlocks()
+    def __init__(self, address, blocks):
+        self.blocks = blocks
+        socketserver.ThreadingTCPServer.__init__(self, address, BlockProtocolHandler)
 
-    server.register_instance(RawBlocks, allow_dotted_names=True)
 
-    # Run the server's main loop
-    server.serve_forever()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='memoryfs block server')
+    parser.add_argument('port', type=int)
+    parser.add_argument('damaged_block', type=int, nargs='?', default=None,
+                        help='block number that always fails its checksum, to test recovery')
+    parser.add_argument('--image', default=None,
+                        help='backing image file; blocks are kept in memory only if not given')
+    parser.add_argument('--num-blocks', type=int, default=TOTAL_NUM_BLOCKS,
+                        help='number of blocks of this server (ignored for an existing image)')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='block size in Bytes (ignored for an existing image)')
+    parser.add_argument('--binary-port', type=int, default=None,
+                        help='also serve the binary block protocol on this port (clients use block://host:port)')
+    parser.add_argument('--checksum', choices=list(CHECKSUM_ALGORITHMS), default=DEFAULT_CHECKSUM,
+                        help='checksum algorithm of the blocks (ignored for an existing image)')
+    parser.add_argument('--verify', choices=VERIFY_POLICIES, default='always',
+                        help='verify block checksums on every Get, on a sample of the Gets, or once per write')
+    parser.add_argument('--rebuilding', action='store_true',
+                        help='this server replaces a failed one: its blocks are read as damaged until '
+                             'memoryfs_rebuild has rebuilt them')
+    args = parser.parse_args()
+
+    port_number = args.port
+    damaged_block = args.damaged_block
+
+    # Create server
+    with ThreadedXMLRPCServer(('localhost', port_number),
+                            requestHandler=RequestHandler, allow_none=True) as server:
+        # Initialize file system data
+        logging.info('Initializing data structures...')
+        if args.image is not None:
+            store = ImageBlockStore(args.image, args.num_blocks, args.block_size, args.checksum)
+        else:
+            store = MemoryBlockStore(args.num_blocks, args.block_size, args.checksum)
+        RawBlocks = DiskBlocks(store, args.rebuilding, args.verify)
+
+        server.register_instance(RawBlocks, allow_dotted_names=True)
+
+        # The binary protocol is served next to XML-RPC, from the same blocks
+        if args.binary_port is not None:
+            binary_server = BlockProtocolServer(('localhost', args.binary_port), RawBlocks)
+            threading.Thread(target=binary_server.serve_forever, daemon=True).start()
+
+        # Run the server's main loop
+        try:
+            server.serve_forever()
+        finally:
+            store.Close()
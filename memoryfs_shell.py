@@ -1,7 +1,12 @@
 import pickle, logging
 import sys
+import argparse
+import memoryfs_client
 from memoryfs_client import *
 
+# The geometry parameters (BLOCK_SIZE, MAX_FILE_SIZE, ...) are set when the file system is mounted,
+# so they are read through the memoryfs_client module rather than imported
+
 
 ## This class implements an interactive shell to navigate the file system
 
@@ -12,9 +17,7 @@ class FSShell():
         # we start in the root directory
         self.cwd = 0
         self.FileObject = file
-        inode_position = self.FileObject.FindAvailableInode()
-        if inode_position == 0:
-            self.FileObject.InitRootInode()
+        self.FileObject.InvalidateCache()
 
     # implements cd (change directory)
     def cd(self, dir):
@@ -31,55 +34,52 @@ class FSShell():
 
     # implements ls (lists files in directory)
     def ls(self):
-        # your code here
-        inode_number = InodeNumber(self.FileObject.RawBlocks, self.cwd)
-        inode_number.InodeNumberToInode()
-        offset = 0
-        scanned = 0
-
-        # Iterate over all data blocks indexed by directory inode, until we reach inode's size
-        while offset < inode_number.inode.size:
-
-            # Retrieve directory data block given current offset
-            b = inode_number.InodeNumberToBlock(offset)
-
-            # A directory data block has multiple (filename,inode) entries
-            # Iterate over file entries to search for matches
-            for i in range(0, FILE_ENTRIES_PER_DATA_BLOCK):
-
-                # don't search beyond file size
-                if inode_number.inode.size > scanned:
-                    scanned += FILE_NAME_DIRENTRY_SIZE
-
-                    # Extract padded MAX_FILENAME string as a bytearray from data block for comparison
-                    filestring = self.FileObject.HelperGetFilenameString(b, i)
-                    file_inodenumber = self.FileObject.HelperGetFilenameInodeNumber(b, i)
-                    file_inodeobj = InodeNumber(self.FileObject.RawBlocks, file_inodenumber)
-                    file_inodeobj.InodeNumberToInode()
-                    if file_inodeobj.inode.type == INODE_TYPE_DIR:
-                        print("[" + str(file_inodeobj.inode.refcnt) + "]:" + filestring.decode() + "/")
-                    else:
-                        print("[" + str(file_inodeobj.inode.refcnt) + "]:" + filestring.decode())
-
-            # Skip to the next block, back to while loop
-            offset += BLOCK_SIZE
+        lock = self.FileObject.locks.LockDirectory(self.cwd, shared=True)
+        try:
+            # All (filename,inode) entries of the directory, read in one batch
+            entries = self.FileObject.ReadDirectory(self.cwd)
+            if entries == -1:
+                print("ls: Error: directory cannot be read\n")
+                return -1
+            for filestring, file_inodenumber in entries:
+                file_inodeobj = InodeNumber(self.FileObject.RawBlocks, file_inodenumber)
+                file_inodeobj.InodeNumberToInode()
+                if file_inodeobj.inode.type == INODE_TYPE_DIR:
+                    print("[" + str(file_inodeobj.inode.refcnt) + "]:" + filestring.decode() + "/")
+                else:
+                    print("[" + str(file_inodeobj.inode.refcnt) + "]:" + filestring.decode())
+        finally:
+            self.FileObject.locks.Unlock(lock)
 
     # implements cat (print file contents)
     def cat(self, filename):
         filename = self.stripSeperator(filename)
-        file_inode_number = self.FileObject.Lookup(filename, self.cwd)
-        bytearray = self.FileObject.Read(file_inode_number, 0, MAX_FILE_SIZE)
-
-        if bytearray == -1:
+        file_inode_number = self.FileObject.GeneralPathToInodeNumber(filename, self.cwd)
+        if file_inode_number == -1:
+            print("cat: Error: '" + filename + "' not found\n")
+            return -1
+        file = self.FileObject.Open(file_inode_number, 'r')
+        if file == -1:
             print("cat: Error: '" + filename + "' Not a file\n")
             return -1
-        print(bytearray.decode())
+
+        # read a few stripes at a time, the file handle reads the next ones ahead
+        chunks = []
+        with file:
+            while True:
+                chunk = file.read(memoryfs_client.READAHEAD_STRIPES * file.stripe_size)
+                if chunk == -1:
+                    print("cat: Error: '" + filename + "' cannot be read\n")
+                    return -1
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        print(b''.join(chunks).decode())
 
     # implement ln (creates a hard link of target with name 'linkname')
+    # Link takes the locks of the current directory and of the target
     def ln(self, target, linkname):
-        #self.FileObject.ACQUIRE()
         self.FileObject.Link(target, linkname, self.cwd)
-        #self.FileObject.RELEASE()
 
     # implement mkdir (create new directory)
     def mkdir(self, dirname):
@@ -89,28 +89,28 @@ class FSShell():
             print("mkdir: cannot create directory: '" + dirname + "' file name exceeds maximum name size")
             return -1
 
-        #self.FileObject.ACQUIRE()
-        # Ensure it's not a duplicate - if Lookup returns anything other than -1
-        if self.FileObject.Lookup(dirname, self.cwd) != -1:
-            print("mkdir: cannot create directory '" + dirname + "': already exists")
-            #self.FileObject.RELEASE()
-            return -1
-
-        # Find if there is an available inode
-        inode_position = self.FileObject.FindAvailableInode()
-        if inode_position == -1:
-            print("mkdir: cannot create directory: no free inode available")
-            #self.FileObject.RELEASE()
-            return -1
-
-        # Find available slot in directory data block
-        fileentry_position = self.FileObject.FindAvailableFileEntry(self.cwd)
-        if fileentry_position == -1:
-            print("mkdir: cannot create directory: no entry available for another object")
-            #self.FileObject.RELEASE()
-            return -1
-        self.FileObject.Create(self.cwd, dirname, INODE_TYPE_DIR)
-        #self.FileObject.RELEASE()
+        # the directory lock keeps other clients from adding the same name in between
+        lock = self.FileObject.locks.LockDirectory(self.cwd)
+        try:
+            # Ensure it's not a duplicate - if Lookup returns anything other than -1
+            if self.FileObject.Lookup(dirname, self.cwd) != -1:
+                print("mkdir: cannot create directory '" + dirname + "': already exists")
+                return -1
+
+            # Find if there is an available inode
+            inode_position = self.FileObject.FindAvailableInode()
+            if inode_position == -1:
+                print("mkdir: cannot create directory: no free inode available")
+                return -1
+
+            # Find available slot in directory data block
+            fileentry_position = self.FileObject.FindAvailableFileEntry(self.cwd)
+            if fileentry_position == -1:
+                print("mkdir: cannot create directory: no entry available for another object")
+                return -1
+            self.FileObject.Create(self.cwd, dirname, INODE_TYPE_DIR)
+        finally:
+            self.FileObject.locks.Unlock(lock)
 
     # implement create (create new file)
     def create(self, filename):
@@ -121,56 +121,52 @@ class FSShell():
             print("create: cannot create file: '" + filename + "' file name exceeds maximum name size")
             return -1
 
-        #self.FileObject.ACQUIRE()
-        # Ensure it's not a duplicate - if Lookup returns anything other than -1
-        if self.FileObject.Lookup(filename, self.cwd) != -1:
-            print("create: cannot create file '" + filename + "': already exists")
-            #self.FileObject.RELEASE()
-            return -1
-
-        # Find if there is an available inode
-        inode_position = self.FileObject.FindAvailableInode()
-        if inode_position == -1:
-            print("create: cannot create file: no free inode available")
-            #self.FileObject.RELEASE()
-            return -1
-
-        # Find available slot in directory data block
-        fileentry_position = self.FileObject.FindAvailableFileEntry(self.cwd)
-        if fileentry_position == -1:
-            print("create: cannot create file: no entry available for another object")
-            #self.FileObject.RELEASE()
-            return -1
-
-        self.FileObject.Create(self.cwd, filename, INODE_TYPE_FILE)
-        #self.FileObject.RELEASE()
+        # the directory lock keeps other clients from adding the same name in between
+        lock = self.FileObject.locks.LockDirectory(self.cwd)
+        try:
+            # Ensure it's not a duplicate - if Lookup returns anything other than -1
+            if self.FileObject.Lookup(filename, self.cwd) != -1:
+                print("create: cannot create file '" + filename + "': already exists")
+                return -1
+
+            # Find if there is an available inode
+            inode_position = self.FileObject.FindAvailableInode()
+            if inode_position == -1:
+                print("create: cannot create file: no free inode available")
+                return -1
+
+            # Find available slot in directory data block
+            fileentry_position = self.FileObject.FindAvailableFileEntry(self.cwd)
+            if fileentry_position == -1:
+                print("create: cannot create file: no entry available for another object")
+                return -1
+
+            self.FileObject.Create(self.cwd, filename, INODE_TYPE_FILE)
+        finally:
+            self.FileObject.locks.Unlock(lock)
 
     # implement append (append string to the end of existing file)
     def append(self, filename, data):
-        #self.FileObject.ACQUIRE()
         filename = self.stripSeperator(filename)
-        file_inode_number = self.FileObject.Lookup(filename, self.cwd)
+        file_inode_number = self.FileObject.LockedLookup(filename, self.cwd)
 
         if file_inode_number == -1:
             print("append: Error: " + filename + " does not exist")
-            #self.FileObject.RELEASE()
             return -1
 
-        file_inode = InodeNumber(self.FileObject.RawBlocks, file_inode_number)
-        file_inode.InodeNumberToInode()
-
-        if file_inode.inode.type != INODE_TYPE_FILE:
+        # the file is locked while open, which keeps the end of file valid until the data is written
+        file = self.FileObject.Open(file_inode_number, 'a')
+        if file == -1:
             print("append: Error: " + filename + " not a file")
-            #self.FileObject.RELEASE()
             return -1
 
-
-        offset = file_inode.inode.size
-
         data_bytearray = bytes(data, 'utf-8')
 
-        bytes_written = self.FileObject.Write(file_inode_number, offset, data_bytearray)
-        #self.FileObject.RELEASE()
+        try:
+            bytes_written = file.write(data_bytearray)
+        finally:
+            if file.close() == -1:
+                bytes_written = -1
         if bytes_written == -1:
             print("append: can not append: space not available\n")
             return -1
@@ -184,64 +180,100 @@ class FSShell():
 
     def Interpreter(self):
         while (True):
+            # Write back dirty blocks before waiting for the next command. The caches are kept: unless this shell is
+            # the only client, commands take the locks of what they read, and the LockManager drops what is cached
+            # under a lock that another client took since (LockChanged)
+            self.FileObject.RawBlocks.Flush()
             command = input("[cwd=" + str(self.cwd) + "]:")
             splitcmd = command.split()
-            if splitcmd[0] == "cd":
-                if len(splitcmd) != 2:
-                    print("Error: cd requires one argument")
-                else:
-                    self.cd(splitcmd[1])
-            elif splitcmd[0] == "cat":
-                if len(splitcmd) != 2:
-                    print("Error: cat requires one argument")
-                else:
-                    self.cat(splitcmd[1])
-            elif splitcmd[0] == "ls":
-                self.ls()
-            elif splitcmd[0] == "exit":
-                return
-            elif splitcmd[0] == "ln":
-                if len(splitcmd) != 3:
-                    print("Error: ln requires two arguments")
-                else:
-                    self.ln(splitcmd[1], splitcmd[2])
-            elif splitcmd[0] == "mkdir":
-                if len(splitcmd) != 2:
-                    print("Error: mkdir requires one argument")
-                else:
-                    self.mkdir(splitcmd[1])
-            elif splitcmd[0] == "create":
-                if len(splitcmd) != 2:
-                    print("Error: create requires one argument")
-                else:
-                    self.create(splitcmd[1])
-            elif splitcmd[0] == "append":
-                if len(splitcmd) != 3:
-                    print("Error: create requires two arguments")
+            # a command fails, rather than the shell, when servers cannot be reached (e.g. fewer than a majority
+            # of the servers are up to take a lock) or when a lock of the command was lost
+            try:
+                if splitcmd[0] == "cd":
+                    if len(splitcmd) != 2:
+                        print("Error: cd requires one argument")
+                    else:
+                        self.cd(splitcmd[1])
+                elif splitcmd[0] == "cat":
+                    if len(splitcmd) != 2:
+                        print("Error: cat requires one argument")
+                    else:
+                        self.cat(splitcmd[1])
+                elif splitcmd[0] == "ls":
+                    self.ls()
+                elif splitcmd[0] == "exit":
+                    self.FileObject.RawBlocks.Flush()
+                    return
+                elif splitcmd[0] == "ln":
+                    if len(splitcmd) != 3:
+                        print("Error: ln requires two arguments")
+                    else:
+                        self.ln(splitcmd[1], splitcmd[2])
+                elif splitcmd[0] == "mkdir":
+                    if len(splitcmd) != 2:
+                        print("Error: mkdir requires one argument")
+                    else:
+                        self.mkdir(splitcmd[1])
+                elif splitcmd[0] == "create":
+                    if len(splitcmd) != 2:
+                        print("Error: create requires one argument")
+                    else:
+                        self.create(splitcmd[1])
+                elif splitcmd[0] == "append":
+                    if len(splitcmd) != 3:
+                        print("Error: create requires two arguments")
+                    else:
+                        self.append(splitcmd[1], splitcmd[2])
                 else:
-                    self.append(splitcmd[1], splitcmd[2])
-            else:
-                print("command " + splitcmd[0] + " not valid.\n")
+                    print("command " + splitcmd[0] + " not valid.\n")
+            except (OSError, LockLost) as e:
+                print("Error: " + str(e))
 
 
 if __name__ == "__main__":
     # Initialize file for logging
     # Changer logging level to INFO to remove debugging messages
     logging.basicConfig(filename='memoryfs.log', filemode='w', level=logging.DEBUG)
-    number_of_servers = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description='memoryfs shell')
+    parser.add_argument('number_of_servers', type=int)
+    parser.add_argument('servers', nargs='+', help='host:port of each block server')
+    # Geometry used to format a blank volume; the block size is the servers' block size
+    parser.add_argument('--num-blocks', type=int, default=None,
+                        help='number of virtual blocks (default: capacity of the servers)')
+    parser.add_argument('--num-inodes', type=int, default=MAX_NUM_INODES)
+    parser.add_argument('--inode-size', type=int, default=INODE_SIZE)
+    parser.add_argument('--protocol', choices=['xmlrpc', 'binary'], default='xmlrpc',
+                        help='binary: the servers are the binary protocol ports of the block servers')
+    parser.add_argument('--exclusive', action='store_true',
+                        help='this shell is the only client: take no locks')
+    args = parser.parse_args()
+
+    number_of_servers = args.number_of_servers
     server_url_list = []
     for i in range(0, number_of_servers):
-        server_info = sys.argv[i + 2].strip()
-        server_url_list.append("http://" + server_info)
+        server_info = args.servers[i].strip()
+        server_url_list.append(("block://" if args.protocol == 'binary' else "http://") + server_info)
 
     # Replace with your UUID, encoded as a byte array
     UUID = b'\x12\x34\x56\x78'
     server_url = 'http://localhost:8000'
     # Initialize file system data
     logging.info('Initializing data structures...')
-    RawBlocks = DiskBlocks(server_url_list)
-    # Load blocks from dump file
-    RawBlocks.InitializeBlocks(True, UUID)
+    # Unless this shell is the only client, file system updates are done under the locks of the LockManager
+    RawBlocks = DiskBlocks(server_url_list, parallel=True, cache_size=64, write_back=True, shared=not args.exclusive)
+    # Mount the file system, or format the volume if the servers are blank
+    mounted = RawBlocks.Mount()
+    if mounted == -1:
+        print("Error: the servers hold a volume of another layout version, or no file system: not mounting it")
+        sys.exit(1)
+    if mounted == 0:
+        num_blocks = args.num_blocks if args.num_blocks is not None else RawBlocks.Capacity()
+        SetGeometry(num_blocks, memoryfs_client.BLOCK_SIZE, args.num_inodes, args.inode_size)
+        RawBlocks.InitializeBlocks(True, UUID)
+        # the root directory is created with the volume, before other clients can mount it: a client finding
+        # inode 0 free on a mounted volume must not create it again over another client's
+        FileName(RawBlocks).InitRootInode()
+        RawBlocks.Flush()
     #
     # # Show file system information and contents of first few blocks
     RawBlocks.PrintFSInfo()
@@ -0,0 +1,85 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# The modules under test are in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import memoryfs_client
+
+# Seconds to wait for a server to accept connections
+START_TIMEOUT = 10
+
+
+## Returns a TCP port nobody listens on
+
+def FreePort():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+## Block servers started as memoryfs_server processes on free ports, with the given command line options
+## A server can be killed, and started again (blank, as blocks are kept in memory) with other options
+
+class BlockServers():
+    def __init__(self, count, *options):
+        self.options = list(options)
+        # a port released by FreePort may be handed out again: the servers would then be one and the same
+        self.ports = []
+        while len(self.ports) < count:
+            port = FreePort()
+            if port not in self.ports:
+                self.ports.append(port)
+        self.processes = [None] * count
+        for server in range(count):
+            self.Start(server)
+
+    def URLs(self):
+        return ['http://localhost:' + str(port) for port in self.ports]
+
+    def Start(self, server, *options):
+        self.processes[server] = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'memoryfs_server.py'), str(self.ports[server])] + self.options
+            + list(options), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('localhost', self.ports[server])).close()
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    def Kill(self, server):
+        if self.processes[server] is not None:
+            self.processes[server].kill()
+            self.processes[server].wait()
+            self.processes[server] = None
+
+    def Restart(self, server, *options):
+        self.Kill(server)
+        self.Start(server, *options)
+
+    def Stop(self):
+        for server in range(len(self.processes)):
+            self.Kill(server)
+
+
+## Restores the default geometry of memoryfs_client, which tests with another geometry change
+
+def DefaultGeometry():
+    memoryfs_client.SetGeometry(256, 128, 16, 16)
+
+
+## Waits until condition() is true, for at most timeout seconds; returns its last value
+
+def WaitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
@@ -0,0 +1,258 @@
+import os
+import unittest
+
+from servers import BlockServers, DefaultGeometry
+import memoryfs_client as mc
+
+
+## Files large enough for the single and double indirect blocks of their inode
+
+class IndirectBlocksTest(unittest.TestCase):
+    def tearDown(self):
+        self.servers.Stop()
+        DefaultGeometry()
+
+    def File(self, size):
+        RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+        RawBlocks.InitializeBlocks(True, b'\x12\x34\x56\x78')
+        FileObject = mc.FileName(RawBlocks)
+        FileObject.InitRootInode()
+        file_inode_number = FileObject.Create(0, 'file', mc.INODE_TYPE_FILE)
+        data = os.urandom(size)
+        self.assertEqual(FileObject.Write(file_inode_number, 0, data), size)
+        self.assertEqual(bytes(FileObject.Read(file_inode_number, 0, size)), data)
+        # the inode, read back from the servers
+        fresh = mc.FileName(mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0))
+        self.assertEqual(bytes(fresh.Read(file_inode_number, 0, size)), data)
+        file_inode = mc.InodeNumber(fresh.RawBlocks, file_inode_number)
+        file_inode.InodeNumberToInode()
+        self.assertEqual(file_inode.inode.size, size)
+        return file_inode.inode
+
+    def testSingleIndirect(self):
+        DefaultGeometry()
+        self.servers = BlockServers(3)
+        inode = self.File(30 * mc.BLOCK_SIZE + 5)
+        self.assertNotEqual(inode.block_numbers[mc.NUM_DIRECT_BLOCK_NUMBERS], 0)
+
+    def testDoubleIndirect(self):
+        mc.SetGeometry(1024, 128, 16, 32)
+        self.servers = BlockServers(3, '--num-blocks', '512')
+        size = (mc.NUM_DIRECT_BLOCK_NUMBERS + mc.POINTERS_PER_BLOCK + 3) * mc.BLOCK_SIZE
+        inode = self.File(size)
+        self.assertNotEqual(inode.block_numbers[mc.NUM_DIRECT_BLOCK_NUMBERS], 0)
+        self.assertNotEqual(inode.block_numbers[mc.NUM_DIRECT_BLOCK_NUMBERS + 1], 0)
+
+
+## A volume with a few files in its root directory, and a client without block cache: every block read is a call
+
+class FileSystemTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(3)
+        RawBlocks = mc.DiskBlocks(self.servers.URLs(), heartbeat_interval=0)
+        RawBlocks.InitializeBlocks(True, b'\x12\x34\x56\x78')
+        self.FileObject = mc.FileName(RawBlocks)
+        self.FileObject.InitRootInode()
+        # more entries than fit in a directory block
+        self.files = {}
+        for k in range(0, mc.FILE_ENTRIES_PER_DATA_BLOCK + 2):
+            self.files['file' + str(k)] = self.FileObject.Create(0, 'file' + str(k), mc.INODE_TYPE_FILE)
+
+    def tearDown(self):
+        self.servers.Stop()
+
+    def Calls(self):
+        return sum(health['calls'] for health in self.FileObject.RawBlocks.ServerHealth())
+
+
+## Directory lookups, served from the index of the directory once it is built
+
+class DirectoryIndexTest(FileSystemTest):
+    def testLookups(self):
+        self.FileObject.dentry_cache_size = 0
+        self.FileObject.dentry_cache.clear()
+        self.FileObject.directory_index = {}
+        self.assertEqual(self.FileObject.Lookup('file0', 0), self.files['file0'])
+        calls = self.Calls()
+        for name, inode_number in self.files.items():
+            self.assertEqual(self.FileObject.Lookup(name, 0), inode_number)
+        self.assertEqual(self.FileObject.Lookup('missing', 0), -1)
+        self.assertEqual(self.Calls(), calls)
+
+    def testCreateUpdatesIndex(self):
+        inode_number = self.FileObject.Create(0, 'new', mc.INODE_TYPE_FILE)
+        self.assertEqual(self.FileObject.directory_index[0][b'new'.ljust(mc.MAX_FILENAME, b'\x00')], inode_number)
+        # the index of a client that reads the directory from the servers
+        self.assertEqual(self.FileObject.DirectoryIndex(0), mc.FileName(self.FileObject.RawBlocks).DirectoryIndex(0))
+
+    def testNotADirectory(self):
+        self.assertEqual(self.FileObject.Lookup('file0', self.files['file0']), -1)
+        self.assertNotIn(self.files['file0'], self.FileObject.directory_index)
+
+
+## Path resolution through the dentry cache: (directory, name) -> inode number, names known not to exist included
+
+class DentryCacheTest(FileSystemTest):
+    def testHitsAndMisses(self):
+        self.FileObject.dentry_cache.clear()
+        self.assertEqual(self.FileObject.Lookup('file1', 0), self.files['file1'])
+        self.assertEqual(self.FileObject.Lookup('missing', 0), -1)
+        self.assertEqual(dict(self.FileObject.dentry_cache), {(0, 'file1'): self.files['file1'], (0, 'missing'): -1})
+        # served before the directory index
+        self.FileObject.directory_index = {}
+        calls = self.Calls()
+        self.assertEqual(self.FileObject.Lookup('file1', 0), self.files['file1'])
+        self.assertEqual(self.FileObject.Lookup('missing', 0), -1)
+        self.assertEqual(self.Calls(), calls)
+        self.assertEqual(self.FileObject.directory_index, {})
+
+    def testEviction(self):
+        self.FileObject.dentry_cache.clear()
+        self.FileObject.dentry_cache_size = 2
+        for name in ('file0', 'file1', 'file0', 'file2'):
+            self.FileObject.Lookup(name, 0)
+        # least recently used first
+        self.assertEqual(list(self.FileObject.dentry_cache), [(0, 'file0'), (0, 'file2')])
+
+    def testCreateDropsMissingName(self):
+        self.assertEqual(self.FileObject.Lookup('new', 0), -1)
+        inode_number = self.FileObject.Create(0, 'new', mc.INODE_TYPE_FILE)
+        self.assertEqual(self.FileObject.Lookup('new', 0), inode_number)
+
+    def testPaths(self):
+        dir = self.FileObject.Create(0, 'dir', mc.INODE_TYPE_DIR)
+        file_inode_number = self.FileObject.Create(dir, 'file', mc.INODE_TYPE_FILE)
+        self.assertEqual(self.FileObject.GeneralPathToInodeNumber('/dir/file', 0), file_inode_number)
+        self.assertEqual(self.FileObject.GeneralPathToInodeNumber('file', dir), file_inode_number)
+        self.assertEqual(self.FileObject.GeneralPathToInodeNumber('/dir/missing/file', 0), -1)
+        self.assertEqual(self.FileObject.dentry_cache[(dir, 'file')], file_inode_number)
+        # only the names of the invalidated directory are dropped
+        self.FileObject.InvalidateDirectory(dir)
+        self.assertNotIn((dir, 'file'), self.FileObject.dentry_cache)
+        self.assertEqual(self.FileObject.dentry_cache[(0, 'dir')], dir)
+        self.assertNotIn(dir, self.FileObject.directory_index)
+        self.assertIn(0, self.FileObject.directory_index)
+
+
+## Inodes loaded from the inode table blocks decoded by the block layer
+
+class InodeTableTest(FileSystemTest):
+    def testUnreadableBlock(self):
+        self.FileObject.RawBlocks.InvalidateCache()
+        # two servers of three are down: the inode table blocks cannot be rebuilt
+        self.servers.Kill(1)
+        self.servers.Kill(2)
+        inode = mc.InodeNumber(self.FileObject.RawBlocks, self.files['file0'])
+        self.assertEqual(inode.InodeNumberToInode(), -1)
+        self.assertEqual(inode.inode.type, mc.INODE_TYPE_INVALID)
+        self.assertEqual(self.FileObject.RawBlocks.decoded_blocks, {})
+        self.assertEqual(self.FileObject.Read(self.files['file0'], 0, 10), -1)
+
+
+## Next-fit allocation of data blocks from the free bitmap
+
+class AllocatorTest(FileSystemTest):
+    def Used(self, block_number):
+        bitmap_index = block_number // mc.FREEBITMAP_BITS_PER_BLOCK
+        bitmap = self.FileObject.RawBlocks.Get(mc.FREEBITMAP_BLOCK_OFFSET + bitmap_index)
+        bit = block_number % mc.FREEBITMAP_BITS_PER_BLOCK
+        return (bitmap[bit // 8] >> (bit % 8)) & 1 == 1
+
+    def testContiguous(self):
+        first = self.FileObject.AllocateDataBlocks(5)
+        self.assertEqual(first, list(range(first[0], first[0] + 5)))
+        # the next allocation resumes after the last one
+        self.assertEqual(self.FileObject.AllocateDataBlocks(2), [first[-1] + 1, first[-1] + 2])
+        self.assertTrue(all(self.Used(block_number) for block_number in first))
+        # a second client, whose free space summary is loaded from the bitmap, allocates other blocks
+        other = mc.FileName(self.FileObject.RawBlocks).AllocateDataBlocks(3)
+        self.assertFalse(set(other) & set(range(first[0], first[-1] + 3)))
+
+
+## Open files: blocks read ahead of sequential reads, writes buffered and written out in whole stripes
+
+class FileHandleTest(FileSystemTest):
+    def setUp(self):
+        FileSystemTest.setUp(self)
+        self.inode_number = self.files['file0']
+        self.data = bytes(range(256)) * (4 * mc.BLOCK_SIZE // 256 * len(self.servers.URLs()))
+        file = self.FileObject.Open(self.inode_number, 'r+')
+        self.assertEqual(file.write(self.data), len(self.data))
+        self.assertEqual(file.close(), 0)
+
+    def testReadAhead(self):
+        file = self.FileObject.Open(self.inode_number, 'r')
+        self.assertEqual(file.write(b'a'), -1)
+        self.assertEqual(file.read(mc.BLOCK_SIZE), self.data[:mc.BLOCK_SIZE])
+        # the blocks of the next stripes are read in the background
+        self.assertEqual(sorted(file.readahead), list(range(1, 1 + file.readahead_blocks)))
+        for future, i in file.readahead.values():
+            future.result()
+        # and the next sequential read finds them
+        requested = []
+        GetMany = self.FileObject.RawBlocks.GetMany
+        self.FileObject.RawBlocks.GetMany = lambda block_numbers: requested.extend(block_numbers) or \
+            GetMany(block_numbers)
+        self.assertEqual(file.read(3 * mc.BLOCK_SIZE), self.data[mc.BLOCK_SIZE:4 * mc.BLOCK_SIZE])
+        self.assertEqual(requested, [])
+        self.assertEqual(file.read(), self.data[4 * mc.BLOCK_SIZE:])
+        self.assertEqual(file.read(), b'')
+        self.assertEqual(file.close(), 0)
+
+    def testWriteBuffer(self):
+        file = self.FileObject.Open(self.inode_number, 'r+')
+        calls = self.Calls()
+        self.assertEqual(file.write(b'a' * 100), 100)
+        self.assertEqual(self.Calls(), calls)
+        # a full buffer is written out in whole stripes, the rest stays buffered
+        self.assertEqual(file.write(b'b' * file.write_buffer_size), file.write_buffer_size)
+        end = 100 + file.write_buffer_size
+        self.assertEqual(file.write_offset, end // file.stripe_size * file.stripe_size)
+        self.assertEqual(len(file.write_data), end % file.stripe_size)
+        # reads see the buffered data
+        self.assertEqual(file.seek(0), 0)
+        self.assertEqual(file.read(end), b'a' * 100 + b'b' * file.write_buffer_size)
+        self.assertEqual(file.write_data, b'')
+        self.assertEqual(file.close(), 0)
+        self.assertEqual(file.close(), 0)
+
+    def testSeek(self):
+        with self.FileObject.Open(self.inode_number, 'r+') as file:
+            self.assertEqual(file.seek(-4, 2), len(self.data) - 4)
+            self.assertEqual(file.read(), self.data[-4:])
+            self.assertEqual(file.seek(1, 1), -1)
+            self.assertEqual(file.tell(), len(self.data))
+            self.assertEqual(file.seek(2), 2)
+            self.assertEqual(file.write(b'xy'), 2)
+            self.assertEqual(file.seek(-4, 1), 0)
+            self.assertEqual(file.read(6), self.data[:2] + b'xy' + self.data[4:6])
+        # appends go to the end of the file, whatever the position
+        with self.FileObject.Open(self.inode_number, 'a') as file:
+            file.seek(0)
+            self.assertEqual(file.write(b'z'), 1)
+            self.assertEqual(file.tell(), len(self.data) + 1)
+        file = self.FileObject.Open(self.inode_number, 'r')
+        self.assertEqual(file.read(), self.data[:2] + b'xy' + self.data[4:] + b'z')
+        file.close()
+
+    def testFailedFlush(self):
+        file = self.FileObject.Open(self.inode_number, 'r+')
+        self.assertEqual(file.write(b'x' * 10), 10)
+        self.FileObject.WriteInode = lambda file_inode, offset, data: -1
+        self.assertEqual(file.seek(0), 0)
+        self.assertEqual(file.read(), -1)
+        self.assertEqual(file.readinto(bytearray(10)), -1)
+        self.assertEqual(file.close(), -1)
+
+    def testUnreadableBlock(self):
+        file = self.FileObject.Open(self.inode_number, 'r')
+        # two servers of three are down: the blocks cannot be rebuilt
+        self.servers.Kill(1)
+        self.servers.Kill(2)
+        self.assertEqual(file.read(), -1)
+        self.assertEqual(file.close(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
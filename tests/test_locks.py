@@ -0,0 +1,223 @@
+import threading
+import time
+import unittest
+
+from servers import BlockServers, DefaultGeometry, WaitFor
+import memoryfs_client as mc
+
+
+## Lock service: locks held on a majority of the servers, handed out first come first served, with leases that
+## the client renews and that expire when it does not
+
+class LockTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(3)
+
+    def tearDown(self):
+        self.servers.Stop()
+
+    def Client(self, **options):
+        return mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0, **options)
+
+    def testFifoOrder(self):
+        holder = self.Client()
+        self.assertTrue(holder.AcquireLock('lock'))
+        order = []
+
+        def Waiter(k):
+            client = self.Client()
+            client.AcquireLock('lock')
+            order.append(k)
+            client.ReleaseLock('lock')
+
+        # waiters queue up in order on the servers
+        waiters = []
+        for k in range(4):
+            waiters.append(threading.Thread(target=Waiter, args=(k,)))
+            waiters[-1].start()
+            time.sleep(0.2)
+        self.assertTrue(holder.ReleaseLock('lock'))
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(order, [0, 1, 2, 3])
+
+    def testSharedLocks(self):
+        readers = [self.Client(), self.Client()]
+        for reader in readers:
+            self.assertTrue(reader.AcquireLock('lock', shared=True, timeout=1))
+        writer = self.Client()
+        self.assertFalse(writer.AcquireLock('lock', timeout=0.3))
+        for reader in readers:
+            reader.ReleaseLock('lock')
+        self.assertTrue(writer.AcquireLock('lock', timeout=1))
+
+    def testLeaseExpiry(self):
+        # a client that died holding the lock: nobody renews its lease
+        for server in self.Client().servers:
+            self.assertTrue(server.Acquire('lock', 'dead client', 0.3, 0, False))
+        client = self.Client()
+        start = time.monotonic()
+        self.assertTrue(client.AcquireLock('lock', timeout=5))
+        self.assertLess(time.monotonic() - start, 2)
+
+    def testQuorum(self):
+        self.servers.Kill(2)
+        client = self.Client()
+        # a majority is up: the lock is held on it, and excludes other clients
+        self.assertTrue(client.AcquireLock('lock'))
+        self.assertFalse(self.Client().AcquireLock('lock', timeout=0.3))
+        client.ReleaseLock('lock')
+        self.servers.Kill(1)
+        with self.assertRaises(mc.ServerUnavailable):
+            self.Client().AcquireLock('lock')
+
+    def testLeaseRenewal(self):
+        holder = self.Client()
+        self.assertTrue(holder.AcquireLock('lock', lease=0.5))
+        # held well past its lease
+        self.assertFalse(self.Client().AcquireLock('lock', timeout=1.5))
+        self.assertTrue(holder.HoldsLock('lock'))
+        self.assertTrue(holder.ReleaseLock('lock'))
+
+    def testLostLock(self):
+        holder = self.Client()
+        self.assertTrue(holder.AcquireLock('lock', lease=0.6))
+        # a majority of the servers is gone: the lease cannot be renewed
+        self.servers.Kill(1)
+        self.servers.Kill(2)
+        self.assertTrue(WaitFor(lambda: not holder.HoldsLock('lock')))
+        with self.assertRaises(mc.LockLost):
+            holder.WriteBlocks([(5, bytearray(mc.BLOCK_SIZE))])
+        self.assertFalse(holder.ReleaseLock('lock'))
+        self.assertEqual(holder.lost_locks, set())
+
+    def testVersions(self):
+        client = self.Client()
+        client.AcquireLock('lock')
+        # never held before
+        self.assertTrue(client.LockChanged('lock'))
+        client.ReleaseLock('lock')
+        client.AcquireLock('lock')
+        self.assertFalse(client.LockChanged('lock'))
+        client.ReleaseLock('lock')
+        other = self.Client()
+        other.AcquireLock('lock')
+        other.ReleaseLock('lock')
+        client.AcquireLock('lock')
+        self.assertTrue(client.LockChanged('lock'))
+        client.ReleaseLock('lock')
+        # shared holders change nothing
+        other.AcquireLock('lock', shared=True)
+        other.ReleaseLock('lock')
+        client.AcquireLock('lock')
+        self.assertFalse(client.LockChanged('lock'))
+        client.ReleaseLock('lock')
+
+    def testCompareAndSwap(self):
+        client = self.Client()
+        self.assertEqual(client.CompareAndSwap('word', '', 'a'), '')
+        self.assertEqual(client.CompareAndSwap('word', '', 'b'), 'a')
+        self.assertEqual(self.Client().CompareAndSwap('word', 'a', 'c'), 'a')
+        self.assertEqual(client.CompareAndSwap('word', 'c', 'c'), 'c')
+
+
+## Clients sharing a file system see each other's changes through the locks of the LockManager, and keep their
+## caches across locks nobody else took
+
+class SharedFileSystemTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(3)
+        self.clients = []
+        for k in range(2):
+            RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, cache_size=256, write_back=True,
+                                      shared=True, heartbeat_interval=0)
+            if k == 0:
+                RawBlocks.InitializeBlocks(True, b'\x12\x34\x56\x78')
+                mc.FileName(RawBlocks).InitRootInode()
+                RawBlocks.Flush()
+            self.clients.append(mc.FileName(RawBlocks))
+
+    def tearDown(self):
+        self.servers.Stop()
+
+    def Create(self, FileObject, name):
+        lock = FileObject.locks.LockDirectory(0)
+        try:
+            return FileObject.Create(0, name, mc.INODE_TYPE_FILE)
+        finally:
+            FileObject.locks.Unlock(lock)
+
+    def Append(self, FileObject, file_inode_number, data):
+        with FileObject.Open(file_inode_number, 'a') as file:
+            self.assertEqual(file.write(data), len(data))
+
+    def Cat(self, FileObject, file_inode_number):
+        with FileObject.Open(file_inode_number) as file:
+            return bytes(file.read())
+
+    def testCachesAndVisibility(self):
+        a, b = self.clients
+        file_inode_number = self.Create(a, 'file')
+        self.Append(a, file_inode_number, b'hello')
+        self.assertEqual(self.Cat(a, file_inode_number), b'hello')
+        # nobody else took the lock: served from the cache
+        cached = dict(a.RawBlocks.cache)
+        self.assertEqual(self.Cat(a, file_inode_number), b'hello')
+        self.assertEqual(dict(a.RawBlocks.cache), cached)
+
+        self.Append(b, b.LockedLookup('file', 0), b' world')
+        self.assertEqual(self.Cat(a, file_inode_number), b'hello world')
+        self.Create(b, 'other')
+        self.assertNotEqual(a.LockedLookup('other', 0), -1)
+
+    def testUpgrade(self):
+        file_inode_number = self.Create(self.clients[0], 'file')
+        for client in self.clients:
+            client.locks.LockDirectory(0, shared=True)
+            self.assertEqual(client.LockedLookup('file', 0), file_inode_number)
+
+        # both clients upgrade the directory lock they share, then give it back
+        created = []
+
+        def Upgrade(FileObject, name):
+            FileObject.locks.LockDirectory(0)
+            created.append(FileObject.Create(0, name, mc.INODE_TYPE_FILE))
+            FileObject.locks.Unlock('dir:0')
+            FileObject.locks.Unlock('dir:0')
+
+        threads = [threading.Thread(target=Upgrade, args=(client, name), daemon=True)
+                   for client, name in zip(self.clients, ['a', 'b'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(created), 2)
+        # each one saw the file the other created, if it came second
+        for client in self.clients:
+            self.assertEqual(sorted(client.LockedLookup(name, 0) for name in ['a', 'b', 'file']),
+                             sorted(created + [file_inode_number]))
+
+    def testOpenFileLostLock(self):
+        a, b = self.clients
+        file_inode_number = self.Create(a, 'file')
+        file = a.Open(file_inode_number, 'r+')
+        self.assertEqual(file.write(b'a' * 10), 10)
+        self.assertEqual(file.flush(), 0)
+        # the lease ran out on the servers (e.g. a long pause of the client) and b took the lock
+        name = 'inode:' + str(file_inode_number)
+        for server in a.RawBlocks.servers:
+            server.Release(name, a.RawBlocks.owner)
+        self.Append(b, file_inode_number, b'b')
+        a.RawBlocks.held_locks[name][3] = 0
+        a.RawBlocks.renewer_wakeup.set()
+        self.assertTrue(WaitFor(lambda: not a.locks.Held(name)))
+        # the file handle does not write over the changes of b
+        file.write(b'c')
+        self.assertEqual(file.close(), -1)
+        self.assertEqual(self.Cat(b, file_inode_number), b'a' * 10 + b'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
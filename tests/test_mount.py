@@ -0,0 +1,43 @@
+import pickle
+import unittest
+
+from servers import BlockServers, DefaultGeometry
+import memoryfs_client as mc
+
+
+## Mount: the superblock gives the geometry of the file system, and the version of its layout
+
+class MountTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(3)
+        self.RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+
+    def tearDown(self):
+        self.servers.Stop()
+        DefaultGeometry()
+
+    def testBlank(self):
+        self.assertEqual(self.RawBlocks.Mount(), 0)
+
+    def testFormatted(self):
+        mc.SetGeometry(512, 128, 32, 16)
+        self.RawBlocks.InitializeBlocks(True, b'\x12\x34\x56\x78')
+        DefaultGeometry()
+        self.assertEqual(self.RawBlocks.Mount(), 1)
+        self.assertEqual((mc.TOTAL_NUM_BLOCKS, mc.MAX_NUM_INODES), (512, 32))
+
+    def testLayoutVersion(self):
+        self.RawBlocks.InitializeBlocks(True, b'\x12\x34\x56\x78')
+        for superblock in ([256, 128, 16, 16], [256, 128, 16, 16, mc.FORMAT_VERSION + 1]):
+            with self.subTest(superblock=superblock):
+                self.RawBlocks.Put(1, pickle.dumps(superblock))
+                self.assertEqual(self.RawBlocks.Mount(), -1)
+
+    def testNotASuperblock(self):
+        self.RawBlocks.Put(1, b'garbage')
+        self.assertEqual(self.RawBlocks.Mount(), -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import unittest
+
+# puts the repository root on the path
+import servers
+import memoryfs_client as mc
+
+
+## Reference XOR of blocks, byte by byte
+
+def Xor(*blocks):
+    result = bytearray(max(len(block) for block in blocks))
+    for block in blocks:
+        for i in range(0, len(block)):
+            result[i] ^= block[i]
+    return result
+
+
+## XOR engine: whole-block integers, or NumPy (when installed) from NUMPY_XOR_MIN_SIZE Bytes up
+
+class XorTest(unittest.TestCase):
+    def Check(self):
+        for size in (16, 128, mc.NUMPY_XOR_MIN_SIZE, 4096):
+            with self.subTest(size=size):
+                a, b, c = os.urandom(size), os.urandom(size), os.urandom(size // 2)
+                self.assertEqual(mc.xor_blocks(a, b), Xor(a, b))
+                # a shorter block is padded with zeroes
+                self.assertEqual(mc.xor_blocks(c, a), Xor(a, c))
+                accumulator = bytearray(a)
+                self.assertIs(mc.xor_into(accumulator, c), accumulator)
+                self.assertEqual(accumulator, Xor(a, c))
+                self.assertEqual(mc.xor_many([a, b, c], size), Xor(a, b, c))
+                self.assertEqual(mc.xor_many([], size), bytes(size))
+
+    def testWithoutNumpy(self):
+        numpy = mc.numpy
+        mc.numpy = None
+        try:
+            self.Check()
+        finally:
+            mc.numpy = numpy
+
+    @unittest.skipIf(mc.numpy is None, 'NumPy is not installed')
+    def testWithNumpy(self):
+        self.Check()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+import json
+import socket
+import threading
+import time
+import unittest
+
+from servers import WaitFor
+from memoryfs_protocol import *
+import memoryfs_server as ms
+
+
+## Accepts one connection on listener, reads count requests, then answers them in reverse order with their payload,
+## and closes the connection
+
+def ReverseServer(listener, count):
+    connection, address = listener.accept()
+    frames = [RecvFrame(connection) for k in range(count)]
+    for request_id, opcode, payload in reversed(frames):
+        SendFrame(connection, request_id, STATUS_OK, [payload])
+    connection.close()
+
+
+## Client end of the binary protocol: pipelined requests matched to their responses by request id
+
+class BlockClientTest(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.create_server(('localhost', 0))
+        self.client = BlockClient('localhost', self.listener.getsockname()[1], timeout=5)
+
+    def tearDown(self):
+        self.client.Close()
+        self.listener.close()
+
+    def Serve(self, target, *args):
+        server = threading.Thread(target=target, args=(self.listener,) + args)
+        server.start()
+        return server
+
+    def testPipelining(self):
+        server = self.Serve(ReverseServer, 5)
+        # all requests are sent before the first response comes back
+        futures = [self.client.Submit(OP_GET, [BLOCK_NUMBER.pack(k)], bytes) for k in range(5)]
+        self.assertEqual([future.result(5) for future in futures], [BLOCK_NUMBER.pack(k) for k in range(5)])
+        server.join()
+
+    def testReconnect(self):
+        server = self.Serve(ReverseServer, 1)
+        self.assertEqual(self.client.Get(1), BLOCK_NUMBER.pack(1))
+        server.join()
+        # the server closed the connection: the next request opens a new one
+        self.assertTrue(WaitFor(lambda: self.client.socket is None))
+        server = self.Serve(ReverseServer, 1)
+        self.assertEqual(self.client.Get(2), BLOCK_NUMBER.pack(2))
+        server.join()
+
+    def testPendingRequestsFail(self):
+        def Server(listener):
+            connection, address = listener.accept()
+            RecvFrame(connection)
+            connection.close()
+
+        server = self.Serve(Server)
+        with self.assertRaises(ConnectionError):
+            self.client.Get(1)
+        server.join()
+
+
+## Binary protocol against a block server in process: block requests, and the other methods through OP_CALL
+
+class BlockProtocolServerTest(unittest.TestCase):
+    def setUp(self):
+        self.blocks = ms.DiskBlocks(ms.MemoryBlockStore(64, 128))
+        self.server = ms.BlockProtocolServer(('localhost', 0), self.blocks)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = BlockClient('localhost', self.server.server_address[1], timeout=5)
+
+    def tearDown(self):
+        self.client.Close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testBlocks(self):
+        self.assertEqual(self.client.PutMany([[1, b'a' * 128], [2, b'b']]), 0)
+        self.assertEqual(self.client.GetMany([2, 1, 3]), [b'b' + bytes(127), b'a' * 128, bytes(128)])
+        self.assertEqual(self.client.PutRange(1, 4, b'zz'), b'aa')
+        self.assertEqual(self.client.GetRange(1, 3, 4), b'azza')
+        self.assertEqual(self.client.XorMany([[2, b'\x03']]), [])
+        self.assertEqual(self.client.Get(2), b'a' + bytes(127))
+        # a block that fails its checksum
+        self.blocks.store.block[1][0] ^= 1
+        self.assertEqual(self.client.Get(1), -1)
+        self.assertEqual(self.client.GetMany([1, 2]), [-1, b'a' + bytes(127)])
+        self.assertEqual(self.client.XorMany([[1, b'\x01'], [2, b'\x01']]), [1])
+        # a repair only writes the blocks that are still damaged
+        self.assertEqual(self.client.RepairMany([[1, b'c' * 128], [2, b'c' * 128]]), [2])
+        self.assertEqual(self.client.GetMany([1, 2]), [b'c' * 128, b'`' + bytes(127)])
+
+    def testCall(self):
+        self.assertEqual(self.client.Geometry(), [64, 128])
+        self.assertTrue(self.client.Acquire('lock', 'a', 10, 0, False))
+        self.assertEqual(self.client.CompareAndSwap('word', '', 'x'), '')
+        self.assertEqual(self.client.CompareAndSwap('word', '', 'y'), 'x')
+        for name in ('NoSuchMethod', '__init__'):
+            with self.assertRaises(BlockProtocolError):
+                self.client.CallMethod(name, [])
+
+    def testCallsDoNotHoldUpBlocks(self):
+        self.blocks.Acquire('lock', 'a', 10, 0)
+        waiting = self.client.Submit(OP_CALL, [json.dumps(['Acquire', ['lock', 'b', 10, 1, False]]).encode()],
+                                     json.loads)
+        # served while the lock request waits on the same connection
+        start = time.monotonic()
+        self.assertEqual(self.client.Get(5), bytes(128))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertFalse(waiting.done())
+        self.assertFalse(waiting.result(5))
+
+
+## A fake block server for ServerPool: it counts the connections opened to it and the calls running at once, and
+## fails calls while it is down
+
+class FakeServer():
+    def __init__(self):
+        self.down = False
+        self.connections = 0
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def Connect(self, timeout):
+        with self.lock:
+            self.connections += 1
+        return FakeConnection(self)
+
+
+class FakeConnection():
+    def __init__(self, server):
+        self.server = server
+        self.closed = False
+
+    def Geometry(self):
+        if self.server.down or self.closed:
+            raise ConnectionResetError('fake server is down')
+        return [16, 128]
+
+    def Sleep(self, seconds):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.most_active = max(self.server.most_active, self.server.active)
+        time.sleep(seconds)
+        with self.server.lock:
+            self.server.active -= 1
+        return seconds
+
+    def Close(self):
+        self.closed = True
+
+
+## Pool of persistent connections to a server: connections are opened once and reused, up to the size of the pool
+
+class ServerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.pool = ServerPool(self.server.Connect, 2, 5, 'fake')
+
+    def testReuse(self):
+        for k in range(5):
+            self.assertEqual(self.pool.Geometry(), [16, 128])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.pool.Health()['calls'], 5)
+        self.assertEqual(self.pool.Health()['connections'], 1)
+
+    def testConcurrentCalls(self):
+        threads = [threading.Thread(target=self.pool.Sleep, args=(0.2,)) for k in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # at most size calls at once, each on a connection of its own
+        self.assertEqual(self.server.most_active, 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def testFailedConnectionDiscarded(self):
+        self.pool.Geometry()
+        connection = self.pool.idle[0]
+        connection.closed = True
+        with self.assertRaises(ConnectionResetError):
+            self.pool.Geometry()
+        self.assertEqual(len(self.pool.idle), 0)
+        self.assertEqual(self.pool.Geometry(), [16, 128])
+        self.assertEqual(self.server.connections, 2)
+        # a single failure does not mark the server down
+        self.assertEqual(self.pool.Health()['state'], BREAKER_CLOSED)
+
+
+## Circuit breaker of the server pool: a server that failed BREAKER_FAILURES calls in a row is down, and calls fail
+## at once until a probe, after a backoff that doubles with each failed probe, finds it up again
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.pool = ServerPool(self.server.Connect, 2, 5, 'fake')
+
+    def MarkDown(self):
+        self.server.down = True
+        for k in range(BREAKER_FAILURES):
+            with self.assertRaises(ConnectionError):
+                self.pool.Geometry()
+        self.assertEqual(self.pool.Health()['state'], BREAKER_OPEN)
+
+    ## Makes the next probe due at once
+
+    def Probe(self):
+        self.pool.next_probe = 0
+        self.assertTrue(self.pool.Available())
+
+    def testFailFast(self):
+        self.MarkDown()
+        self.assertFalse(self.pool.Available())
+        connections = self.server.connections
+        with self.assertRaises(ServerUnavailable):
+            self.pool.Geometry()
+        self.assertEqual(self.server.connections, connections)
+
+    def testProbeBackoff(self):
+        self.MarkDown()
+        self.assertEqual(self.pool.backoff, PROBE_BACKOFF_MIN)
+        self.Probe()
+        with self.assertRaises(ConnectionError):
+            self.pool.Geometry()
+        self.assertEqual(self.pool.backoff, 2 * PROBE_BACKOFF_MIN)
+        self.assertFalse(self.pool.Available())
+        for k in range(20):
+            self.Probe()
+            with self.assertRaises(ConnectionError):
+                self.pool.Geometry()
+        self.assertEqual(self.pool.backoff, PROBE_BACKOFF_MAX)
+        # the server is back: the probe closes the breaker
+        self.server.down = False
+        self.Probe()
+        self.assertEqual(self.pool.Geometry(), [16, 128])
+        self.assertEqual(self.pool.Health()['state'], BREAKER_CLOSED)
+        self.assertEqual(self.pool.backoff, PROBE_BACKOFF_MIN)
+
+    def testAdmit(self):
+        self.MarkDown()
+        self.server.down = False
+        self.pool.admit = lambda connection: False
+        self.Probe()
+        with self.assertRaises(ServerUnavailable):
+            self.pool.Geometry()
+        self.assertEqual(self.pool.Health()['state'], BREAKER_OPEN)
+        self.pool.admit = lambda connection: connection.Geometry() == [16, 128]
+        self.Probe()
+        self.assertEqual(self.pool.Geometry(), [16, 128])
+        self.assertEqual(self.pool.Health()['state'], BREAKER_CLOSED)
+
+    def testHeartbeat(self):
+        self.server.down = True
+        for k in range(BREAKER_FAILURES):
+            self.pool.Heartbeat(0)
+        self.assertEqual(self.pool.Health()['state'], BREAKER_OPEN)
+        self.server.down = False
+        # not probed before the backoff
+        self.pool.Heartbeat(0)
+        self.assertEqual(self.pool.Health()['state'], BREAKER_OPEN)
+        self.Probe()
+        self.pool.Heartbeat(0)
+        self.assertEqual(self.pool.Health()['state'], BREAKER_CLOSED)
+
+    def testMarkDown(self):
+        self.pool.Geometry()
+        connection = self.pool.idle[0]
+        self.pool.MarkDown('test')
+        self.assertEqual(self.pool.Health()['state'], BREAKER_OPEN)
+        self.assertTrue(connection.closed)
+        self.assertEqual(len(self.pool.idle), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import unittest
+
+from servers import BlockServers, DefaultGeometry
+import memoryfs_client as mc
+
+
+## Block operations of a client over several servers: a batch of blocks costs one call per server
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(4)
+        self.RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+
+    def tearDown(self):
+        self.servers.Stop()
+
+    def Calls(self):
+        return [health['calls'] for health in self.RawBlocks.ServerHealth()]
+
+    def testOneCallPerServer(self):
+        blocks = [(block_number, bytearray([block_number]) * mc.BLOCK_SIZE) for block_number in range(20)]
+        before = self.Calls()
+        self.RawBlocks.WriteBlocks(blocks)
+        # the old data of the two partial stripes is read, then data, parity and deltas are written
+        self.assertTrue(all(after - calls <= 3 for after, calls in zip(self.Calls(), before)))
+        before = self.Calls()
+        self.assertEqual(self.RawBlocks.ReadBlocks([block_number for block_number, data in blocks]),
+                         [data for block_number, data in blocks])
+        self.assertEqual([after - calls for after, calls in zip(self.Calls(), before)], [1, 1, 1, 1])
+
+
+## RAID-5 over block servers: reads and writes with a server down or a damaged block
+
+class RaidTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(4)
+        self.RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+
+    def tearDown(self):
+        self.servers.Stop()
+        DefaultGeometry()
+
+    def Blocks(self, fill):
+        return [(block_number, bytearray([(block_number + fill) % 256]) * mc.BLOCK_SIZE)
+                for block_number in range(48)]
+
+    def ReadAll(self):
+        return self.RawBlocks.ReadBlocks([block_number for block_number, data in self.Blocks(0)])
+
+    def testDegradedRead(self):
+        blocks = self.Blocks(1)
+        self.RawBlocks.WriteBlocks(blocks)
+        self.servers.Kill(1)
+        # the blocks of the dead server are rebuilt from the rest of their stripe
+        self.assertEqual(self.ReadAll(), [data for block_number, data in blocks])
+
+    def testDegradedWrite(self):
+        self.RawBlocks.WriteBlocks(self.Blocks(1))
+        self.servers.Kill(2)
+        # partial stripes (read-modify-write of the parity) and full stripes, with a server down
+        blocks = self.Blocks(7)
+        self.RawBlocks.WriteBlocks(blocks[:5])
+        self.RawBlocks.WriteBlocks(blocks[5:])
+        self.assertEqual(self.ReadAll(), [data for block_number, data in blocks])
+
+    ## Two blocks of a stripe, the first one on server 1
+
+    def StripeBlocks(self):
+        first = [block_number for block_number in range(48)
+                 if self.RawBlocks.virtual_to_physical_block_map(block_number)[0] == 1][0]
+        physical_block_number = self.RawBlocks.virtual_to_physical_block_map(first)[1]
+        second = [block_number for block_number in range(48) if block_number != first
+                  and self.RawBlocks.virtual_to_physical_block_map(block_number)[1] == physical_block_number][0]
+        return first, second
+
+    def testConcurrentDegradedWrites(self):
+        blocks = self.Blocks(1)
+        self.RawBlocks.WriteBlocks(blocks)
+        first, second = self.StripeBlocks()
+        self.servers.Kill(1)
+        # another client writes a block of the stripe while the block of the dead server is written
+        other = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+        ReadStripes = self.RawBlocks.ReadStripes
+
+        def ReadThenWrite(physical_block_numbers, known):
+            stripe_blocks = ReadStripes(physical_block_numbers, known)
+            other.WriteBlocks([blocks[second]])
+            return stripe_blocks
+
+        self.RawBlocks.ReadStripes = ReadThenWrite
+        blocks[first] = (first, bytearray(b'f' * mc.BLOCK_SIZE))
+        blocks[second] = (second, bytearray(b's' * mc.BLOCK_SIZE))
+        self.RawBlocks.WriteBlocks([blocks[first]])
+        # the parity kept both writes
+        self.assertEqual(other.ReadBlocks([first, second]), [blocks[first][1], blocks[second][1]])
+
+    def testConcurrentDegradedRanges(self):
+        blocks = self.Blocks(1)
+        self.RawBlocks.WriteBlocks(blocks)
+        first, second = self.StripeBlocks()
+        self.servers.Kill(1)
+        # another client writes another range of the block while this one rebuilds it
+        other = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+        ReadBlocks = self.RawBlocks.ReadBlocks
+
+        def ReadThenWrite(block_numbers):
+            result = ReadBlocks(block_numbers)
+            other.PutRange(first, 10, b'bb')
+            return result
+
+        self.RawBlocks.ReadBlocks = ReadThenWrite
+        self.assertEqual(self.RawBlocks.PutRange(first, 0, b'aa'), 0)
+        blocks[first][1][0:2] = b'aa'
+        blocks[first][1][10:12] = b'bb'
+        self.assertEqual(other.ReadBlocks([first, second]), [blocks[first][1], blocks[second][1]])
+
+    def testDamagedBlock(self):
+        blocks = self.Blocks(3)
+        # a data block of server 0 that always fails its checksum
+        damaged = [block_number for block_number, data in blocks
+                   if self.RawBlocks.virtual_to_physical_block_map(block_number)[0] == 0][2]
+        physical_block_number = self.RawBlocks.virtual_to_physical_block_map(damaged)[1]
+        self.servers.Restart(0, str(physical_block_number))
+        self.RawBlocks.WriteBlocks(blocks)
+        self.assertEqual(self.ReadAll(), [data for block_number, data in blocks])
+        # a write to another block of its stripe computes the parity from the whole stripe
+        neighbour = [block_number for block_number, data in blocks if block_number != damaged and
+                     self.RawBlocks.virtual_to_physical_block_map(block_number)[1] == physical_block_number][0]
+        new_data = bytearray(b'n' * mc.BLOCK_SIZE)
+        self.RawBlocks.WriteBlocks([(neighbour, new_data)])
+        self.assertEqual(self.RawBlocks.ReadBlocks([damaged, neighbour]), [blocks[damaged][1], new_data])
+
+
+## Partial Put and Get: a range of a block travels alone, with its delta to the parity server
+
+class RangeTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(4)
+        self.RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+        self.blocks = [(block_number, bytearray([block_number + 1]) * mc.BLOCK_SIZE) for block_number in range(16)]
+        self.RawBlocks.WriteBlocks(self.blocks)
+
+    def tearDown(self):
+        self.servers.Stop()
+
+    def Calls(self):
+        return [health['calls'] for health in self.RawBlocks.ServerHealth()]
+
+    def testParityDelta(self):
+        server, physical_block_number, parity_server = self.RawBlocks.virtual_to_physical_block_map(5)
+        before = self.Calls()
+        self.assertEqual(self.RawBlocks.PutRange(5, 10, b'xyz'), 0)
+        # one call to the server of the block, one to its parity server
+        self.assertEqual([after - calls for after, calls in zip(self.Calls(), before)],
+                         [int(number in (server, parity_server)) for number in range(4)])
+        self.assertEqual(self.RawBlocks.GetRange(5, 9, 5), bytearray([6]) + b'xyz' + bytearray([6]))
+        # the parity is consistent: the block is rebuilt with the range
+        self.blocks[5][1][10:13] = b'xyz'
+        self.servers.Kill(server)
+        self.assertEqual(self.RawBlocks.ReadBlocks([5])[0], self.blocks[5][1])
+        self.assertEqual(self.RawBlocks.GetRange(5, 9, 5), bytearray([6]) + b'xyz' + bytearray([6]))
+
+    def testDamagedBlock(self):
+        server, physical_block_number, parity_server = self.RawBlocks.virtual_to_physical_block_map(5)
+        self.servers.Restart(server, str(physical_block_number))
+        self.RawBlocks.WriteBlocks(self.blocks)
+        # the block is rebuilt from its stripe and written whole
+        self.assertEqual(self.RawBlocks.PutRange(5, 10, b'xyz'), 0)
+        self.blocks[5][1][10:13] = b'xyz'
+        self.assertEqual(self.RawBlocks.GetRange(5, 0, mc.BLOCK_SIZE), self.blocks[5][1])
+        self.assertEqual(self.RawBlocks.ReadBlocks([block_number for block_number, data in self.blocks]),
+                         [data for block_number, data in self.blocks])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from servers import BlockServers, DefaultGeometry, WaitFor
+import memoryfs_client as mc
+import memoryfs_protocol
+from memoryfs_rebuild import Rebuild
+
+
+## Online rebuild of a server that replaced a failed one, and servers that missed writes kept out until rebuilt
+
+class RebuildTest(unittest.TestCase):
+    def setUp(self):
+        DefaultGeometry()
+        self.servers = BlockServers(4)
+        self.RawBlocks = self.Client()
+        self.blocks = [(block_number, bytearray([block_number % 256]) * mc.BLOCK_SIZE) for block_number in range(64)]
+        self.RawBlocks.WriteBlocks(self.blocks)
+
+    def tearDown(self):
+        self.servers.Stop()
+
+    def Client(self, heartbeat_interval=0):
+        return mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=heartbeat_interval)
+
+    ## Checks every block through the rebuilt server: another server is killed, so that its blocks are rebuilt
+    ## from the stripes that include the rebuilt server
+
+    def CheckRebuilt(self, server):
+        self.servers.Kill((server + 1) % 4)
+        client = self.Client()
+        self.assertEqual(client.ReadBlocks([block_number for block_number, data in self.blocks]),
+                         [data for block_number, data in self.blocks])
+
+    def testWatermark(self):
+        # server 1 is replaced by a blank server
+        self.servers.Restart(1, '--rebuilding')
+        target = self.RawBlocks.servers[1]
+        self.assertEqual(target.RebuildStatus(), 0)
+        # blocks not rebuilt yet are reported damaged: clients read them from the rest of their stripe
+        self.assertEqual(target.GetMany([0, 1]), [-1, -1])
+        self.assertEqual(self.Client().ReadBlocks([block_number for block_number, data in self.blocks]),
+                         [data for block_number, data in self.blocks])
+
+        # first batch only: the watermark tells how far the rebuild went
+        rebuild = Rebuild(self.Client(), 1, batch_size=8)
+        target.RebuildPutMany(rebuild.RebuildBatch(list(range(0, 8))), 8)
+        self.assertEqual(target.RebuildStatus(), 8)
+        self.assertNotEqual(target.GetMany([7])[0], -1)
+        self.assertEqual(target.GetMany([8])[0], -1)
+
+        # a run resumes from the watermark
+        progress = []
+        rebuild = Rebuild(self.Client(), 1, batch_size=8, progress=lambda done, total, elapsed: progress.append(done))
+        self.assertTrue(rebuild.Run())
+        self.assertEqual(progress[0], 16)
+        self.assertEqual(target.RebuildStatus(), -1)
+        self.assertEqual(rebuild.lost, [])
+        self.CheckRebuilt(1)
+
+    def testWritesDuringRebuild(self):
+        self.servers.Restart(2, '--rebuilding')
+        client = self.Client()
+        # blocks written by clients above the watermark are kept over the rebuilt ones
+        self.blocks[:10] = [(block_number, bytearray(b'w' * mc.BLOCK_SIZE)) for block_number in range(10)]
+        client.WriteBlocks(self.blocks[:10])
+        self.assertTrue(Rebuild(self.Client(), 2, batch_size=4).Run())
+        self.CheckRebuilt(2)
+
+    def testMissedWrites(self):
+        probe_backoff = memoryfs_protocol.PROBE_BACKOFF_MIN
+        memoryfs_protocol.PROBE_BACKOFF_MIN = 0.1
+        try:
+            client = self.Client(heartbeat_interval=0.1)
+            self.servers.Kill(3)
+            self.assertTrue(WaitFor(lambda: client.servers[3].Health()['state'] == 'down'))
+            # written without server 3, which comes back blank
+            self.blocks[:8] = [(block_number, bytearray(b'm' * mc.BLOCK_SIZE)) for block_number in range(8)]
+            client.WriteBlocks(self.blocks[:8])
+            self.servers.Start(3)
+
+            # neither this client nor a new one use it again
+            self.assertFalse(WaitFor(lambda: client.servers[3].Health()['state'] == 'up', 1))
+            # Mount checks the servers before the superblock (the blocks written here are not a file system)
+            other = self.Client()
+            other.Mount()
+            self.assertEqual(other.servers[3].Health()['state'], 'down')
+            self.assertEqual(other.ReadBlocks([block_number for block_number, data in self.blocks]),
+                             [data for block_number, data in self.blocks])
+
+            # until it is rebuilt
+            self.servers.Restart(3, '--rebuilding')
+            self.assertTrue(WaitFor(lambda: client.servers[3].Health()['state'] == 'up'))
+            self.assertTrue(Rebuild(self.Client(), 3).Run())
+            other = self.Client()
+            other.Mount()
+            self.assertEqual(other.servers[3].Health()['state'], 'up')
+            self.CheckRebuilt(3)
+        finally:
+            memoryfs_protocol.PROBE_BACKOFF_MIN = probe_backoff
+
+
+if __name__ == '__main__':
+    unittest.main()
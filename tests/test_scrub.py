@@ -0,0 +1,98 @@
+import threading
+import unittest
+
+from servers import BlockServers, DefaultGeometry
+import memoryfs_client as mc
+from memoryfs_scrub import Scrubber
+
+
+## Scrubber, on servers whose block size is not the default one: the geometry is set after memoryfs_scrub is
+## imported, as memoryfs_scrub does it
+
+class ScrubTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = BlockServers(3, '--num-blocks', '64', '--block-size', '512')
+        self.RawBlocks = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+        mc.SetGeometry(self.RawBlocks.Capacity(), self.RawBlocks.ServerGeometry()[1], 16, 16)
+        self.blocks = [(block_number, bytearray([block_number + 1]) * 512) for block_number in range(100)]
+        self.RawBlocks.WriteBlocks(self.blocks)
+
+    def tearDown(self):
+        self.servers.Stop()
+        DefaultGeometry()
+
+    def testCleanStripes(self):
+        scrubber = Scrubber(self.RawBlocks, batch_size=16)
+        self.assertTrue(scrubber.Run())
+        self.assertEqual(scrubber.metrics['stripes'], 64)
+        self.assertEqual(scrubber.metrics['parity_mismatches'], 0)
+        self.assertEqual(scrubber.metrics['checksum_errors'], 0)
+
+    def testParityRepaired(self):
+        # the parity of stripe 3 no longer matches its data, past the default block size
+        parity_server = self.RawBlocks.ParityServer(3)
+        parity = bytearray(self.RawBlocks.servers[parity_server].Get(3))
+        parity[-1] ^= 1
+        self.RawBlocks.servers[parity_server].Put(3, parity)
+        scrubber = Scrubber(self.RawBlocks, batch_size=16)
+        self.assertTrue(scrubber.Run())
+        self.assertEqual(scrubber.metrics['parity_mismatches'], 1)
+        self.assertEqual(scrubber.metrics['repaired'], 1)
+
+        scrubber = Scrubber(self.RawBlocks, batch_size=16)
+        self.assertTrue(scrubber.Run())
+        self.assertEqual(scrubber.metrics['parity_mismatches'], 0)
+        # the data of the stripe is rebuilt right from the repaired parity
+        self.servers.Kill((parity_server + 1) % 3)
+        self.assertEqual(self.RawBlocks.ReadBlocks([block_number for block_number, data in self.blocks]),
+                         [data for block_number, data in self.blocks])
+
+    ## Physical block numbers of the stripes whose blocks do not XOR to zero
+
+    def Inconsistent(self):
+        total = self.RawBlocks.ServerGeometry()[0]
+        blocks = self.RawBlocks.ReadPhysicalBlocks({server: list(range(total)) for server in range(3)})
+        return [physical_block_number for physical_block_number in range(total)
+                if mc.xor_many([blocks[(server, physical_block_number)] for server in range(3)], 512) != bytes(512)]
+
+    def testConcurrentWrites(self):
+        # the parity of a few stripes no longer matches their data
+        corrupted = [2, 17, 41]
+        for physical_block_number in corrupted:
+            parity_server = self.RawBlocks.ParityServer(physical_block_number)
+            parity = bytearray(self.RawBlocks.servers[parity_server].Get(physical_block_number))
+            parity[0] ^= 1
+            self.RawBlocks.servers[parity_server].Put(physical_block_number, parity)
+        self.assertEqual(self.Inconsistent(), corrupted)
+
+        # another client keeps writing single blocks, with parity deltas, while stripes are repaired
+        stop = threading.Event()
+
+        def Write():
+            client = mc.DiskBlocks(self.servers.URLs(), parallel=True, heartbeat_interval=0)
+            k = 0
+            while not stop.is_set():
+                block_number = k * 7 % len(self.blocks)
+                self.blocks[block_number] = (block_number, bytearray([k % 256]) * 512)
+                client.WriteBlocks([self.blocks[block_number]])
+                k += 1
+
+        writer = threading.Thread(target=Write)
+        writer.start()
+        try:
+            scrubber = Scrubber(self.RawBlocks, batch_size=16, recheck_delay=0.05)
+            for k in range(3):
+                self.assertTrue(scrubber.Run())
+        finally:
+            stop.set()
+            writer.join()
+        # no repair undid a write: the only inconsistent stripes left are corrupted ones that a write kept from
+        # being repaired, in every pass
+        self.assertLessEqual(set(self.Inconsistent()), set(corrupted))
+        self.assertTrue(scrubber.Run())
+        self.assertEqual(self.Inconsistent(), [])
+        self.assertEqual(self.RawBlocks.ReadBlocks([block_number for block_number, data in self.blocks]),
+                         [data for block_number, data in self.blocks])
+
+if __name__ == '__main__':
+    unittest.main()
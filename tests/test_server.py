@@ -0,0 +1,160 @@
+import os
+import tempfile
+import time
+import unittest
+
+# puts the repository root on the path
+import servers
+import memoryfs_server as ms
+
+
+## Batched calls of the block server, in process
+
+class ManyTest(unittest.TestCase):
+    def testGetPutMany(self):
+        server = ms.DiskBlocks(ms.MemoryBlockStore(16, 128))
+        self.assertEqual(server.PutMany([[2, b'b' * 128], [5, b'e']]), 0)
+        self.assertEqual([bytes(block) for block in server.GetMany([5, 2, 7])],
+                         [b'e' + bytes(127), b'b' * 128, bytes(128)])
+        self.assertEqual(server.GetMany([]), [])
+
+
+## Versions of the locks of the lock service
+
+## Sparse memory store: only the blocks holding data, and the checksum chunks they fall in, take memory
+
+class MemoryBlockStoreTest(unittest.TestCase):
+    def testSparse(self):
+        server = ms.DiskBlocks(ms.MemoryBlockStore(1 << 30, 128))
+        store = server.store
+        self.assertIs(server.Get(12345), store.checksums.zero_block)
+        self.assertEqual(store.checksum_chunks, {})
+
+        server.Put(5, b'a' * 128)
+        server.Put(ms.CHECKSUM_CHUNK_BLOCKS + 1, b'b' * 128)
+        self.assertEqual(list(store.block), [5, ms.CHECKSUM_CHUNK_BLOCKS + 1])
+        self.assertEqual(sorted(store.checksum_chunks), [0, 1])
+        self.assertEqual(bytes(server.Get(5)), b'a' * 128)
+
+        # a block of zeroes is dropped, and reads as zeroes with its empty checksum
+        server.Put(5, bytes(128))
+        self.assertNotIn(5, store.block)
+        self.assertEqual(store.ReadChecksum(5), store.checksums.empty)
+        self.assertIs(server.Get(5), store.checksums.zero_block)
+        # and allocates no checksums
+        server.Put(10 * ms.CHECKSUM_CHUNK_BLOCKS, bytes(128))
+        self.assertEqual(sorted(store.checksum_chunks), [0, 1])
+
+
+## Image store, which reads blocks as views of the image: Get returns a copy, that a later Put leaves alone
+
+class ImageBlockStoreTest(unittest.TestCase):
+    def testGetCopies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = ms.ImageBlockStore(os.path.join(directory, 'image'), 16, 128)
+            server = ms.DiskBlocks(store)
+            server.Put(3, b'a' * 128)
+            block_data = server.Get(3)
+            server.Put(3, b'b' * 128)
+            self.assertEqual(block_data, b'a' * 128)
+            self.assertEqual(server.ReadSetBlock(3, b'c' * 128), b'b' * 128)
+            store.Close()
+
+
+## Block checksum algorithms: an unwritten block, with its empty digest, reads as zeroes
+
+class ChecksumsTest(unittest.TestCase):
+    def testAlgorithms(self):
+        for algorithm, (size, digest) in ms.CHECKSUM_ALGORITHMS.items():
+            with self.subTest(algorithm=algorithm):
+                checksums = ms.Checksums(algorithm, 128)
+                data = bytes(range(128))
+                self.assertEqual(len(checksums.Digest(data)), size)
+                self.assertTrue(checksums.Matches(data, checksums.Digest(data)))
+                self.assertFalse(checksums.Matches(b'\x01' + data[1:], checksums.Digest(data)))
+                self.assertTrue(checksums.Matches(checksums.zero_block, checksums.empty))
+                self.assertTrue(checksums.Matches(bytes(128), checksums.empty))
+                self.assertFalse(checksums.Matches(data, checksums.empty))
+
+
+## Checksum verification policies of Get; the blocks updated in place are verified whatever the policy
+
+class VerifyPolicyTest(unittest.TestCase):
+    def Server(self, verify):
+        server = ms.DiskBlocks(ms.MemoryBlockStore(16, 128), verify=verify)
+        server.Put(3, b'a' * 128)
+        # verified once, and for 'once' never again
+        server.Get(3)
+        server.Get(3)
+        # silent corruption: the checksum is left as it was
+        server.store.block[3][0] ^= 1
+        return server
+
+    def testCorruptedBlock(self):
+        self.assertEqual(self.Server('always').Get(3), -1)
+        # trusted until it is written again
+        server = self.Server('once')
+        self.assertEqual(bytes(server.Get(3)), b'`' + b'a' * 127)
+        server.Put(3, b'b' * 128)
+        server.store.block[3][0] ^= 1
+        self.assertEqual(server.Get(3), -1)
+        # the scrubber verifies whatever the policy
+        for verify in ms.VERIFY_POLICIES:
+            with self.subTest(verify=verify):
+                self.assertEqual(self.Server(verify).VerifyMany([3, 4]), [3])
+
+    def testReadModifyWrite(self):
+        for verify in ms.VERIFY_POLICIES:
+            with self.subTest(verify=verify):
+                server = self.Server(verify)
+                # the corrupted block is not updated, which would give it a fresh checksum
+                self.assertEqual(server.XorInto(3, b'\x01' * 128), -1)
+                self.assertEqual(server.XorRange(3, 4, b'\x01' * 4), -1)
+                self.assertEqual(server.PutRange(3, 0, b'zz'), -1)
+                self.assertEqual(server.XorMany([[3, b'\x01' * 128]]), [3])
+                self.assertEqual(server.VerifyMany([3]), [3])
+
+    def testUndamagedBlock(self):
+        for verify in ms.VERIFY_POLICIES:
+            with self.subTest(verify=verify):
+                server = ms.DiskBlocks(ms.MemoryBlockStore(16, 128), verify=verify)
+                server.Put(3, b'a' * 128)
+                self.assertEqual(server.PutRange(3, 1, b'zz'), b'aa')
+                self.assertEqual(server.XorRange(3, 0, b'\x03'), 0)
+                self.assertEqual(bytes(server.Get(3)), b'b' + b'zz' + b'a' * 125)
+                self.assertEqual(server.VerifyMany([3]), [])
+
+
+class LockServiceTest(unittest.TestCase):
+    def testVersions(self):
+        locks = ms.LockService()
+        version = locks.Acquire('lock', 'a', 10, 0)
+        self.assertTrue(version)
+        # released by its exclusive owner: a new version
+        released = locks.Release('lock', 'a')
+        self.assertNotEqual(released, version)
+        self.assertEqual(locks.Acquire('lock', 'b', 10, 0, True), released)
+        self.assertEqual(locks.Release('lock', 'b'), released)
+        # the lease of an exclusive owner expired
+        locks.Acquire('lock', 'c', 0.01, 0)
+        self.assertNotEqual(locks.Acquire('lock', 'd', 10, 1), released)
+        self.assertFalse(locks.Release('lock', 'c'))
+        # a restarted server hands out other versions
+        self.assertNotEqual(ms.LockService().Acquire('lock', 'a', 10, 0), version)
+
+    def testUpgrade(self):
+        locks = ms.LockService()
+        self.assertTrue(locks.Acquire('lock', 'a', 10, 0, True))
+        self.assertTrue(locks.Acquire('lock', 'b', 10, 0, True))
+        # b may be upgrading too: refused rather than waited for
+        start = time.monotonic()
+        self.assertFalse(locks.Acquire('lock', 'a', 10, 5))
+        self.assertLess(time.monotonic() - start, 1)
+        # the only owner upgrades
+        locks.Release('lock', 'b')
+        self.assertTrue(locks.Acquire('lock', 'a', 10, 0))
+        self.assertFalse(locks.Acquire('lock', 'b', 10, 0, True))
+
+
+if __name__ == '__main__':
+    unittest.main()